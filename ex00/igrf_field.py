@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+#
+# IGRF magnetic field, |B|, electron gyrofrequency and dip angle on large
+# grids of points and for many dates.
+#
+# The field is a spherical harmonic expansion of the potential,
+#
+#   V = R_E sum_n (R_E/r)^(n+1) sum_m (g_nm cos(m phi) + h_nm sin(m phi)) P_nm(cos(theta))
+#
+# with Schmidt semi-normalized associated Legendre functions P_nm, and
+# B = -grad V. The Gauss coefficients g_nm and h_nm are given at epochs
+# five years apart, and are linear in time between the epochs. The field
+# is linear in the coefficients, so the field at any date is
+#
+#   B(t) = (1 - w) B(epoch_i) + w B(epoch_i+1),   w = (t - t_i)/(t_i+1 - t_i)
+#
+# Dates outside of the epochs are held at the first or last epoch, as in
+# ppigrf, and a warning is given.
+#
+# An IgrfGrid therefore evaluates the expansion (the Legendre recursions
+# and the trigonometric and radial factors) only once for each epoch that
+# is needed, and keeps the field of these epochs. All dates between two
+# epochs are then a weighted sum of two cached fields. The expansion itself
+# is evaluated for blocks of points, with the Legendre recursion in the
+# degree and order and vectorized over the points.
+#
+# The positions are geodetic (WGS84) latitude, longitude and height, as in
+# ppigrf.igrf(), or ECEF positions in meters, as in optics/jcoord.py. The
+# field is returned as east, north and up components relative to the
+# ellipsoid, and in the ECEF basis. The WGS84 ellipsoid and the geodetic
+# latitude of ECEF positions are those of optics/jcoord.py.
+#
+# The coefficients are read from a .shc file, by default the IGRF file
+# that comes with ppigrf (pip install ppigrf).
+#
+import os
+import sys
+import warnings
+import functools
+import importlib.util
+import numpy as n
+import scipy.constants as c
+
+def _load_jcoord():
+    # optics/jcoord.py, from the path or from the optics directory of this repository
+    try:
+        import jcoord
+        return(jcoord)
+    except ImportError:
+        fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "optics", "jcoord.py")
+        spec = importlib.util.spec_from_file_location("jcoord", fname)
+        jcoord = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(jcoord)
+        return(jcoord)
+
+jcoord = _load_jcoord()
+
+# radius of the expansion (km)
+RE = 6371.2
+# WGS84 of jcoord, with the semi-major axis in km
+WGS84_a = jcoord.a/1e3
+WGS84_e2 = jcoord.esq
+
+def _warn(message):
+    """ Warning attributed to the first caller outside of this module, so that it is shown once
+        for each call site in the user's code, whichever function of this module was called. """
+    this_file = os.path.abspath(__file__)
+    frame = sys._getframe(1)
+    level = 2
+    while frame is not None and os.path.abspath(frame.f_code.co_filename) == this_file:
+        frame = frame.f_back
+        level += 1
+    warnings.warn(message, stacklevel=level)
+
+def default_shc():
+    """ The IGRF coefficient file of ppigrf. """
+    spec = importlib.util.find_spec("ppigrf")
+    if spec is not None and spec.submodule_search_locations:
+        fnames = sorted(f for f in os.listdir(spec.submodule_search_locations[0]) if f.startswith("IGRF") and f.endswith(".shc"))
+        if len(fnames) > 0:
+            return(os.path.join(spec.submodule_search_locations[0], fnames[-1]))
+    raise FileNotFoundError("No IGRF .shc file found, pip install ppigrf or give the file name")
+
+def year_to_datetime64(year):
+    """ Decimal year to numpy.datetime64 (s), with the fraction of the year in days as in ppigrf. """
+    y = int(n.floor(year))
+    days = 366.0 if (y % 4 == 0 and (y % 100 != 0 or y % 400 == 0)) else 365.0
+    return(n.datetime64("%04d-01-01"%(y), "s") + n.timedelta64(int(round((year - y)*days*86400.0)), "s"))
+
+@functools.lru_cache(maxsize=4)
+def read_shc(fname=None):
+    """ Read a .shc spherical harmonic coefficient file.
+        Returns (epochs, degree, order, g, h), with the epochs as datetime64 (n_epochs,), the degree and
+        order (n_terms,) of the terms with order >= 0, and the coefficients g and h (n_epochs, n_terms) in nT.
+        h is zero for order 0. """
+    if fname is None:
+        fname = default_shc()
+    coeffs = {}
+    epochs = None
+    header = 2
+    with open(fname, "r") as f:
+        for line in f:
+            if line.startswith("#") or len(line.strip()) == 0:
+                continue
+            if header == 2:
+                header -= 1
+                continue
+            if header == 1:
+                epochs = n.array([year_to_datetime64(float(y)) for y in line.split()])
+                header -= 1
+                continue
+            v = line.split()
+            coeffs[(int(v[0]), int(v[1]))] = n.array(v[2:], dtype=n.float64)
+    keys = sorted([k for k in coeffs.keys() if k[1] >= 0])
+    degree = n.array([k[0] for k in keys])
+    order = n.array([k[1] for k in keys])
+    g = n.array([coeffs[k] for k in keys]).T
+    h = n.array([coeffs[(k[0], -k[1])] if k[1] > 0 else n.zeros(len(epochs)) for k in keys]).T
+    for a in [epochs, degree, order, g, h]:
+        a.setflags(write=False)
+    return(epochs, degree, order, g, h)
+
+def epoch_weights(date, epochs):
+    """ Index i and weight w of date between epochs i and i+1. The coefficients are not
+        extrapolated: dates before the first epoch or after the last are held at that epoch,
+        as in ppigrf, with a warning. """
+    t = n.datetime64(date, "s").astype(n.int64)
+    te = epochs.astype("datetime64[s]").astype(n.int64)
+    if t < te[0] or t > te[-1]:
+        _warn("%s is outside of the IGRF epochs %s to %s, using the nearest epoch"%(
+            str(n.datetime64(date, "s")), str(epochs[0]), str(epochs[-1])))
+    i = int(n.clip(n.searchsorted(te, t, side="right") - 1, 0, len(te) - 2))
+    w = float(n.clip((t - te[i])/(te[i+1] - te[i]), 0.0, 1.0))
+    return(i, w)
+
+@functools.lru_cache(maxsize=256)
+def _coefficients(t, fname):
+    epochs, degree, order, g, h = read_shc(fname)
+    i, w = epoch_weights(n.datetime64(t, "s"), epochs)
+    return((1.0 - w)*g[i] + w*g[i+1], (1.0 - w)*h[i] + w*h[i+1])
+
+def coefficients(date, fname=None):
+    """ Gauss coefficients g and h (n_terms,) in nT at a date, linearly interpolated between the epochs. """
+    return(_coefficients(str(n.datetime64(date, "s")), fname))
+
+def schmidt_factors(n_max):
+    """ Schmidt semi-normalization factors S[n, m] of the Legendre functions of legendre(). """
+    S = {(0, 0): 1.0}
+    for nn in range(1, n_max + 1):
+        S[nn, 0] = S[nn-1, 0]*(2.0*nn - 1.0)/nn
+        for m in range(1, nn + 1):
+            S[nn, m] = S[nn, m-1]*n.sqrt((nn - m + 1)*(2.0 if m == 1 else 1.0)/(nn + m))
+    return(S)
+
+def legendre(theta, n_max, normalize=True):
+    """ Schmidt semi-normalized associated Legendre functions P_nm(cos(theta)) and their derivatives
+        dP_nm/dtheta, as dicts of arrays with the shape of theta (radians), for 0 <= m <= n <= n_max.
+        With normalize=False, the factors schmidt_factors() are not applied. """
+    st = n.sin(theta)
+    ct = n.cos(theta)
+    P = {(0, 0): n.ones_like(theta)}
+    dP = {(0, 0): n.zeros_like(theta)}
+    for nn in range(1, n_max + 1):
+        for m in range(0, nn + 1):
+            if nn == m:
+                P[nn, m] = st*P[nn-1, m-1]
+                dP[nn, m] = st*dP[nn-1, m-1] + ct*P[nn-1, m-1]
+            elif m == nn - 1:
+                # P_n-2,m is zero
+                P[nn, m] = ct*P[nn-1, m]
+                dP[nn, m] = ct*dP[nn-1, m] - st*P[nn-1, m]
+            else:
+                K = ((nn - 1)**2 - m**2)/((2*nn - 1)*(2*nn - 3))
+                P[nn, m] = ct*P[nn-1, m] - K*P[nn-2, m]
+                dP[nn, m] = ct*dP[nn-1, m] - st*P[nn-1, m] - K*dP[nn-2, m]
+    if not normalize:
+        return(P, dP)
+    S = schmidt_factors(n_max)
+    for k in P.keys():
+        P[k] *= S[k]
+        dP[k] *= S[k]
+    return(P, dP)
+
+def spherical_field(r, theta, phi, g, h, degree, order, block_size=8192):
+    """ Geocentric field components B_r, B_theta, B_phi (n_sets, n_points) in nT at radius r (km),
+        colatitude theta and longitude phi (radians) (n_points,), for the coefficient sets g and h
+        (n_sets, n_terms). B_theta is southward. """
+    g = n.atleast_2d(g)
+    h = n.atleast_2d(h)
+    n_max = int(n.max(degree))
+    n_terms = len(degree)
+    n_pts = len(r)
+    Br = n.empty((g.shape[0], n_pts))
+    Bt = n.empty((g.shape[0], n_pts))
+    Bp = n.empty((g.shape[0], n_pts))
+    # with the terms (R_E/r)^(n+2) P_nm cos(m phi) and (R_E/r)^(n+2) P_nm sin(m phi), and the same with
+    # dP_nm/dtheta, the components are matrix products with the coefficients:
+    #   B_r = sum (n+1) (g c + h s),   B_theta = -sum (g dc + h ds),   B_phi = sum m (g s - h c)/sin(theta)
+    # the Schmidt normalization is applied to the coefficients instead of the Legendre functions
+    S = schmidt_factors(n_max)
+    S = n.array([S[nn, m] for nn, m in zip(degree, order)])
+    g = g*S[None, :]
+    h = h*S[None, :]
+    gh = n.concatenate([g, h], axis=1).T
+    c_r = n.concatenate([degree + 1, degree + 1])[:, None]*gh
+    c_t = -gh
+    c_p = n.concatenate([-order[:, None]*h.T, order[:, None]*g.T])
+    terms = n.empty((2*n_terms, block_size))
+    dterms = n.empty((2*n_terms, block_size))
+    for i0 in range(0, n_pts, block_size):
+        sl = slice(i0, min(i0 + block_size, n_pts))
+        n_b = sl.stop - sl.start
+        P, dP = legendre(theta[sl], n_max, normalize=False)
+        a = RE/r[sl]
+        a_n = {1: a*a*a}
+        for nn in range(2, n_max + 1):
+            a_n[nn] = a_n[nn-1]*a
+        # cos(m phi) and sin(m phi) from powers of exp(i phi)
+        z1 = n.exp(1j*phi[sl])
+        z = {0: n.ones(n_b, dtype=n.complex128), 1: z1}
+        for m in range(2, n_max + 1):
+            z[m] = z[m-1]*z1
+        cos_m = {m: z[m].real for m in z.keys()}
+        sin_m = {m: z[m].imag for m in z.keys()}
+        for k, (nn, m) in enumerate(zip(degree, order)):
+            rp = a_n[nn]*P[nn, m]
+            rdp = a_n[nn]*dP[nn, m]
+            n.multiply(rp, cos_m[m], out=terms[k, :n_b])
+            n.multiply(rp, sin_m[m], out=terms[k + n_terms, :n_b])
+            n.multiply(rdp, cos_m[m], out=dterms[k, :n_b])
+            n.multiply(rdp, sin_m[m], out=dterms[k + n_terms, :n_b])
+        T = terms[:, :n_b]
+        Br[:, sl] = c_r.T @ T
+        Bt[:, sl] = c_t.T @ dterms[:, :n_b]
+        Bp[:, sl] = (c_p.T @ T)/n.sin(theta[sl])[None, :]
+    return(Br, Bt, Bp)
+
+def geodetic2spherical(lat, lon, alt_km):
+    """ Geocentric radius (km), colatitude and longitude (radians) of geodetic (WGS84) positions. """
+    lat = n.radians(lat)
+    N = WGS84_a/n.sqrt(1.0 - WGS84_e2*n.sin(lat)**2.0)
+    rho = (N + alt_km)*n.cos(lat)
+    z = (N*(1.0 - WGS84_e2) + alt_km)*n.sin(lat)
+    return(n.sqrt(rho**2.0 + z**2.0), n.arctan2(rho, z), n.radians(lon))
+
+class IgrfGrid:
+    """ IGRF field on a fixed set of points, for any number of dates. The field of each IGRF epoch
+        that is needed is computed once and kept.
+        @lat, lon geodetic latitude and longitude (degrees)
+        @alt_km height above the WGS84 ellipsoid (km)
+        @fname .shc coefficient file, default from ppigrf
+        @block_size number of points evaluated at once
+    """
+    def __init__(self, lat, lon, alt_km, fname=None, block_size=8192):
+        lat, lon, alt_km = n.broadcast_arrays(n.asarray(lat, dtype=n.float64), n.asarray(lon, dtype=n.float64),
+                                              n.asarray(alt_km, dtype=n.float64))
+        self.shape = lat.shape
+        self.fname = fname
+        self.block_size = block_size
+        self.gdlat = lat.ravel()
+        self.r, self.theta, self.phi = geodetic2spherical(self.gdlat, lon.ravel(), alt_km.ravel())
+        self.epoch_fields = {}
+        self.rotation = None
+
+    @classmethod
+    def from_ecef(cls, ecef, fname=None, block_size=8192):
+        """ Grid of ECEF positions (3, ...) in meters, e.g., points along ray paths from optics/jcoord.py. """
+        ecef = n.asarray(ecef, dtype=n.float64)
+        grid = cls.__new__(cls)
+        grid.shape = ecef.shape[1:]
+        grid.fname = fname
+        grid.block_size = block_size
+        x, y, z = [e.ravel() for e in ecef]
+        grid.gdlat = jcoord.ecef2geodetic(x, y, z, method="bowring")[0]
+        grid.r = n.sqrt(x**2.0 + y**2.0 + z**2.0)/1e3
+        grid.theta = n.arctan2(n.sqrt(x**2.0 + y**2.0), z)
+        grid.phi = n.arctan2(y, x)
+        grid.epoch_fields = {}
+        grid.rotation = None
+        return(grid)
+
+    def _epoch_field(self, indices):
+        # geocentric field (3, n_points) of the epochs, computing the ones not yet cached in one pass
+        epochs, degree, order, g, h = read_shc(self.fname)
+        new = [i for i in indices if i not in self.epoch_fields]
+        if len(new) > 0:
+            Br, Bt, Bp = spherical_field(self.r, self.theta, self.phi, g[new], h[new], degree, order, self.block_size)
+            for j, i in enumerate(new):
+                self.epoch_fields[i] = n.array([Br[j], Bt[j], Bp[j]])
+        return([self.epoch_fields[i] for i in indices])
+
+    def spherical(self, date):
+        """ Geocentric B_r, B_theta (southward), B_phi (eastward) (3, ...) in nT at a date. """
+        epochs = read_shc(self.fname)[0]
+        i, w = epoch_weights(date, epochs)
+        B0, B1 = self._epoch_field([i, i + 1])
+        B = B0*(1.0 - w)
+        B += w*B1
+        return(B.reshape((3,) + self.shape))
+
+    def field(self, date):
+        """ IGRF field at a date. Returns a dict with the east, north and up components relative to the
+            ellipsoid Be, Bn, Bu (...) in nT, the field in the ECEF basis ecef (3, ...) in nT, |B| B (nT),
+            the electron gyrofrequency gyrofrequency (Hz) and the dip (inclination) angle dip (degrees,
+            positive downward). """
+        Br, Bt, Bp = self.spherical(date).reshape(3, -1)
+        if self.rotation is None:
+            # rotation from geocentric to geodetic vertical, and to ECEF
+            psi = n.radians(self.gdlat) - (0.5*n.pi - self.theta)
+            self.rotation = (n.cos(psi), n.sin(psi), n.sin(self.theta), n.cos(self.theta), n.sin(self.phi), n.cos(self.phi))
+        cpsi, spsi, st, ct, sp, cp = self.rotation
+        Bn = -cpsi*Bt - spsi*Br
+        Bu = -spsi*Bt + cpsi*Br
+        Be = Bp
+        ecef = n.array([st*cp*Br + ct*cp*Bt - sp*Bp,
+                        st*sp*Br + ct*sp*Bt + cp*Bp,
+                        ct*Br - st*Bt])
+        B = n.sqrt(Br**2.0 + Bt**2.0 + Bp**2.0)
+        res = {"Be": Be, "Bn": Bn, "Bu": Bu, "B": B,
+               "gyrofrequency": gyrofrequency(B),
+               "dip": n.degrees(n.arctan2(-Bu, n.sqrt(Be**2.0 + Bn**2.0)))}
+        res = {k: v.reshape(self.shape) for k, v in res.items()}
+        res["ecef"] = ecef.reshape((3,) + self.shape)
+        return(res)
+
+def gyrofrequency(B):
+    """ Electron gyrofrequency (Hz) of magnetic field strength B (nT). """
+    return(c.e*n.asarray(B)*1e-9/c.electron_mass/(2.0*n.pi))
+
+def igrf(lon, lat, alt_km, date, fname=None):
+    """ Be, Bn, Bu (nT) at geodetic positions for one date, with the argument order of ppigrf.igrf().
+        The shape is the broadcast shape of the positions, without the date axis of ppigrf. """
+    f = IgrfGrid(lat, lon, alt_km, fname=fname).field(date)
+    return(f["Be"], f["Bn"], f["Bu"])
+
+if __name__ == "__main__":
+    import time
+    from datetime import datetime
+
+    # the profile of igrfdemo.py
+    lat = 69.65
+    lon = 18.96
+    h = n.linspace(0, 500, 500)
+    date = datetime(2024, 1, 17)
+    Be, Bn, Bu = igrf(lon, lat, h, date)
+    print("Tromso 0-500 km: |B| %1.0f-%1.0f nT, gyrofrequency %1.3f-%1.3f MHz"%(
+        n.min(n.sqrt(Be**2 + Bn**2 + Bu**2)), n.max(n.sqrt(Be**2 + Bn**2 + Bu**2)),
+        n.min(gyrofrequency(n.sqrt(Be**2 + Bn**2 + Bu**2)))/1e6, n.max(gyrofrequency(n.sqrt(Be**2 + Bn**2 + Bu**2)))/1e6))
+
+    # a lat, lon, height grid of one million points, for dates through a year
+    glat, glon, galt = n.meshgrid(n.linspace(55, 80, 100), n.linspace(-10, 40, 100), n.linspace(60, 600, 100), indexing="ij")
+    t0 = time.perf_counter()
+    grid = IgrfGrid(glat, glon, galt)
+    f = grid.field(date)
+    t1 = time.perf_counter()
+    dates = [n.datetime64("2024-01-01") + n.timedelta64(d, "D") for d in range(0, 365, 12)]
+    for d in dates:
+        f = grid.field(d)
+    t2 = time.perf_counter()
+    print("%d points: first date %1.2f s, %d more dates %1.2f s (%1.3f s per date)"%(
+        glat.size, t1-t0, len(dates), t2-t1, (t2-t1)/len(dates)))
+
+    # points along a ray path in ECEF, compared with the geodetic grid
+    ecef = n.array([n.linspace(2.1e6, 2.3e6, 1000), n.full(1000, 0.7e6), n.linspace(5.9e6, 6.2e6, 1000)])
+    fe = IgrfGrid.from_ecef(ecef).field(date)
+    print("Ray path: |B| %1.0f-%1.0f nT, dip %1.1f-%1.1f deg"%(n.min(fe["B"]), n.max(fe["B"]), n.min(fe["dip"]), n.max(fe["dip"])))
+
+    # the ECEF field against the ENU field rotated with the jcoord formulas
+    ee = [-n.sin(n.radians(lon)), n.cos(n.radians(lon)), 0.0]
+    nn = [-n.sin(n.radians(lat))*n.cos(n.radians(lon)), -n.sin(n.radians(lat))*n.sin(n.radians(lon)), n.cos(n.radians(lat))]
+    uu = [n.cos(n.radians(lat))*n.cos(n.radians(lon)), n.cos(n.radians(lat))*n.sin(n.radians(lon)), n.sin(n.radians(lat))]
+    fp = IgrfGrid(lat, lon, h).field(date)
+    rot = n.array([ee[i]*fp["Be"] + nn[i]*fp["Bn"] + uu[i]*fp["Bu"] for i in range(3)])
+    print("Max difference ECEF vs rotated ENU: %1.2g nT"%(n.max(n.abs(rot - fp["ecef"]))))
+
+    try:
+        import ppigrf
+    except ImportError:
+        ppigrf = None
+        print("ppigrf is not installed, no comparison")
+    if ppigrf is not None:
+        Be_p, Bn_p, Bu_p = ppigrf.igrf(lon, lat, h, date)
+        print("Max difference to ppigrf.igrf: %1.2g nT"%(n.max(n.abs(n.array([Be - Be_p[0], Bn - Bn_p[0], Bu - Bu_p[0]])))))
+        # one ppigrf.igrf call per point and date
+        n_calls = 100
+        pts = n.random.default_rng(0).integers(0, glat.size, n_calls)
+        t0 = time.perf_counter()
+        ref = n.array([n.ravel(ppigrf.igrf(glon.flat[i], glat.flat[i], galt.flat[i], dates[-1])) for i in pts])
+        t1 = time.perf_counter()
+        print("ppigrf.igrf: %1.1f ms per call, %1.0f s for the %d points of one date"%(1e3*(t1-t0)/n_calls, (t1-t0)/n_calls*glat.size, glat.size))
+        ours = n.array([f["Be"].flat[pts], f["Bn"].flat[pts], f["Bu"].flat[pts]]).T
+        print("Max difference on the grid: %1.2g nT"%(n.max(n.abs(ours - ref))))
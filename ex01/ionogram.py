@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+#
+# Synthetic O-mode ionograms from electron density profiles, for all
+# frequencies and for batches of profiles at once.
+#
+# Without the magnetic field, the O-mode group velocity is
+#
+#   v_g/c = sqrt(1 - X),   X = omega_p^2/omega^2,   omega_p^2 = e^2 n_e/(eps_0 m_e)
+#
+# and a vertically launched wave reflects at the first height where X = 1.
+# The plasma frequency does not depend on the radio frequency, so it is
+# computed once per profile. The reflection height of every frequency is
+# found from the running maximum of the plasma frequency, which is
+# non-decreasing in height: the first height where the running maximum
+# reaches f is a searchsorted() of f into it. For a batch of profiles, the
+# running maxima of all profiles are searched at once, by offsetting each
+# profile (and its frequencies) by a multiple of a frequency larger than
+# any plasma frequency, which keeps the concatenated array sorted.
+#
+# The virtual height is the group path up to the reflection height,
+#
+#   h' = h_0 + sum_{i < r-2} dh_i/sqrt(1 - X_i)
+#
+# which is the sum of ex01/ionosol.py, including leaving out the last two
+# heights below reflection where the integrand is singular. This sum
+# converges slowly with the grid spacing; virtual_height.py integrates the
+# singularity analytically.
+#
+import numpy as n
+import scipy.constants as c
+
+def read_iri_csv(fname="iri_data.csv"):
+    """ Altitude (km) and electron density (1/m^3) from a file such as iri_data.csv.
+        Missing densities (-1) are set to zero. """
+    d = n.loadtxt(fname, delimiter=",", comments="#")
+    return(d[:, 0], n.maximum(d[:, 1], 0.0))
+
+def plasma_frequency(ne):
+    """ Plasma frequency (Hz) of electron density (1/m^3). Negative or NaN densities are zero. """
+    ne = n.asarray(ne, dtype=n.float64)
+    ne = n.where(ne > 0, ne, 0.0)
+    return(n.sqrt(c.e**2.0*ne/(c.epsilon_0*c.electron_mass))/(2.0*n.pi))
+
+def electron_density(fp):
+    """ Electron density (1/m^3) of plasma frequency fp (Hz), the inverse of plasma_frequency(). """
+    return((2.0*n.pi*n.asarray(fp, dtype=n.float64))**2.0*c.epsilon_0*c.electron_mass/c.e**2.0)
+
+def group_velocity(ne, freqs):
+    """ O-mode v_g/c (..., n_h, n_freq) as the V array of ionosol.py. NaN above reflection. """
+    X = (plasma_frequency(ne)[..., :, None]/n.asarray(freqs)[None, :])**2.0
+    with n.errstate(invalid="ignore"):
+        return(n.sqrt(1.0 - X))
+
+def reflection_index(fp, freqs):
+    """ Index (..., n_freq) of the first height where the plasma frequency fp (..., n_h) reaches
+        the frequency. n_h when the frequency doesn't reflect. """
+    fp = n.asarray(fp, dtype=n.float64)
+    freqs = n.asarray(freqs, dtype=n.float64)
+    batch_shape = fp.shape[:-1]
+    n_h = fp.shape[-1]
+    fp = fp.reshape(-1, n_h)
+    n_b = fp.shape[0]
+    cmax = n.maximum.accumulate(fp, axis=1)
+    # offset each profile by a frequency larger than all plasma frequencies and frequencies
+    offset = 2.0*max(n.max(cmax), n.max(freqs)) + 1.0
+    shift = offset*n.arange(n_b)[:, None]
+    idx = n.searchsorted((cmax + shift).ravel(), (freqs[None, :] + shift).ravel(), side="left")
+    idx = idx.reshape(n_b, len(freqs)) - n_h*n.arange(n_b)[:, None]
+    return(idx.reshape(batch_shape + (len(freqs),)))
+
+def synthesize(alt_km, ne, freqs, max_elements=2**24):
+    """ O-mode ionogram of one profile ne (n_h,) or a batch of profiles (..., n_h) on the altitude grid alt_km.
+        @freqs frequencies (Hz)
+        @max_elements profiles are processed in chunks of at most this many (profile, frequency, height) values
+        Returns a dict with the reflection height and virtual height (..., n_freq) in km (NaN for frequencies
+        above the critical frequency), the reflection index, and foF2 (...) in Hz.
+    """
+    alt_km = n.asarray(alt_km, dtype=n.float64)
+    ne = n.asarray(ne, dtype=n.float64)
+    freqs = n.asarray(freqs, dtype=n.float64)
+    batch_shape = ne.shape[:-1]
+    n_h = len(alt_km)
+    n_f = len(freqs)
+    fp = plasma_frequency(ne).reshape(-1, n_h)
+    n_b = fp.shape[0]
+    ridx = reflection_index(fp, freqs)
+    dh = n.diff(alt_km, append=alt_km[-1])
+
+    virtual = n.full((n_b, n_f), n.nan)
+    h_idx = n.arange(n_h)
+    inv_f2 = 1.0/freqs**2.0
+    reflects = ridx < n_h
+    if n.any(reflects):
+        # only the frequencies that reflect, and the heights below reflection, are integrated.
+        # the chunk size is set from the largest of these over the batch.
+        n_fr = n.max(n.sum(reflects, axis=1))
+        h_r = n.max(ridx[reflects])
+        chunk = max(1, max_elements//(n_fr*h_r))
+        for b0 in range(0, n_b, chunk):
+            r = ridx[b0:b0+chunk]
+            f_sel = n.flatnonzero(n.any(r < n_h, axis=0))
+            if len(f_sel) == 0:
+                continue
+            r = r[:, f_sel]
+            h_max = max(1, n.max(n.where(r < n_h, r, 0)) - 2)
+            below = h_idx[None, None, :h_max] < (r - 2)[:, :, None]
+            X = fp[b0:b0+chunk, None, :h_max]**2.0*inv_f2[None, f_sel, None]
+            integrand = n.where(below, dh[None, None, :h_max]/n.sqrt(n.where(below, 1.0 - X, 1.0)), 0.0)
+            virtual[b0:b0+chunk, f_sel] = alt_km[0] + n.sum(integrand, axis=2)
+
+    reflects = ridx < n_h
+    virtual[~reflects] = n.nan
+    reflection = n.where(reflects, alt_km[n.minimum(ridx, n_h-1)], n.nan)
+    return({"reflection_height": reflection.reshape(batch_shape + (n_f,)),
+            "virtual_height": virtual.reshape(batch_shape + (n_f,)),
+            "reflection_index": ridx.reshape(batch_shape + (n_f,)),
+            "foF2": n.max(fp, axis=1).reshape(batch_shape)})
+
+if __name__ == "__main__":
+    import time
+    alt_km, ne = read_iri_csv("iri_data.csv")
+    freqs = n.linspace(0.5e6, 16e6, num=1000)
+
+    # the loops of ionosol.py
+    t0 = time.perf_counter()
+    V = n.zeros([len(alt_km), 1000])
+    with n.errstate(invalid="ignore"):
+        for fi in range(len(freqs)):
+            omp2 = (c.e**2.0*ne/(c.epsilon_0*c.electron_mass))
+            V[:, fi] = n.sqrt(1 - omp2/((2.0*n.pi*freqs[fi])**2.0))
+    dx = n.diff(alt_km)[0]
+    reflection_height_idx = n.zeros(len(freqs), dtype=int)
+    virtual_ref = n.full(len(freqs), n.nan)
+    for fi in range(len(freqs)):
+        ridx = n.where(n.isnan(V[:, fi]))[0]
+        if len(ridx) > 0:
+            reflection_height_idx[fi] = ridx[0]
+            virtual_ref[fi] = alt_km[0] + n.sum(dx/V[0:(ridx[0]-2), fi])
+        else:
+            reflection_height_idx[fi] = -1
+    t1 = time.perf_counter()
+    res = synthesize(alt_km, ne, freqs)
+    t2 = time.perf_counter()
+    print("One profile, %d frequencies: loops %1.3f s, vectorized %1.3f s"%(len(freqs), t1-t0, t2-t1))
+    print("foF2 %1.2f MHz, max virtual height difference %1.2g km"%(res["foF2"]/1e6, n.nanmax(n.abs(res["virtual_height"] - virtual_ref))))
+    print("Same reflection heights: %s"%(n.array_equal(n.where(reflection_height_idx < 0, len(alt_km), reflection_height_idx), res["reflection_index"])))
+
+    # a day of 5 minute profiles, scaled and shifted versions of the IRI profile
+    n_t = 288
+    hour = n.arange(n_t)/12.0
+    scale = 0.5 + 0.5*(1 + n.cos(2*n.pi*(hour - 12)/24))
+    shift = 20.0*n.sin(2*n.pi*hour/24)
+    ne_batch = scale[:, None]*n.array([n.interp(alt_km - s, alt_km, ne) for s in shift])
+    t0 = time.perf_counter()
+    res = synthesize(alt_km, ne_batch, freqs)
+    t1 = time.perf_counter()
+    print("%d profiles: %1.2f s, foF2 from %1.2f to %1.2f MHz"%(n_t, t1-t0, n.min(res["foF2"])/1e6, n.max(res["foF2"])/1e6))
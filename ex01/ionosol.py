@@ -2,22 +2,25 @@
 
 import numpy as n
 import matplotlib.pyplot as plt
-import scipy.constants as c
 # https://github.com/space-physics/iri2016
 # pip install iri2016
 # documentation:
 # http://www.physics.mcgill.ca/mist/memos/MIST_memo_46.pdf
-import iri2016.profile as iri
+# iri_cache runs iri2016.profile.IRI() and caches the profiles on disk.
+# Without iri2016, the profile of iri_data.csv is used.
+import iri_cache
 
 from datetime import datetime, timedelta
 from matplotlib.pyplot import figure, show
 
+import ionogram
+
 time_date = datetime(2016,7,7,12,0,0)
 alt_km_range = (0,1000,1)
 glat=69
 glon=19
 
-sim = iri.IRI(time_date, [0,1000,1], glat, glon)
+sim = iri_cache.IriProfiles(alt_km_range=alt_km_range).profile(time_date, glat, glon)
 
 ne=sim["ne"]
 alt_km=sim["alt_km"]
@@ -28,10 +31,8 @@ plt.ylabel("Altitude (km)")
 plt.show()
 
 freqs=n.linspace(0.5e6,16e6,num=1000)
-V = n.zeros([len(alt_km),1000])
-for fi in range(len(freqs)):
-    omp2=(c.e**2.0 * ne / (c.epsilon_0 * c.electron_mass))
-    V[:,fi] = n.sqrt(1 - omp2/((2.0*n.pi*freqs[fi])**2.0))
+# v_g/c for all heights and frequencies
+V = ionogram.group_velocity(ne,freqs)
 
 fof2=9.0*n.sqrt(n.max(ne))/1e6
 print(fof2)
@@ -44,21 +45,10 @@ plt.xlabel("$n_e$ (m$^{-3}$)")
 plt.ylabel("Altitude (km)")
 plt.xlabel("Frequency (MHz)")
 #plt.show()
-# delta height in meters 
-dx=n.diff(alt_km)[0]*1e3
-
-reflection_height_idx=n.zeros(len(freqs),dtype=int)
-group_delay=n.zeros(len(freqs))
-for fi in range(len(freqs)):
-    ridx=n.where(n.isnan(V[:,fi]))[0]
-    if len(ridx)>0:
-        reflection_height_idx[fi]=ridx[0]
-        group_delay[fi]=2.0*n.sum(dx/(c.c*V[0:(ridx[0]-2),fi]))
-    else:
-        reflection_height_idx[fi]=-1
-        group_delay[fi]=-1
-plt.plot(freqs/1e6,alt_km[reflection_height_idx],color="red",label="Reflection height (O-mode)")
-plt.plot(freqs/1e6,group_delay*c.c/2.0/1e3,color="blue",label="Virtual height (O-mode)")
+# reflection and virtual heights of all frequencies at once
+iono=ionogram.synthesize(alt_km,ne,freqs)
+plt.plot(freqs/1e6,iono["reflection_height"],color="red",label="Reflection height (O-mode)")
+plt.plot(freqs/1e6,iono["virtual_height"],color="blue",label="Virtual height (O-mode)")
 plt.ylim([0,1000])
 plt.legend()
 
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+#
+# Cached, batched IRI electron density profiles.
+#
+# A call to iri2016.profile.IRI() runs the IRI model for one time and
+# location, which is slow, and the same profiles are often requested again
+# by later runs. Each profile is therefore stored in an on-disk cache, one
+# file per profile, named by a hash of everything the profile depends
+# on: the source, the time, the location, the altitude grid and the
+# variables. A changed request is a new file, and a cached file is never
+# out of date. The files are raw float64 (variables x heights), as the
+# shape is known from the request, which avoids parsing a header for every
+# profile.
+#
+# The cache has a maximum size. A cache hit updates the modification time
+# of the file, and when new profiles make the cache too large, the files
+# that were least recently used are removed. Profiles read in the current
+# session are also kept in memory, up to max_memory profiles.
+#
+# Requests for many (time, lat, lon) are looked up at once. The profiles
+# that are not in the cache are computed in a process pool.
+#
+# Without iri2016 (pip install iri2016), the profile of iri_data.csv is
+# used for all times and locations, interpolated to the altitude grid.
+#
+import os
+import hashlib
+import functools
+import collections
+import concurrent.futures
+import numpy as n
+
+import ionogram
+
+def have_iri2016():
+    try:
+        import iri2016.profile
+        return(True)
+    except ImportError:
+        return(False)
+
+def as_datetime64(t):
+    """ Time as numpy.datetime64 (s) from a datetime, datetime64, ISO string or unix seconds. """
+    if isinstance(t, (int, float, n.integer, n.floating)):
+        return(n.datetime64(int(round(t)), "s"))
+    return(n.datetime64(t, "s"))
+
+def iri2016_profile(t, glat, glon, alt_km_range, variables=("ne",)):
+    """ Profiles of variables (e.g., ne, Te, Ti) from iri2016 for one time and location. """
+    import iri2016.profile as iri
+    sim = iri.IRI(as_datetime64(t).astype(object), list(alt_km_range), glat, glon)
+    res = {"alt_km": n.asarray(sim["alt_km"], dtype=n.float64)}
+    for v in variables:
+        res[v] = n.asarray(sim[v], dtype=n.float64).ravel()
+    return(res)
+
+@functools.lru_cache(maxsize=4)
+def _read_csv(fname):
+    return(ionogram.read_iri_csv(fname))
+
+def csv_profile(t, glat, glon, alt_km_range, variables=("ne",), fname=None):
+    """ The electron density of iri_data.csv, the same for all times and locations,
+        interpolated to the altitude grid. Zero outside of the heights of the file. """
+    if tuple(variables) != ("ne",):
+        raise ValueError("Only ne is available from %s"%(fname))
+    if fname is None:
+        fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), "iri_data.csv")
+    alt, ne = _read_csv(fname)
+    alt_km = altitudes(alt_km_range)
+    return({"alt_km": alt_km, "ne": n.interp(alt_km, alt, ne, left=0.0, right=0.0)})
+
+sources = {"iri2016": iri2016_profile, "csv": csv_profile}
+
+def altitudes(alt_km_range):
+    """ Altitude grid (km) of an IRI altitude range (start, stop, step), including stop. """
+    a0, a1, da = alt_km_range
+    return(n.arange(a0, a1 + 0.5*da, da, dtype=n.float64))
+
+def _compute(task):
+    # worker: profiles of a list of (key, t, glat, glon)
+    source, alt_km_range, variables, requests = task
+    f = sources[source]
+    return([(key, f(t, glat, glon, alt_km_range, variables)) for key, t, glat, glon in requests])
+
+class IriProfiles:
+    """ IRI profiles on the altitude grid alt_km_range (start, stop, step) in km, cached on disk.
+        @cache_dir directory of the cache
+        @source "iri2016", "csv" or "auto" (iri2016 if it is installed, otherwise csv)
+        @variables IRI variables to return
+        @max_bytes maximum size of the cache on disk
+        @max_memory maximum number of profiles kept in memory
+        @n_workers processes for profiles not in the cache. Default all cores for iri2016, and one for csv.
+    """
+    def __init__(self, cache_dir="~/.cache/fys3002/iri", alt_km_range=(50, 1000, 1), source="auto",
+                 variables=("ne",), max_bytes=2**30, max_memory=10000, n_workers=None):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.alt_km_range = tuple(float(a) for a in alt_km_range)
+        if source == "auto":
+            source = "iri2016" if have_iri2016() else "csv"
+        if source not in sources:
+            raise ValueError("Unknown source %s, use %s or auto"%(source, ", ".join(sources.keys())))
+        self.source = source
+        self.variables = tuple(variables)
+        self.max_bytes = max_bytes
+        self.max_memory = max_memory
+        if n_workers is None:
+            n_workers = os.cpu_count() if source == "iri2016" else 1
+        self.n_workers = n_workers
+        self.alt_km = altitudes(self.alt_km_range)
+        self.memory = collections.OrderedDict()
+
+    def key(self, t, glat, glon):
+        """ Cache key of a profile. The location is rounded to 1e-4 degrees. """
+        s = "%s|%s|%.4f|%.4f|%r|%s"%(self.source, str(as_datetime64(t)), glat, (glon + 180.0)%360.0 - 180.0,
+                                       self.alt_km_range, ",".join(self.variables))
+        return(hashlib.sha1(s.encode()).hexdigest())
+
+    def fname(self, key):
+        return(os.path.join(self.cache_dir, key[0:2], key + ".f8"))
+
+    def _remember(self, key, prof):
+        self.memory[key] = prof
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory:
+            self.memory.popitem(last=False)
+
+    def _read(self, key):
+        # profile from memory or disk, None if not cached
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return(self.memory[key])
+        fname = self.fname(key)
+        try:
+            d = n.fromfile(fname, dtype=n.float64)
+        except (FileNotFoundError, OSError):
+            return(None)
+        if len(d) != len(self.variables)*len(self.alt_km):
+            return(None)
+        d = d.reshape(len(self.variables), len(self.alt_km))
+        prof = {v: d[i] for i, v in enumerate(self.variables)}
+        # mark as recently used
+        os.utime(fname)
+        self._remember(key, prof)
+        return(prof)
+
+    def _write(self, key, prof):
+        fname = self.fname(key)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmp = "%s.%d.tmp"%(fname, os.getpid())
+        n.array([prof[v] for v in self.variables], dtype=n.float64).tofile(tmp)
+        os.replace(tmp, fname)
+        self._remember(key, prof)
+
+    def cache_files(self):
+        """ (file name, size, modification time) of the files in the cache. """
+        files = []
+        for sub in os.scandir(self.cache_dir):
+            if not sub.is_dir():
+                continue
+            for f in os.scandir(sub.path):
+                if f.name.endswith(".f8"):
+                    st = f.stat()
+                    files.append((f.path, st.st_size, st.st_mtime))
+        return(files)
+
+    def evict(self):
+        """ Remove the least recently used files until the cache is at most max_bytes. """
+        files = self.cache_files()
+        total = sum(f[1] for f in files)
+        for fname, size, mtime in sorted(files, key=lambda f: f[2]):
+            if total <= self.max_bytes:
+                break
+            os.remove(fname)
+            total -= size
+
+    def _compute(self, requests):
+        # (key, profile) of requests that are not in the cache
+        tasks = []
+        n_tasks = max(1, min(len(requests), 4*self.n_workers))
+        for i in range(n_tasks):
+            tasks.append((self.source, self.alt_km_range, self.variables, requests[i::n_tasks]))
+        if self.n_workers <= 1 or len(requests) == 1:
+            return([r for task in tasks for r in _compute(task)])
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+            return([r for res in pool.map(_compute, tasks) for r in res])
+
+    def profiles(self, times, glat, glon):
+        """ Profiles for all times and locations, broadcast against each other.
+            Returns a dict with alt_km (n_h,) and each variable (..., n_h), where ... is the broadcast shape. """
+        times = n.asarray(times, dtype=object if not isinstance(times, n.ndarray) else None)
+        times, glat, glon = n.broadcast_arrays(times, n.asarray(glat, dtype=n.float64), n.asarray(glon, dtype=n.float64))
+        shape = times.shape
+        keys = [self.key(t, la, lo) for t, la, lo in zip(times.ravel(), glat.ravel(), glon.ravel())]
+        out = {v: n.empty((len(keys), len(self.alt_km))) for v in self.variables}
+
+        missing = collections.OrderedDict()
+        for i, key in enumerate(keys):
+            prof = self._read(key)
+            if prof is None:
+                missing.setdefault(key, []).append(i)
+            else:
+                for v in self.variables:
+                    out[v][i] = prof[v]
+        if len(missing) > 0:
+            first = [idx[0] for idx in missing.values()]
+            requests = [(keys[i], times.ravel()[i], glat.ravel()[i], glon.ravel()[i]) for i in first]
+            for key, prof in self._compute(requests):
+                prof = {v: prof[v] for v in self.variables}
+                self._write(key, prof)
+                for i in missing[key]:
+                    for v in self.variables:
+                        out[v][i] = prof[v]
+            self.evict()
+
+        res = {"alt_km": self.alt_km}
+        for v in self.variables:
+            res[v] = out[v].reshape(shape + (len(self.alt_km),))
+        return(res)
+
+    def profile(self, t, glat, glon):
+        """ Profile of one time and location, as a dict with alt_km and the variables (n_h,)
+            like iri2016.profile.IRI(). """
+        res = self.profiles([t], glat, glon)
+        return({k: (v if k == "alt_km" else v[0]) for k, v in res.items()})
+
+if __name__ == "__main__":
+    import time
+    import shutil
+    import tempfile
+
+    tmp = tempfile.mkdtemp()
+    p = IriProfiles(cache_dir=tmp, source="auto")
+    print("Source: %s, %d workers"%(p.source, p.n_workers))
+
+    # a day of 5 minute profiles at three stations
+    times = n.datetime64("2016-07-07T00:00") + n.arange(288)*n.timedelta64(5, "m")
+    glat = n.array([69.58, 67.86, 78.15])
+    glon = n.array([19.23, 20.41, 16.04])
+    for label in ["First run (computed)", "Second run (memory)"]:
+        t0 = time.perf_counter()
+        res = p.profiles(times[:, None], glat[None, :], glon[None, :])
+        t1 = time.perf_counter()
+        print("%s: %s profiles %1.3f s"%(label, str(res["ne"].shape), t1-t0))
+
+    # a new session reads the cache from disk
+    p = IriProfiles(cache_dir=tmp, source="auto")
+    t0 = time.perf_counter()
+    res2 = p.profiles(times[:, None], glat[None, :], glon[None, :])
+    t1 = time.perf_counter()
+    print("New session (disk): %1.3f s, identical %s"%(t1-t0, n.array_equal(res["ne"], res2["ne"])))
+
+    # eviction of the least recently used profiles
+    files = p.cache_files()
+    p.max_bytes = sum(f[1] for f in files)//2
+    p.evict()
+    print("Cache files: %d, after eviction to half the size: %d"%(len(files), len(p.cache_files())))
+    shutil.rmtree(tmp)
@@ -6,7 +6,9 @@ import matplotlib.pyplot as plt
 # pip install iri2016
 # documentation:
 # http://www.physics.mcgill.ca/mist/memos/MIST_memo_46.pdf
-import iri2016.profile as iri
+# iri_cache runs iri2016.profile.IRI() and caches the profiles on disk.
+# Without iri2016, the profile of iri_data.csv is used.
+import iri_cache
 
 from datetime import datetime, timedelta
 from matplotlib.pyplot import figure, show
@@ -16,7 +18,7 @@ alt_km_range = (50,1000,1)
 glat=69
 glon=19
 
-sim = iri.IRI(time_date, [50,1000,1], glat, glon)
+sim = iri_cache.IriProfiles(alt_km_range=alt_km_range).profile(time_date, glat, glon)
 
 ne=sim["ne"]
 alt_km=sim["alt_km"]
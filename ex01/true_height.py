@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+#
+# True-height inversion of O-mode ionogram traces (lamination).
+#
+# The plasma frequency is modelled as piecewise linear in height between
+# the reflection heights h_k of the sounding frequencies f_0 < f_1 < ....
+# Within layer k, dh = (h_k - h_k-1)/(f_k - f_k-1) df_p, and the group path
+# of frequency f_j through the layer is integrated exactly:
+#
+#   int dh/sqrt(1 - f_p^2/f_j^2) = (h_k - h_k-1) G_jk
+#
+#   G_jk = f_j (asin(f_k/f_j) - asin(f_k-1/f_j))/(f_k - f_k-1),   1 <= k <= j
+#
+# which is finite also in the reflection layer k = j. Below h_0, where
+# there are no echoes, the electron density is exponential with a scale
+# height H. Its group path, above the free space path to h_0, is
+#
+#   H g_j,   g_j = 2 ln(2/(1 + sqrt(1 - f_0^2/f_j^2)))
+#
+# The virtual heights are then linear in the unknowns,
+#
+#   h'_j = h_0 + H g_j + sum_{1 <= k <= j} G_jk (h_k - h_k-1) = J [H, h_0, ..., h_n-1]
+#
+# and the Jacobian J is exact and depends only on the frequencies. The true
+# heights are the maximum a posteriori estimate with a smoothness prior on
+# the second derivative of h(f), and a prior on H:
+#
+#   x = (J^T J/sigma^2 + P)^-1 (J^T h'/sigma^2 + P x_0)
+#
+# The underlying ionization is poorly determined by the echoes, as a
+# change of H can be traded for a change of the lowest true heights. The
+# smoothness prior and the prior on H resolve this.
+#
+# As in spectriometer/absorption_inversion.py, the operator is computed once
+# for each pattern of missing frequencies (no echo, or above foF2), and all
+# ionograms with the same pattern are inverted with one matrix product.
+#
+# The lamination assumes that the plasma frequency increases with height,
+# so the E-F valley is not resolved. The estimate itself does not enforce
+# h_k > h_k-1, and with noisy traces some profiles are not monotonic.
+# profile() returns NaN for these, as there is no n_e(h) with these
+# true heights.
+#
+import concurrent.futures
+import numpy as n
+
+import ionogram
+
+def group_delay_operator(freqs):
+    """ G (n_f, n_f) with G[j, k] the group path of frequency j through layer k divided by the
+        thickness of the layer, for a plasma frequency linear in height between the frequencies
+        (increasing, Hz). Layer 0 is from zero plasma frequency to freqs[0]. Zero above the diagonal. """
+    f = n.asarray(freqs, dtype=n.float64)
+    f_lo = n.concatenate([[0.0], f[:-1]])
+    fj = f[:, None]
+    below = f[None, :] <= fj
+    with n.errstate(invalid="ignore"):
+        a_hi = n.arcsin(n.where(below, f[None, :]/fj, 0.0))
+        a_lo = n.arcsin(n.where(below, f_lo[None, :]/fj, 0.0))
+    return(n.where(below, fj*(a_hi - a_lo)/(f - f_lo)[None, :], 0.0))
+
+def underlying_delay(freqs):
+    """ Group path (km) per km of scale height of exponential ionization below the reflection height
+        of the lowest frequency, for each of the frequencies (increasing, Hz). """
+    f = n.asarray(freqs, dtype=n.float64)
+    return(2.0*n.log(2.0/(1.0 + n.sqrt(1.0 - (f[0]/f)**2.0))))
+
+def jacobian(freqs):
+    """ J (n_f, n_f+1) with h' = J [H, h_0, ..., h_n-1], the derivative of the virtual heights
+        with respect to the scale height of the underlying ionization and the true heights. """
+    G = group_delay_operator(freqs)
+    J = n.zeros((G.shape[0], G.shape[0] + 1))
+    J[:, 0] = underlying_delay(freqs)
+    J[:, 1:] = G
+    J[:, 1:-1] -= G[:, 1:]
+    # the free space path below h_0 replaces layer 0
+    J[:, 1] += 1.0 - G[:, 0]
+    return(J)
+
+def forward(h_true, scale_height, freqs):
+    """ Virtual heights (..., n_f) of the laminated profiles with true heights h_true (..., n_f)
+        and scale heights of the underlying ionization scale_height (...). For ionograms with
+        missing frequencies, use only the frequencies and true heights with echoes. """
+    x = n.concatenate([n.asarray(scale_height, dtype=n.float64)[..., None], h_true], axis=-1)
+    return(n.einsum("jk,...k->...j", jacobian(freqs), x))
+
+def second_derivative(freqs):
+    """ (n_f-2, n_f) second derivative of h with respect to frequency (MHz) at the frequencies (Hz). """
+    f = n.asarray(freqs, dtype=n.float64)/1e6
+    n_f = len(f)
+    L = n.zeros((max(n_f - 2, 0), n_f))
+    i = n.arange(n_f - 2)
+    d0 = f[i+1] - f[i]
+    d1 = f[i+2] - f[i+1]
+    L[i, i] = 2.0/(d0*(d0 + d1))
+    L[i, i+1] = -2.0/(d0*d1)
+    L[i, i+2] = 2.0/(d1*(d0 + d1))
+    return(L)
+
+def monotonic(h_true):
+    """ True (...) for true-height profiles h_true (..., n_f) that increase with frequency,
+        leaving out NaN true heights. """
+    h_true = n.asarray(h_true, dtype=n.float64)
+    # running maximum over the frequencies with echoes, which each true height must exceed
+    prev = n.fmax.accumulate(n.concatenate([n.full(h_true.shape[:-1] + (1,), -n.inf), h_true[..., :-1]], axis=-1), axis=-1)
+    return(n.all(~n.isfinite(h_true) | (h_true > prev), axis=-1))
+
+def profile(h_true, scale_height, freqs, alt_km):
+    """ Electron density (..., n_h) on the altitude grid alt_km of true-height profiles
+        h_true (..., n_f), linear in plasma frequency between the true heights and exponential
+        with scale_height (...) below them, as in the inversion. NaN above the highest true height
+        of each profile, and NaN true heights are left out. Profiles whose true heights don't
+        increase with frequency (see monotonic()) are all NaN. """
+    h_true = n.asarray(h_true, dtype=n.float64)
+    batch_shape = h_true.shape[:-1]
+    h_true = h_true.reshape(-1, h_true.shape[-1])
+    scale_height = n.broadcast_to(scale_height, batch_shape).reshape(-1)
+    ne = n.full((h_true.shape[0], len(alt_km)), n.nan)
+    increasing = monotonic(h_true)
+    for i, h in enumerate(h_true):
+        ok = n.flatnonzero(n.isfinite(h))
+        if len(ok) < 2 or not increasing[i]:
+            continue
+        ne[i] = ionogram.electron_density(n.interp(alt_km, h[ok], freqs[ok], left=n.nan, right=n.nan))
+        under = alt_km < h[ok[0]]
+        ne[i, under] = ionogram.electron_density(freqs[ok[0]])*n.exp((alt_km[under] - h[ok[0]])/scale_height[i])
+    return(ne.reshape(batch_shape + (len(alt_km),)))
+
+class TrueHeightInversion:
+    """ Regularized lamination inversion of virtual height traces on the sounding frequencies freqs (Hz).
+        @sigma standard deviation of the virtual heights (km)
+        @sigma_d2 prior standard deviation of the second derivative of the true height with
+          respect to frequency (km/MHz^2)
+        @scale_height prior mean of the scale height of the ionization below the lowest echo (km)
+        @sigma_scale_height prior standard deviation of the scale height (km)
+    """
+    def __init__(self, freqs, sigma=2.0, sigma_d2=100.0, scale_height=10.0, sigma_scale_height=5.0):
+        self.freqs = n.asarray(freqs, dtype=n.float64)
+        self.n_f = len(self.freqs)
+        self.sigma = sigma
+        self.sigma_d2 = sigma_d2
+        self.scale_height = scale_height
+        self.sigma_scale_height = sigma_scale_height
+        self.operators = {}
+
+    def operator(self, good):
+        """ Operator M (n_f+1, n_f), offset b (n_f+1,) and posterior covariance of
+            [H, h_0, ..., h_n-1] using only the frequencies where good (n_f,) is True, so that
+            x = M h' + b. The rows and columns of the other frequencies are zero. """
+        key = n.packbits(good).tobytes()
+        if key in self.operators:
+            return(self.operators[key])
+        idx = n.flatnonzero(good)
+        cols = n.concatenate([[0], idx + 1])
+        J = jacobian(self.freqs[idx])
+        L = second_derivative(self.freqs[idx])
+        P = n.zeros((len(cols), len(cols)))
+        P[1:, 1:] = L.T @ L/self.sigma_d2**2
+        P[0, 0] = 1.0/self.sigma_scale_height**2
+        x0 = n.zeros(len(cols))
+        x0[0] = self.scale_height
+        cov = n.linalg.inv(J.T @ J/self.sigma**2 + P)
+        M = n.zeros((self.n_f + 1, self.n_f))
+        M[n.ix_(cols, idx)] = cov @ J.T/self.sigma**2
+        b = n.zeros(self.n_f + 1)
+        b[cols] = cov @ (P @ x0)
+        C = n.zeros((self.n_f + 1, self.n_f + 1))
+        C[n.ix_(cols, cols)] = cov
+        self.operators[key] = (M, b, C)
+        return(M, b, C)
+
+    def solve(self, hv):
+        """ True heights from virtual heights hv (n_t, n_f) in km, NaN where there is no echo.
+            Returns a dict with the true heights h_true (n_t, n_f), NaN where there is no echo,
+            their posterior standard deviation h_std (n_t, n_f), and the scale height of the
+            underlying ionization scale_height (n_t,).
+            Ionograms with less than two echoes are NaN. """
+        hv = n.asarray(hv, dtype=n.float64).reshape(-1, self.n_f)
+        good = n.isfinite(hv)
+        n_t = hv.shape[0]
+        x = n.full((n_t, self.n_f + 1), n.nan)
+        x_std = n.full((n_t, self.n_f + 1), n.nan)
+        enough = n.flatnonzero(n.sum(good, axis=1) >= 2)
+        if len(enough) > 0:
+            # group the ionograms by the pattern of missing frequencies, packed into bytes for unique()
+            packed = n.packbits(good[enough], axis=1)
+            _, first, inverse = n.unique(packed, axis=0, return_index=True, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            hv_g = n.where(good[enough], hv[enough], 0.0)
+            order = n.argsort(inverse, kind="stable")
+            bounds = n.searchsorted(inverse[order], n.arange(len(first) + 1))
+            for pi, row in enumerate(first):
+                idx = order[bounds[pi]:bounds[pi+1]]
+                g = good[enough[row]]
+                M, b, C = self.operator(g)
+                x[enough[idx]] = hv_g[idx] @ M.T + b[None, :]
+                x_std[enough[idx]] = n.sqrt(n.diag(C))[None, :]
+            x[:, 1:][~good] = n.nan
+            x_std[:, 1:][~good] = n.nan
+        return({"h_true": x[:, 1:], "h_std": x_std[:, 1:], "scale_height": x[:, 0]})
+
+def _solve_block(task):
+    # worker: inversion of a block of ionograms
+    freqs, hv, kwargs = task
+    return(TrueHeightInversion(freqs, **kwargs).solve(hv))
+
+def invert(freqs, hv, n_workers=1, block_size=256, **kwargs):
+    """ True-height inversion of virtual heights hv (..., n_f) on the frequencies freqs (Hz), in blocks of
+        block_size ionograms on n_workers processes. Other keyword arguments are passed to
+        TrueHeightInversion. Returns the dict of TrueHeightInversion.solve() with the batch shape of hv. """
+    hv = n.asarray(hv, dtype=n.float64)
+    batch_shape = hv.shape[:-1]
+    hv = hv.reshape(-1, len(freqs))
+    tasks = [(freqs, hv[i0:(i0+block_size)], kwargs) for i0 in range(0, hv.shape[0], block_size)]
+    if n_workers <= 1 or len(tasks) == 1:
+        inv = TrueHeightInversion(freqs, **kwargs)
+        results = [inv.solve(t[1]) for t in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(_solve_block, tasks))
+    res = {}
+    for k in results[0].keys():
+        v = n.concatenate([r[k] for r in results])
+        res[k] = v.reshape(batch_shape + v.shape[1:])
+    return(res)
+
+if __name__ == "__main__":
+    import time
+    import os
+    import virtual_height as vhm
+
+    # a night of 1 minute ionograms of a Chapman F layer with changing peak height and density
+    n_t = 720
+    tt = n.arange(n_t)/n_t
+    hmF2 = 300.0 - 40.0*n.sin(2*n.pi*tt)
+    NmF2 = 2e11*(1 + 0.5*n.cos(2*n.pi*tt))
+    alt_km = n.arange(80.0, 600.0, 0.5)
+    ne = vhm.chapman(alt_km[None, :], NmF2[:, None], hmF2[:, None], 50.0)
+    freqs = n.arange(1.0e6, 8.0e6, 0.05e6)
+    t0 = time.perf_counter()
+    syn = vhm.virtual_height(alt_km, ne, freqs)
+    t1 = time.perf_counter()
+    print("Forward model of %d ionograms, %d frequencies: %1.2f s"%(n_t, len(freqs), t1-t0))
+
+    # measurement noise, and no echoes from within 1% of foF2
+    rng = n.random.default_rng(0)
+    sigma = 2.0
+    hv = syn["virtual_height"] + rng.normal(0, sigma, syn["virtual_height"].shape)
+    hv[freqs[None, :] > 0.99*syn["foF2"][:, None]] = n.nan
+    hv[rng.random(hv.shape) < 0.02] = n.nan
+
+    for n_workers in sorted(set([1, os.cpu_count()])):
+        t0 = time.perf_counter()
+        res = invert(freqs, hv, n_workers=n_workers, sigma=sigma)
+        t1 = time.perf_counter()
+        print("Inversion of %d ionograms, %d workers: %1.2f s"%(n_t, n_workers, t1-t0))
+
+    err = res["h_true"] - syn["reflection_height"]
+    print("True height error: RMS %1.2f km, median posterior std %1.2f km"%(n.sqrt(n.nanmean(err**2)), n.nanmedian(res["h_std"])))
+    print("Errors within two posterior standard deviations: %1.0f%%"%(100*n.nanmean(n.abs(err[n.isfinite(err)]) < 2*res["h_std"][n.isfinite(err)])))
+    print("Profiles that don't increase with frequency: %d of %d"%(n.sum(~monotonic(res["h_true"])), n_t))
+    ne_est = profile(res["h_true"], res["scale_height"], freqs, alt_km)
+    below = alt_km[None, :] < hmF2[:, None] - 20.0
+    rel = n.abs(ne_est - ne)/ne
+    print("Median n_e error below hmF2 - 20 km: %1.1f%%"%(100*n.nanmedian(rel[below & (ne > 1e10)])))
+    resid = []
+    for i in range(0, n_t, 10):
+        ok = n.isfinite(res["h_true"][i])
+        resid.append(hv[i, ok] - forward(res["h_true"][i, ok], res["scale_height"][i], freqs[ok]))
+    print("Residual RMS %1.2f km (noise %1.2f km)"%(n.sqrt(n.mean(n.concatenate(resid)**2)), sigma))
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+#
+# Virtual heights with the reflection singularity integrated analytically.
+#
+# The virtual height of an O-mode wave is
+#
+#   h' = h_0 + int_{h_0}^{h_r} dh/sqrt(1 - X(h)),   X = f_p^2/f^2
+#
+# The integrand diverges at the reflection height h_r, where X = 1, so a
+# sum on a fixed grid (ionogram.py, ionosol.py) converges slowly with the
+# grid spacing. Here the electron density is modelled between the samples
+# of the profile, and each layer is integrated exactly:
+#
+# Linear n_e between h_i and h_i+1 (X linear, s = 1 - X):
+#
+#   int dh/sqrt(s) = 2 dh/(sqrt(s_i) + sqrt(s_i+1))
+#
+# and in the layer where the wave reflects (s_i+1 <= 0), up to the
+# reflection height h_i + dh s_i/(s_i - s_i+1),
+#
+#   int dh/sqrt(s) = 2 dh/sqrt(s_i) s_i/(s_i - s_i+1)
+#
+# Exponential n_e between the samples, X = X_i exp((h - h_i)/H) with
+# H = dh/ln(X_i+1/X_i):
+#
+#   int dh/sqrt(1 - X) = 2 H ln((1 + sqrt(s_i))/(1 + sqrt(s_i+1))) + dh
+#
+# and in the reflection layer, up to h_i - H ln(X_i),
+#
+#   int dh/sqrt(1 - X) = 2 H ln(1 + sqrt(s_i)) - H ln(X_i)
+#
+# These forms avoid differences of nearly equal numbers. Layers where the
+# exponential model is not defined (zero density) or not needed (nearly
+# constant density) use the linear model.
+#
+import numpy as n
+
+import ionogram
+
+def _layer_integrals(X0, X1, dh, reflects, method):
+    # integral of dh/sqrt(1 - X) over layers with X0 < 1 at the bottom. In reflecting layers (X1 >= 1)
+    # the integral ends at the reflection height. Returns (integral, height of reflection above the layer bottom).
+    s0 = 1.0 - X0
+    s1 = n.where(reflects, 0.0, 1.0 - X1)
+    q0 = n.sqrt(s0)
+    q1 = n.sqrt(s1)
+    # linear n_e
+    with n.errstate(invalid="ignore", divide="ignore"):
+        frac = n.where(reflects, s0/(s0 - (1.0 - X1)), 1.0)
+    integral = n.where(reflects, 2.0*dh*frac/q0, 2.0*dh/(q0 + q1))
+    h_r = frac*dh
+    if method == "exponential":
+        with n.errstate(invalid="ignore", divide="ignore"):
+            log_ratio = n.log(X1/X0)
+            expo = (X0 > 0) & (X1 > 0) & (n.abs(log_ratio) > 1e-9)
+            H = dh/log_ratio
+            exp_full = 2.0*H*n.log((1.0 + q0)/(1.0 + q1)) + dh
+            exp_refl = 2.0*H*n.log(1.0 + q0) - H*n.log(X0)
+            integral = n.where(expo, n.where(reflects, exp_refl, exp_full), integral)
+            h_r = n.where(expo & reflects, -H*n.log(X0), h_r)
+    return(integral, h_r)
+
+def virtual_height(alt_km, ne, freqs, method="linear", max_elements=2**24):
+    """ O-mode virtual heights of one profile ne (n_h,) or a batch of profiles (..., n_h) on the altitude grid alt_km.
+        @freqs frequencies (Hz)
+        @method "linear" or "exponential" electron density between the samples of the profile
+        @max_elements profiles are processed in chunks of at most this many (profile, frequency, height) values
+        Returns a dict with the virtual height and the reflection height (..., n_freq) in km, both NaN for
+        frequencies that don't reflect, and foF2 (...) in Hz.
+    """
+    alt_km = n.asarray(alt_km, dtype=n.float64)
+    freqs = n.asarray(freqs, dtype=n.float64)
+    fp = ionogram.plasma_frequency(ne)
+    batch_shape = fp.shape[:-1]
+    n_h = len(alt_km)
+    n_f = len(freqs)
+    fp = fp.reshape(-1, n_h)
+    n_b = fp.shape[0]
+    ridx = ionogram.reflection_index(fp, freqs)
+    reflects = ridx < n_h
+    dh = n.diff(alt_km)
+    inv_f2 = 1.0/freqs**2.0
+
+    virtual = n.full((n_b, n_f), n.nan)
+    reflection = n.full((n_b, n_f), n.nan)
+    # reflection at or below the first height
+    ground = ridx == 0
+    virtual[ground] = alt_km[0]
+    reflection[ground] = alt_km[0]
+    if n.any(reflects & ~ground):
+        n_fr = n.max(n.sum(reflects, axis=1))
+        h_r = n.max(ridx[reflects])
+        chunk = max(1, max_elements//(n_fr*h_r))
+        for b0 in range(0, n_b, chunk):
+            r = ridx[b0:b0+chunk]
+            f_sel = n.flatnonzero(n.any((r < n_h) & (r > 0), axis=0))
+            if len(f_sel) == 0:
+                continue
+            r = r[:, f_sel]
+            # layers i = 0 .. h_max-1 between heights i and i+1. layer r-1 is the reflection layer.
+            h_max = n.max(n.where(r < n_h, r, 0))
+            X = fp[b0:b0+chunk, None, :h_max+1]**2.0*inv_f2[None, f_sel, None]
+            layer = n.arange(h_max)[None, None, :]
+            below = layer < (r - 1)[:, :, None]
+            in_refl = layer == (r - 1)[:, :, None]
+            use = below | in_refl
+            # the values of unused layers are replaced by a harmless X = 0.5, and masked out of the sum
+            X0 = n.where(use, X[:, :, :-1], 0.5)
+            X1 = n.where(use, X[:, :, 1:], 0.5)
+            integral, h_refl = _layer_integrals(X0, X1, dh[None, None, :h_max], in_refl, method)
+            vh = alt_km[0] + n.sum(n.where(use, integral, 0.0), axis=2)
+            rh = alt_km[n.maximum(r - 1, 0)] + n.sum(n.where(in_refl, h_refl, 0.0), axis=2)
+            ok = (r < n_h) & (r > 0)
+            virtual[b0:b0+chunk, f_sel] = n.where(ok, vh, virtual[b0:b0+chunk, f_sel])
+            reflection[b0:b0+chunk, f_sel] = n.where(ok, rh, reflection[b0:b0+chunk, f_sel])
+
+    return({"virtual_height": virtual.reshape(batch_shape + (n_f,)),
+            "reflection_height": reflection.reshape(batch_shape + (n_f,)),
+            "foF2": n.max(fp, axis=1).reshape(batch_shape)})
+
+def chapman(alt_km, n_max, h_max, H):
+    """ Chapman layer electron density with peak n_max (1/m^3) at h_max (km) and scale height H (km). """
+    z = (alt_km - h_max)/H
+    return(n_max*n.exp(0.5*(1.0 - z - n.exp(-z))))
+
+if __name__ == "__main__":
+    import time
+
+    # convergence with the grid spacing for a smooth E + F layer profile
+    def profile(alt_km):
+        return(chapman(alt_km, 1.2e11, 110.0, 8.0) + chapman(alt_km, 5e11, 280.0, 45.0))
+    freqs = n.linspace(0.5e6, 6.2e6, 200)
+    fine = n.arange(50.0, 600.0, 0.005)
+    ref = virtual_height(fine, profile(fine), freqs, method="exponential", max_elements=2**26)["virtual_height"]
+    # close to the critical frequencies of the layers, the virtual height depends on how well
+    # the grid samples the peak of the layer, so these are left out of the maximum error
+    f_crit = ionogram.plasma_frequency(profile(n.array([110.0, 280.0])))
+    away = n.min(n.abs(freqs[:, None] - f_crit[None, :])/f_crit[None, :], axis=1) > 0.05
+    print("Virtual height error (km), median and maximum more than 5% from foE and foF2.")
+    print("Reference: exponential layers on a 5 m grid")
+    print("%8s %16s %16s %16s"%("dh (km)", "sum", "linear", "exponential"))
+    for step in [10.0, 5.0, 2.0, 1.0, 0.1, 0.01]:
+        alt = n.arange(50.0, 600.0, step)
+        ne = profile(alt)
+        hv = [ionogram.synthesize(alt, ne, freqs)["virtual_height"]]
+        for method in ["linear", "exponential"]:
+            hv.append(virtual_height(alt, ne, freqs, method=method)["virtual_height"])
+        err = ["%7.2g %8.2g"%(n.nanmedian(n.abs(h - ref)), n.nanmax(n.abs(h - ref)[away])) for h in hv]
+        print("%8.2f %s"%(step, " ".join(err)))
+
+    # a day of 5 minute IRI-like profiles on the 1 km grid of iri_data.csv
+    alt_km, ne = ionogram.read_iri_csv("iri_data.csv")
+    freqs = n.linspace(0.5e6, 16e6, num=1000)
+    n_t = 288
+    hour = n.arange(n_t)/12.0
+    scale = 0.5 + 0.5*(1 + n.cos(2*n.pi*(hour - 12)/24))
+    ne_batch = scale[:, None]*ne[None, :]
+    for method in ["linear", "exponential"]:
+        t0 = time.perf_counter()
+        res = virtual_height(alt_km, ne_batch, freqs, method=method)
+        t1 = time.perf_counter()
+        print("%d profiles, %d frequencies, %s: %1.2f s"%(n_t, len(freqs), method, t1-t0))
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+#
+# Benchmark of the TEC hole filling on a synthetic 180x360x288 cube
+# (one day of 5 minute frames on a 1x1 degree grid) with 20% of the cells
+# measured. The synthetic TEC is a smooth day-side bulge that moves with
+# the Sun, and the measurements have dtec dependent noise.
+#
+import time
+import resource
+import numpy as n
+
+import tec_interp
+
+n_lat = 180
+n_lon = 360
+n_frames = 288
+fill_fraction = 0.2
+
+lat = n.arange(n_lat) - 89.5
+lon = n.arange(n_lon) - 179.5
+t_h = n.arange(n_frames)*5.0/60.0
+
+# smooth "true" TEC field
+subsolar_lon = 180.0 - 15.0*t_h
+lon_g, lat_g, sun_g = n.meshgrid(lon, lat, subsolar_lon)
+tec_true = 5.0 + 30.0*n.exp(-0.5*(lat_g/30.0)**2)*(0.5 + 0.5*n.cos(n.radians(lon_g - sun_g)))
+
+rng = n.random.default_rng(0)
+dtec = rng.uniform(0.5, 3.0, size=tec_true.shape)
+tec = tec_true + dtec*rng.standard_normal(tec_true.shape)
+missing = rng.random(tec_true.shape) > fill_fraction
+tec[missing] = n.nan
+dtec[missing] = n.nan
+
+t0 = time.perf_counter()
+interp = tec_interp.TecInterpolator(lat, lon, sigma_km=300.0, sigma_t=1.0)
+t1 = time.perf_counter()
+tec_hat, tec_std = interp.fill(tec, dtec)
+t2 = time.perf_counter()
+
+print("Neighbour structure: %1.2f s, %d non-zero kernel weights"%(t1-t0, interp.S.nnz))
+print("Filling %d frames: %1.2f s (%1.1f ms per frame)"%(n_frames, t2-t1, 1e3*(t2-t1)/n_frames))
+err = tec_hat - tec_true
+print("Filled fraction %1.3f"%(n.mean(n.isfinite(tec_hat))))
+print("RMS error %1.2f TECu, median estimated std %1.2f TECu"%(n.sqrt(n.nanmean(err**2)), n.nanmedian(tec_std)))
+print("RMS error of the measurements %1.2f TECu"%(n.sqrt(n.nanmean((tec - tec_true)**2))))
+# ru_maxrss is in kilobytes on Linux
+print("Peak memory use %1.2f GB"%(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e6))
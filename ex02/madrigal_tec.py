@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+# Lazy reader for Madrigal GPS TEC files (e.g., gps150317g.004.hdf5).
+#
+# The 2D parameters (tec, dtec) are stored as (n_lat, n_lon, n_times)
+# arrays. Only the hyperslabs that are needed are read from the file.
+# Reading one time slice from a time-last array touches every row of the
+# array on disk, so for repeated per-frame access the file can be
+# rechunked once into a time-major cache file, where each frame is
+# a contiguous (n_lat, n_lon) block. The cache stores the path, size and
+# modification time of the file it was made from, and is made again when
+# these don't match. It is written to a temporary file that is renamed when
+# complete, so an interrupted rechunk doesn't leave a partial cache.
+#
+import os
+import numpy as n
+import h5py
+
+class MadrigalTecFile:
+    """ Madrigal GPS TEC file. The lat, lon and timestamps axes are read when opened.
+        @cache_fname optional time-major cache file. It is created with rechunk() if it
+          doesn't exist or was made from another file, and used for all reads afterwards.
+        @block_size number of frames read at a time when iterating or rechunking,
+          which sets the peak memory use.
+    """
+    def __init__(self, fname, cache_fname=None, block_size=16):
+        self.fname = fname
+        self.block_size = block_size
+        self.h = h5py.File(fname, "r")
+        self.lat = self.h["Data/Array Layout/gdlat"][()]
+        self.lon = self.h["Data/Array Layout/glon"][()]
+        self.timestamps = self.h["Data/Array Layout/timestamps"][()]
+        self.cache = None
+        if cache_fname is not None:
+            if not self.is_cache_current(cache_fname):
+                self.rechunk(cache_fname)
+            self.cache = h5py.File(cache_fname, "r")
+
+    def close(self):
+        self.h.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def dataset(self, parameter="tec"):
+        """ The (n_lat, n_lon, n_times) h5py dataset of a 2D parameter, e.g., "tec" or "dtec". """
+        return(self.h["Data/Array Layout/2D Parameters/%s"%(parameter)])
+
+    def source_identity(self):
+        """ Path, size and modification time of the file, stored in the cache. """
+        st = os.stat(self.fname)
+        return({"source": os.path.abspath(self.fname), "source_size": st.st_size, "source_mtime": st.st_mtime})
+
+    def is_cache_current(self, cache_fname, parameters=("tec", "dtec")):
+        """ True if cache_fname is a complete cache of this file. """
+        if not os.path.exists(cache_fname):
+            return(False)
+        try:
+            with h5py.File(cache_fname, "r") as c:
+                for k, v in self.source_identity().items():
+                    a = c.attrs.get(k)
+                    if a is None or (a.decode() if isinstance(a, bytes) else a) != v:
+                        return(False)
+                shape = (len(self.timestamps), len(self.lat), len(self.lon))
+                if not all(p in c and c[p].shape == shape for p in parameters):
+                    return(False)
+                return(n.array_equal(c["timestamps"][()], self.timestamps))
+        except (OSError, KeyError):
+            return(False)
+
+    def rechunk(self, cache_fname, parameters=("tec", "dtec")):
+        """ Write the 2D parameters into a (n_times, n_lat, n_lon) cache file with one chunk per frame.
+            The file is written under a temporary name and renamed when it is complete. """
+        n_t = len(self.timestamps)
+        tmp = "%s.%d.tmp"%(cache_fname, os.getpid())
+        with h5py.File(tmp, "w") as c:
+            for k, v in self.source_identity().items():
+                c.attrs[k] = v
+            c["lat"] = self.lat
+            c["lon"] = self.lon
+            c["timestamps"] = self.timestamps
+            for p in parameters:
+                d = self.dataset(p)
+                out = c.create_dataset(p, shape=(n_t, len(self.lat), len(self.lon)), dtype=d.dtype,
+                                       chunks=(1, len(self.lat), len(self.lon)))
+                for i0 in range(0, n_t, self.block_size):
+                    i1 = min(i0 + self.block_size, n_t)
+                    out[i0:i1] = n.moveaxis(d[:, :, i0:i1], 2, 0)
+        os.replace(tmp, cache_fname)
+
+    def time_slice(self, t0=None, t1=None):
+        """ Slice of time indices with t0 <= timestamps < t1 (unix seconds). """
+        i0 = 0 if t0 is None else n.searchsorted(self.timestamps, t0, side="left")
+        i1 = len(self.timestamps) if t1 is None else n.searchsorted(self.timestamps, t1, side="left")
+        return(slice(i0, i1))
+
+    def box_slices(self, lat_range=None, lon_range=None):
+        """ Slices of lat and lon indices inside the (min, max) ranges (deg), inclusive. """
+        lat_sl = slice(0, len(self.lat))
+        lon_sl = slice(0, len(self.lon))
+        if lat_range is not None:
+            lat_sl = slice(n.searchsorted(self.lat, lat_range[0], side="left"),
+                           n.searchsorted(self.lat, lat_range[1], side="right"))
+        if lon_range is not None:
+            lon_sl = slice(n.searchsorted(self.lon, lon_range[0], side="left"),
+                           n.searchsorted(self.lon, lon_range[1], side="right"))
+        return(lat_sl, lon_sl)
+
+    def _read(self, parameter, lat_sl, lon_sl, t_sl):
+        # (n_times, n_lat, n_lon) block
+        if self.cache is not None:
+            return(self.cache[parameter][t_sl, lat_sl, lon_sl])
+        return(n.moveaxis(self.dataset(parameter)[lat_sl, lon_sl, t_sl], 2, 0))
+
+    def read(self, t0=None, t1=None, lat_range=None, lon_range=None, parameter="tec"):
+        """ Read a time range and lat-lon box.
+            Returns (timestamps, lat, lon, data), where data is (n_lat, n_lon, n_times) as in the file. """
+        t_sl = self.time_slice(t0, t1)
+        lat_sl, lon_sl = self.box_slices(lat_range, lon_range)
+        data = n.moveaxis(self._read(parameter, lat_sl, lon_sl, t_sl), 0, 2)
+        return(self.timestamps[t_sl], self.lat[lat_sl], self.lon[lon_sl], data)
+
+    def iter_frames(self, t0=None, t1=None, lat_range=None, lon_range=None, parameter="tec"):
+        """ Iterate over frames (i, t_unix, frame), where frame is (n_lat, n_lon) and i is the
+            time index in the file. At most block_size frames are in memory at once. """
+        t_sl = self.time_slice(t0, t1)
+        lat_sl, lon_sl = self.box_slices(lat_range, lon_range)
+        for i0 in range(t_sl.start, t_sl.stop, self.block_size):
+            i1 = min(i0 + self.block_size, t_sl.stop)
+            block = self._read(parameter, lat_sl, lon_sl, slice(i0, i1))
+            for i in range(i0, i1):
+                yield((i, self.timestamps[i], block[i-i0]))
+
+    def valid_frames(self, t0=None, t1=None, lat_range=None, lon_range=None, parameter="tec"):
+        """ Iterate over frames (i, t_unix, lat, lon, values) of the points that are not NaN,
+            as used by tec_render.render_sequence. """
+        lat_sl, lon_sl = self.box_slices(lat_range, lon_range)
+        lon_grid, lat_grid = n.meshgrid(self.lon[lon_sl], self.lat[lat_sl])
+        lat_points = lat_grid.flatten()
+        lon_points = lon_grid.flatten()
+        for i, t, frame in self.iter_frames(t0, t1, lat_range, lon_range, parameter):
+            points = frame.flatten()
+            good_idx = n.where(n.isnan(points) != True)[0]
+            yield((i, t, lat_points[good_idx], lon_points[good_idx], points[good_idx]))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+#
+# Gap-filled TEC maps from the binned Madrigal TEC data.
+#
+# Each cell of the output is a weighted mean of the measured cells that are
+# nearby in space and time:
+#
+#   tec_hat(x,t) = sum_j w_j tec_j / sum_j w_j
+#   w_j = k_s(|x - x_j|) k_t(t - t_j) / dtec_j^2
+#
+# with Gaussian kernels k_s (great circle distance) and k_t (frames). The
+# kernel is separable, and the grid is fixed, so the spatial kernel is a
+# sparse (n_cells, n_cells) matrix S found once with a KD-tree. All frames are
+# then smoothed with a sparse matrix product S @ X, where X is the
+# (n_cells, n_frames) matrix of weighted measurements, followed by a short
+# convolution along time. Cells with no measurements within the kernel
+# support are NaN. The frames are smoothed in blocks, each with the
+# frames within the temporal kernel on either side, so that the work
+# arrays are the size of a block rather than of the whole cube.
+#
+# The standard deviation of the weighted mean, assuming independent errors
+# dtec, is
+#
+#   sqrt(sum_j w_j^2 dtec_j^2) / sum_j w_j
+#
+import numpy as n
+import scipy.sparse as sp
+import scipy.spatial as ss
+import scipy.ndimage as ndi
+
+# mean Earth radius (km)
+R_e = 6371.0
+
+def cell_positions(lat, lon):
+    """ Unit vectors (n_cells,3) of the cell centers of a lat, lon grid, flattened in (lat,lon) order. """
+    lon_grid, lat_grid = n.meshgrid(n.radians(lon), n.radians(lat))
+    return(n.column_stack([(n.cos(lat_grid)*n.cos(lon_grid)).flatten(),
+                           (n.cos(lat_grid)*n.sin(lon_grid)).flatten(),
+                           n.sin(lat_grid).flatten()]))
+
+class TecInterpolator:
+    """ Spatio-temporal smoothing and hole filling on a fixed lat, lon grid.
+        @sigma_km standard deviation of the spatial kernel (km)
+        @sigma_t standard deviation of the temporal kernel (frames). 0 smooths each frame separately.
+        @n_sigma kernels are truncated at n_sigma standard deviations
+        @block_cells number of cells in each block of the neighbour search, which sets its memory use
+    """
+    def __init__(self, lat, lon, sigma_km=300.0, sigma_t=1.0, n_sigma=3.0, block_cells=8192):
+        self.lat = lat
+        self.lon = lon
+        self.n_cells = len(lat)*len(lon)
+        pos = cell_positions(lat, lon)
+        # neighbour search is done once, as the grid is fixed, for blocks of block_cells rows at a time.
+        # chord length on the unit sphere, which is close to the great circle distance at these scales
+        tree = ss.cKDTree(pos)
+        data = []
+        indices = []
+        indptr = [n.zeros(1, dtype=n.int64)]
+        for r0 in range(0, self.n_cells, block_cells):
+            r1 = min(r0 + block_cells, self.n_cells)
+            D = ss.cKDTree(pos[r0:r1]).sparse_distance_matrix(tree, n_sigma*sigma_km/R_e, output_type="ndarray")
+            # the diagonal is added separately, as zero distances may or may not be stored
+            off = D["i"] + r0 != D["j"]
+            rows = n.concatenate([D["i"][off], n.arange(r1 - r0)])
+            cols = n.concatenate([D["j"][off], n.arange(r0, r1)])
+            dist_km = n.concatenate([D["v"][off], n.zeros(r1 - r0)])*R_e
+            S = sp.csr_matrix((n.exp(-0.5*(dist_km/sigma_km)**2), (rows, cols)), shape=(r1 - r0, self.n_cells))
+            data.append(S.data)
+            indices.append(S.indices)
+            indptr.append(S.indptr[1:] + indptr[-1][-1])
+            del D, S
+        # one array at a time, so that the blocks of the other arrays are freed before the next is made
+        data = n.concatenate(data)
+        indices = n.concatenate(indices)
+        self.S = sp.csr_matrix((data, indices, n.concatenate(indptr)), shape=(self.n_cells, self.n_cells))
+        # same structure as S, sharing the index arrays
+        self.S2 = sp.csr_matrix((self.S.data**2, self.S.indices, self.S.indptr), shape=self.S.shape)
+
+        if sigma_t > 0:
+            n_t = int(n.ceil(n_sigma*sigma_t))
+            self.k_t = n.exp(-0.5*(n.arange(-n_t, n_t+1)/sigma_t)**2)
+        else:
+            self.k_t = n.ones(1)
+
+    def _smooth(self, M, S, k_t):
+        # spatial kernel for all frames at once, then the temporal kernel
+        res = S @ M
+        if sp.issparse(res):
+            res = res.toarray()
+        return(ndi.convolve1d(n.asarray(res), k_t, axis=1, mode="constant"))
+
+    def _blocks(self, n_frames, block_size):
+        # (i0, i1, j0, j1): output frames i0:i1, and the frames j0:j1 within the temporal kernel of them
+        h = len(self.k_t)//2
+        for i0 in range(0, n_frames, block_size):
+            i1 = min(i0 + block_size, n_frames)
+            yield((i0, i1, max(0, i0 - h), min(n_frames, i1 + h)))
+
+    def _fill(self, X_w, X_wv, sl):
+        # estimate and standard deviation (n_cells, n_frames) of the frames sl of the block X_w, X_wv
+        den = self._smooth(X_w, self.S, self.k_t)[:, sl]
+        num = self._smooth(X_wv, self.S, self.k_t)[:, sl]
+        # sum w_j^2 dtec_j^2 = sum k_j^2 / dtec_j^2
+        var = self._smooth(X_w, self.S2, self.k_t**2)[:, sl]
+        with n.errstate(invalid="ignore", divide="ignore"):
+            return(num/den, n.sqrt(var)/den)
+
+    def fill(self, tec, dtec, keep_observed=False, block_size=32):
+        """ Smoothed and gap-filled maps from (n_lat, n_lon, n_frames) tec and dtec arrays
+            as in the Madrigal files. Missing cells are NaN.
+            @keep_observed keep the measured values in the cells that have them, and only fill the gaps.
+            @block_size number of frames smoothed at a time, which sets the size of the work arrays.
+            Returns (tec, tec_std), both (n_lat, n_lon, n_frames).
+        """
+        n_frames = tec.shape[2]
+        tec = tec.reshape(self.n_cells, n_frames)
+        dtec = dtec.reshape(self.n_cells, n_frames)
+        tec_hat = n.empty((self.n_cells, n_frames))
+        tec_std = n.empty((self.n_cells, n_frames))
+        for i0, i1, j0, j1 in self._blocks(n_frames, block_size):
+            t = tec[:, j0:j1]
+            d = dtec[:, j0:j1]
+            observed = n.isfinite(t) & n.isfinite(d) & (d > 0)
+            w = n.zeros(t.shape)
+            w[observed] = 1.0/d[observed]**2
+            wv = n.zeros(t.shape)
+            wv[observed] = w[observed]*t[observed]
+            sl = slice(i0 - j0, i1 - j0)
+            est, err = self._fill(w, wv, sl)
+            if keep_observed:
+                observed = observed[:, sl]
+                est[observed] = t[:, sl][observed]
+                err[observed] = d[:, sl][observed]
+            tec_hat[:, i0:i1] = est
+            tec_std[:, i0:i1] = err
+        # (n_cells, n_frames) -> (n_lat, n_lon, n_frames)
+        shape = (len(self.lat), len(self.lon), n_frames)
+        return(tec_hat.reshape(shape), tec_std.reshape(shape))
+
+    def fill_sparse(self, sparse, keep_observed=False, block_size=32):
+        """ Same as fill(), but from a tec_sparse.SparseTec with tec and dtec values.
+            The valid cells of the SparseTec are already a CSC matrix of shape (n_cells, n_frames). """
+        tec = sparse.values["tec"].astype(n.float64)
+        dtec = sparse.values["dtec"].astype(n.float64)
+        ok = n.isfinite(dtec) & (dtec > 0)
+        w = n.where(ok, 1.0/n.where(ok, dtec, 1.0)**2, 0.0)
+        n_frames = sparse.n_frames
+        shape = (self.n_cells, n_frames)
+        X_w = sp.csc_matrix((w, sparse.cells, sparse.indptr), shape=shape)
+        X_wv = sp.csc_matrix((w*tec, sparse.cells, sparse.indptr), shape=shape)
+        tec_hat = n.empty(shape)
+        tec_std = n.empty(shape)
+        for i0, i1, j0, j1 in self._blocks(n_frames, block_size):
+            tec_hat[:, i0:i1], tec_std[:, i0:i1] = self._fill(X_w[:, j0:j1], X_wv[:, j0:j1], slice(i0 - j0, i1 - j0))
+        if keep_observed:
+            frame = sparse.frame_index()
+            tec_hat[sparse.cells[ok], frame[ok]] = tec[ok]
+            tec_std[sparse.cells[ok], frame[ok]] = dtec[ok]
+        shape = (len(self.lat), len(self.lon), n_frames)
+        return(tec_hat.reshape(shape), tec_std.reshape(shape))
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+#
+# Fast rendering of TEC map animation frames.
+#
+# The figure, map projections, background image, gridlines and colorbars
+# are the same for every frame, so they are rendered only once and the
+# rendered pixels are saved. For each frame, the saved background is
+# restored and only the nightshade, the scatter plot data, the coastlines
+# (on top of the data) and the title are drawn on it (blitting).
+#
+# Frames can be rendered in parallel with a process pool. Each worker
+# process creates its own figure template once and reuses it for all of
+# the frames that it renders.
+#
+# Frames are saved as image files, or streamed as raw RGB pixels to a
+# video encoder (ffmpeg) through a pipe, which avoids writing and reading
+# back intermediate PNG files. Without ffmpeg, the examples fall back to
+# image files.
+#
+import time
+import shutil
+import subprocess
+import concurrent.futures
+import numpy as n
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.image
+import matplotlib.pyplot as plt
+import cartopy.crs as ccrs
+from datetime import datetime, timezone
+from cartopy.feature.nightshade import Nightshade
+
+def default_projections():
+    # Northern Hemisphere and Southern Hemisphere
+    return([ccrs.Orthographic(0, 90), ccrs.Orthographic(180, -90)])
+
+def point_size(lat):
+    # scale scatter plot point size by latitude,
+    # to allow larger data points at high latitudes where data is sparse
+    return(n.sqrt(n.abs(lat)+1.0)*0.5)
+
+class TecMapRenderer:
+    """ Figure template with static map layers. Call draw() for each frame, then savefig() or rgb().
+        @nightshade_delta step (deg) of the day-night terminator polygon. Projecting the polygon is
+          the largest cost per frame, and 0.5 degrees is 5 times faster than the cartopy default of 0.1.
+    """
+    def __init__(self, projections=None, figsize=[10, 5], vmin=0, vmax=50, cmap="turbo", dpi=None, nightshade_delta=0.5):
+        if projections is None:
+            projections = default_projections()
+        self.fig = plt.figure(figsize=figsize, dpi=dpi)
+        self.nightshade_delta = nightshade_delta
+        self.data_projection = ccrs.PlateCarree()
+        self.axes = []
+        self.scatters = []
+        self.coastlines = []
+        self.nightshades = []
+        self.grid_xy = None
+        for pi, proj in enumerate(projections):
+            ax = self.fig.add_subplot(1, len(projections), pi+1, projection=proj)
+            coast = ax.coastlines(zorder=3)
+            ax.stock_img()
+            ax.gridlines()
+            # empty scatter plot, updated for each frame. The points are
+            # given in the map projection coordinates, see draw()
+            mp = ax.scatter(n.zeros(0), n.zeros(0), c=n.zeros(0), s=n.zeros(0),
+                            vmin=vmin, vmax=vmax,
+                            zorder=2,
+                            cmap=cmap)
+            cb = plt.colorbar(mp, ax=ax)
+            cb.set_label("TEC Units")
+            self.axes.append(ax)
+            self.scatters.append(mp)
+            self.coastlines.append(coast)
+            self.nightshades.append(None)
+        self.title = self.axes[0].set_title("0000-00-00 00:00:00")
+        # ensure small borders in plot
+        self.fig.tight_layout()
+
+        # animated artists are left out when rendering the static background
+        for artist in self.scatters + self.coastlines + [self.title]:
+            artist.set_animated(True)
+        self.fig.canvas.draw()
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+
+    def set_grid(self, lat, lon):
+        """ Project the cells of a fixed lat, lon grid once, for use with draw_cells(). """
+        lon_grid, lat_grid = n.meshgrid(lon, lat)
+        lat_points = lat_grid.flatten()
+        lon_points = lon_grid.flatten()
+        self.grid_sizes = point_size(lat_points)
+        self.grid_xy = []
+        self.grid_visible = []
+        for ax in self.axes:
+            xy = ax.projection.transform_points(self.data_projection, lon_points, lat_points)[:,0:2]
+            self.grid_xy.append(xy)
+            self.grid_visible.append(n.all(n.isfinite(xy), axis=1))
+
+    def draw_cells(self, t_unix, cells, tec):
+        """ Render one frame of TEC values in the flat cell indices of the grid given to set_grid(). """
+        self._draw([(self.grid_xy[i][cells], self.grid_visible[i][cells]) for i in range(len(self.axes))],
+                   self.grid_sizes[cells], t_unix, tec)
+
+    def draw(self, t_unix, lat, lon, tec):
+        """ Render one frame of TEC points on top of the static background. """
+        projected = []
+        for ax in self.axes:
+            # project the points once per frame here, instead of letting
+            # cartopy transform them on every draw
+            xy = ax.projection.transform_points(self.data_projection, lon, lat)[:,0:2]
+            projected.append((xy, n.all(n.isfinite(xy), axis=1)))
+        self._draw(projected, point_size(lat), t_unix, tec)
+
+    def _draw(self, projected, sizes, t_unix, tec):
+        this_frame_date = datetime.fromtimestamp(t_unix, tz=timezone.utc)
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        for i, ax in enumerate(self.axes):
+            xy, visible = projected[i]
+            self.scatters[i].set_offsets(xy[visible])
+            self.scatters[i].set_array(tec[visible])
+            self.scatters[i].set_sizes(sizes[visible])
+            if self.nightshades[i] is not None:
+                self.nightshades[i].remove()
+            self.nightshades[i] = ax.add_feature(Nightshade(this_frame_date, delta=self.nightshade_delta))
+            self.nightshades[i].set_animated(True)
+            ax.draw_artist(self.nightshades[i])
+            ax.draw_artist(self.scatters[i])
+            ax.draw_artist(self.coastlines[i])
+        # convert unix seconds to UTC string
+        self.title.set_text(this_frame_date.strftime('%Y-%m-%d %H:%M:%S'))
+        self.axes[0].draw_artist(self.title)
+
+    def rgb(self):
+        """ Copy of the rendered frame as an (height,width,3) uint8 array. """
+        return(n.array(self.fig.canvas.buffer_rgba())[:,:,0:3])
+
+    def savefig(self, fname):
+        """ Save the rendered frame as an image file. """
+        matplotlib.image.imsave(fname, n.asarray(self.fig.canvas.buffer_rgba()))
+
+    def close(self):
+        plt.close(self.fig)
+
+def valid_frames(timestamps, lat, lon, tec):
+    """ Iterate over frames (i, t_unix, lat, lon, tec) of the TEC points that are not NaN.
+        @lat, @lon are the grid axes and @tec is (n_lat, n_lon, n_times) as in the Madrigal files. """
+    lon_grid, lat_grid = n.meshgrid(lon, lat)
+    lat_points = lat_grid.flatten()
+    lon_points = lon_grid.flatten()
+    for i in range(len(timestamps)):
+        tec_points = tec[:,:,i].flatten()
+        good_idx = n.where(n.isnan(tec_points) != True)[0]
+        yield((i, timestamps[i], lat_points[good_idx], lon_points[good_idx], tec_points[good_idx]))
+
+# one renderer per worker process
+_renderer = None
+
+def _init_worker(renderer_kwargs, grid=None):
+    global _renderer
+    _renderer = TecMapRenderer(**renderer_kwargs)
+    if grid is not None:
+        _renderer.set_grid(*grid)
+
+def _render_frame(args):
+    fname_template, frame = args
+    if _renderer.grid_xy is None:
+        i, t_unix, lat, lon, tec = frame
+        _renderer.draw(t_unix, lat, lon, tec)
+    else:
+        i, t_unix, cells, tec = frame
+        _renderer.draw_cells(t_unix, cells, tec)
+    if fname_template is None:
+        # the frame is passed on to a video writer
+        return(i, _renderer.rgb())
+    _renderer.savefig(fname_template%(i))
+    return(i, None)
+
+def have_ffmpeg(ffmpeg="ffmpeg"):
+    """ True if the ffmpeg executable is found, which is needed by FFmpegWriter. """
+    return(shutil.which(ffmpeg) is not None)
+
+class FFmpegWriter:
+    """ Stream RGB frames into a video file through a pipe to ffmpeg.
+        The container and codec follow from the file name extension (e.g., .mp4, .webm, .gif).
+        @fps frames per second of the video
+        @ffmpeg path of the ffmpeg executable
+        @codec_args ffmpeg output options, by default H.264 with yuv420p pixels for .mp4 and .mkv
+    """
+    def __init__(self, fname, fps=10, ffmpeg="ffmpeg", codec_args=None):
+        self.fname = fname
+        self.fps = fps
+        self.ffmpeg = ffmpeg
+        if codec_args is None:
+            if fname.endswith(".mp4") or fname.endswith(".mkv"):
+                # yuv420p needs even frame dimensions
+                codec_args = ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2"]
+            else:
+                codec_args = []
+        self.codec_args = codec_args
+        self.proc = None
+
+    def write(self, rgb):
+        if self.proc is None:
+            # the frame size is known when the first frame arrives
+            height, width = rgb.shape[0:2]
+            cmd = [self.ffmpeg, "-y", "-loglevel", "error",
+                   "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "%dx%d"%(width, height),
+                   "-r", "%g"%(self.fps), "-i", "-"] + self.codec_args + [self.fname]
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        self.proc.stdin.write(n.ascontiguousarray(rgb, dtype=n.uint8).tobytes())
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                # ffmpeg has already exited, and the exit status tells why
+                pass
+            if self.proc.wait() != 0:
+                raise RuntimeError("ffmpeg failed writing %s"%(self.fname))
+            self.proc = None
+
+def render_sequence(frames, fname_template="fig-%06d.png", n_workers=1, verbose=True, grid=None, output=None, **renderer_kwargs):
+    """ Render frames (i, t_unix, lat, lon, tec), e.g., from valid_frames(), into image files.
+        @grid optional (lat, lon) grid axes. Then frames are (i, t_unix, cells, tec) with flat cell
+          indices, e.g., from tec_sparse.SparseTec.cell_frames(), and the cells are projected only once.
+        @output optional writer with write(rgb) and close() methods, e.g., FFmpegWriter. Then the
+          rendered frames are written to it in the input order instead of to image files.
+        @n_workers number of worker processes. Frames are submitted to the pool as they are
+          read, with at most a few frames per worker either waiting in the queue or finished
+          out of order and held back until the earlier frames have been written.
+        Other keyword arguments are passed to TecMapRenderer.
+        Returns the number of frames rendered per second.
+    """
+    t0 = time.perf_counter()
+    if output is not None:
+        fname_template = None
+    tasks = ((fname_template, frame) for frame in frames)
+    # frames that are done, but waiting for earlier frames, by submission order
+    done_frames = {}
+    n_written = [0]
+
+    def finished(seq, result):
+        done_frames[seq] = result
+        while n_written[0] in done_frames:
+            i, rgb = done_frames.pop(n_written[0])
+            if output is not None:
+                output.write(rgb)
+            n_written[0] += 1
+            if verbose:
+                print(i)
+
+    try:
+        if n_workers <= 1:
+            _init_worker(renderer_kwargs, grid)
+            try:
+                for seq, task in enumerate(tasks):
+                    finished(seq, _render_frame(task))
+            finally:
+                _renderer.close()
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                                                        initializer=_init_worker,
+                                                        initargs=(renderer_kwargs, grid)) as pool:
+                pending = {}
+                for seq, task in enumerate(tasks):
+                    pending[pool.submit(_render_frame, task)] = seq
+                    # frames held back count towards the limit, so that a slow frame doesn't
+                    # let an unbounded number of later frames pile up in memory
+                    while len(pending) + len(done_frames) >= 4*n_workers:
+                        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for d in done:
+                            finished(pending.pop(d), d.result())
+                for d in concurrent.futures.as_completed(pending):
+                    finished(pending[d], d.result())
+    finally:
+        if output is not None:
+            output.close()
+    frames_per_second = n_written[0]/(time.perf_counter()-t0)
+    if verbose:
+        print("Rendered %d frames, %1.2f frames/s"%(n_written[0], frames_per_second))
+    return(frames_per_second)
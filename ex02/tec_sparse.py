@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+#
+# Sparse representation of gridded TEC maps.
+#
+# Most cells of the 1x1 degree Madrigal grid are empty (NaN) in any given
+# frame. Instead of scanning the full grid in every frame, the valid cells
+# are found once per file and stored in a compressed sparse row (CSR)
+# layout over time:
+#
+#   cells[indptr[i]:indptr[i+1]]  flat (lat_idx*n_lon + lon_idx) indices of the valid cells of frame i
+#   values[p][indptr[i]:indptr[i+1]]  values of parameter p (e.g., tec, dtec) in these cells
+#
+# Accessing a frame is then a slice, and statistics over frames or cells
+# are bincount or reduceat operations over the valid values only.
+#
+import numpy as n
+
+class SparseTec:
+    def __init__(self, lat, lon, timestamps, indptr, cells, values):
+        self.lat = lat
+        self.lon = lon
+        self.timestamps = timestamps
+        self.indptr = indptr
+        self.cells = cells
+        self.values = values
+        self.n_cells = len(lat)*len(lon)
+        # lat and lon of each cell of the flattened grid
+        lon_grid, lat_grid = n.meshgrid(lon, lat)
+        self.cell_lat = lat_grid.flatten()
+        self.cell_lon = lon_grid.flatten()
+
+    @classmethod
+    def from_file(cls, tec_file, parameters=("tec", "dtec"), t0=None, t1=None, dtype=n.float32):
+        """ Build the sparse representation in one pass over a madrigal_tec.MadrigalTecFile.
+            A cell is valid when the first parameter is not NaN. """
+        t_sl = tec_file.time_slice(t0, t1)
+        blocks = {p: tec_file.iter_frames(t0, t1, parameter=p) for p in parameters}
+        counts = []
+        cells = []
+        values = {p: [] for p in parameters}
+        for frames in zip(*blocks.values()):
+            data = {p: f[2].ravel() for p, f in zip(parameters, frames)}
+            cell = n.flatnonzero(n.isfinite(data[parameters[0]]))
+            counts.append(len(cell))
+            cells.append(cell.astype(n.int32))
+            for p in parameters:
+                values[p].append(data[p][cell].astype(dtype))
+        indptr = n.zeros(len(counts)+1, dtype=n.int64)
+        indptr[1:] = n.cumsum(counts)
+        return(cls(tec_file.lat, tec_file.lon, tec_file.timestamps[t_sl], indptr,
+                   n.concatenate(cells) if len(cells) > 0 else n.zeros(0, dtype=n.int32),
+                   {p: n.concatenate(v) if len(v) > 0 else n.zeros(0, dtype=dtype) for p, v in values.items()}))
+
+    @property
+    def n_frames(self):
+        return(len(self.timestamps))
+
+    def fill_fraction(self):
+        """ Fraction of valid cells in the whole file. """
+        return(len(self.cells)/float(self.n_cells*self.n_frames))
+
+    def frame(self, i, parameter="tec"):
+        """ Valid cell indices and values of frame i (views, not copies). """
+        sl = slice(self.indptr[i], self.indptr[i+1])
+        return(self.cells[sl], self.values[parameter][sl])
+
+    def frame_points(self, i, parameter="tec"):
+        """ lat, lon and values of the valid cells of frame i. """
+        cells, values = self.frame(i, parameter)
+        return(self.cell_lat[cells], self.cell_lon[cells], values)
+
+    def valid_frames(self, parameter="tec"):
+        """ Iterate over frames (i, t_unix, lat, lon, values), as used by tec_render.render_sequence. """
+        for i in range(self.n_frames):
+            yield((i, self.timestamps[i]) + self.frame_points(i, parameter))
+
+    def cell_frames(self, parameter="tec"):
+        """ Iterate over frames (i, t_unix, cells, values). Used with tec_render.render_sequence(..., grid=(lat,lon)),
+            where the projected cell positions are computed only once. """
+        for i in range(self.n_frames):
+            yield((i, self.timestamps[i]) + self.frame(i, parameter))
+
+    def frame_index(self):
+        """ Frame index of each valid value. """
+        return(n.repeat(n.arange(self.n_frames), n.diff(self.indptr)))
+
+    def frame_mean(self, parameter="tec"):
+        """ Mean over the valid cells of each frame, NaN for empty frames. """
+        counts = n.diff(self.indptr)
+        sums = n.bincount(self.frame_index(), weights=self.values[parameter], minlength=self.n_frames)
+        with n.errstate(invalid="ignore", divide="ignore"):
+            return(sums/counts)
+
+    def cell_mean(self, parameter="tec"):
+        """ Mean over time of each cell (n_lat, n_lon), NaN for cells without data. """
+        counts = n.bincount(self.cells, minlength=self.n_cells)
+        sums = n.bincount(self.cells, weights=self.values[parameter], minlength=self.n_cells)
+        with n.errstate(invalid="ignore", divide="ignore"):
+            return((sums/counts).reshape(len(self.lat), len(self.lon)))
+
+    def dense_frame(self, i, parameter="tec"):
+        """ Frame i as an (n_lat, n_lon) array with NaN in the empty cells. """
+        cells, values = self.frame(i, parameter)
+        grid = n.full(self.n_cells, n.nan, dtype=values.dtype)
+        grid[cells] = values
+        return(grid.reshape(len(self.lat), len(self.lon)))
+
+    def save(self, fname):
+        """ Export to an npz file. """
+        n.savez(fname, lat=self.lat, lon=self.lon, timestamps=self.timestamps,
+                indptr=self.indptr, cells=self.cells,
+                **{"value_%s"%(p): v for p, v in self.values.items()})
+
+    @classmethod
+    def load(cls, fname):
+        d = n.load(fname)
+        values = {k[len("value_"):]: d[k] for k in d.files if k.startswith("value_")}
+        return(cls(d["lat"], d["lon"], d["timestamps"], d["indptr"], d["cells"], values))
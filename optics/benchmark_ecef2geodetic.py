@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+#
+# Throughput and accuracy of the ecef2geodetic methods in jcoord.
+# The reference is a global grid of geodetic coordinates from -1000 km
+# to 40000 km height, converted to ECEF with geodetic2ecef. The latitude
+# error is also given as a horizontal distance on the ground.
+#
+import time
+import numpy as n
+
+import jcoord
+
+lat=n.linspace(-89.99,89.99,num=361)
+lon=n.linspace(-180,180,num=73)
+h=n.concatenate([n.linspace(-1000e3,0,num=21),
+                 n.linspace(0,1000e3,num=101)[1:],
+                 n.linspace(1000e3,40000e3,num=79)[1:]])
+lat_g,lon_g,h_g=n.meshgrid(lat,lon,h,indexing="ij")
+lat_g=lat_g.flatten()
+lon_g=lon_g.flatten()
+h_g=h_g.flatten()
+x,y,z=jcoord.geodetic2ecef(lat_g,lon_g,h_g)
+n_points=len(x)
+print("%d points"%(n_points))
+
+# preallocated output buffer, reused for all repeats
+out=n.empty([3,n_points])
+n_repeat=5
+
+print("%-8s %8s %14s %14s %14s %14s"%("method","iter","points/s","max |dh| (m)","max |dlat| (deg)","max |dlat| (m)"))
+for method in ["zhu","bowring","newton"]:
+    if method == "newton":
+        variants=[("%d"%(n_iter), lambda n_iter=n_iter: jcoord.ecef2geodetic_newton(x,y,z,out=out,n_iter=n_iter)) for n_iter in [1,2,3]]
+    else:
+        variants=[("-", lambda method=method: jcoord.ecef2geodetic(x,y,z,method=method,out=out))]
+    for n_iter, fun in variants:
+        t0=time.perf_counter()
+        for i in range(n_repeat):
+            fun()
+        dt=(time.perf_counter()-t0)/n_repeat
+        dh=n.max(n.abs(out[2]-h_g))
+        dlat=n.max(n.abs(out[0]-lat_g))
+        print("%-8s %8s %14.3g %14.3g %14.3g %14.3g"%(method,n_iter,n_points/dt,dh,dlat,n.pi*jcoord.a*dlat/180.0))
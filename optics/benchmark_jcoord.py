@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+#
+# Compare the throughput of the original scalar jcoord functions, called
+# per point in a Python loop, with one batched call of the vectorized
+# jcoord on arrays of points. Also reports the largest difference between
+# the two, which should be at the round-off level.
+#
+import math
+import time
+import numpy as n
+
+import jcoord
+
+# the scalar functions of the original jcoord.py, copied here as the reference.
+# The WGS84 constants are those of jcoord.
+from jcoord import a, b, esq, e1sq
+
+def scalar_cbrt(x):
+    if x >= 0:
+        return n.power(x, 1.0/3.0)
+    else:
+        return -n.power(abs(x), 1.0/3.0)
+
+def scalar_geodetic2ecef(lat, lon, alt):
+    lat, lon = n.radians(lat), n.radians(lon)
+    xi = n.sqrt(1 - esq * n.sin(lat)**2)
+    x = (a / xi + alt) * n.cos(lat) * n.cos(lon)
+    y = (a / xi + alt) * n.cos(lat) * n.sin(lon)
+    z = (a / xi * (1 - esq) + alt) * n.sin(lat)
+    return(n.array([x, y, z]))
+
+def scalar_ned2ecef(lat, lon, alt, north, e, d):
+    x, y, z = e, north, -1.0*d
+    lat, lon = n.radians(lat), n.radians(lon)
+    mx = n.array([[-n.sin(lon), -n.sin(lat) * n.cos(lon), n.cos(lat) * n.cos(lon)],
+                  [n.cos(lon), -n.sin(lat) * n.sin(lon), n.cos(lat) * n.sin(lon)],
+                  [0, n.cos(lat), n.sin(lat)]])
+    enu = n.array([x, y, z])
+    res = n.dot(mx,enu)
+    return(res)
+
+def scalar_azel_ecef(lat, lon, alt, az, el):
+    return(scalar_ned2ecef(lat,lon,alt,
+                           n.cos(-n.radians(az))*n.cos(n.radians(el)),
+                           -n.sin(-n.radians(az))*n.cos(n.radians(el)),
+                           -n.sin(n.radians(el))))
+
+def scalar_ecef2geodetic(x, y, z):
+    r = n.sqrt(x * x + y * y)
+    Esq = a * a - b * b
+    F = 54 * b * b * z * z
+    G = r * r + (1 - esq) * z * z - esq * Esq
+    C = (esq * esq * F * r * r) / (pow(G, 3))
+    S = scalar_cbrt(1 + C + n.sqrt(C * C + 2 * C))
+    P = F / (3 * pow((S + 1 / S + 1), 2) * G * G)
+    Q = n.sqrt(1 + 2 * esq * esq * P)
+    r_0 =  -(P * esq * r) / (1 + Q) + n.sqrt(0.5 * a * a*(1 + 1.0 / Q) - \
+        P * (1 - esq) * z * z / (Q * (1 + Q)) - 0.5 * P * r * r)
+    U = n.sqrt(pow((r - esq * r_0), 2) + z * z)
+    V = n.sqrt(pow((r - esq * r_0), 2) + (1 - esq) * z * z)
+    Z_0 = b * b * z / (a * V)
+    h = U * (1 - b * b / (a * V))
+    lat = n.arctan((z + e1sq * Z_0) / r)
+    lon = n.arctan2(y, x)
+    return(n.array([n.degrees(lat), n.degrees(lon), h]))
+
+def scalar_geodetic_to_az_el_r(obs_lat, obs_lon, obs_h, target_lat, target_lon, target_h):
+    up = scalar_ned2ecef(obs_lat, obs_lon, obs_h, 0.0, 0.0, -1.0)
+    north = scalar_ned2ecef(obs_lat, obs_lon, obs_h, 1.0, 0.0, 0.0)
+    east = scalar_ned2ecef(obs_lat, obs_lon, obs_h, 0.0, 1.0, 0.0)
+    obs = n.array(scalar_geodetic2ecef(obs_lat, obs_lon, obs_h))
+    target = n.array(scalar_geodetic2ecef(target_lat, target_lon, target_h))
+    p_vec = (target-obs)
+    az_p = n.dot(p_vec,north)*north+n.dot(p_vec,east)*east
+    azs = n.sign(n.dot(p_vec,east))
+    elevation = 90.0-180.0*n.arccos(n.dot(p_vec,up)/(n.sqrt(n.dot(p_vec,p_vec))*n.sqrt(n.dot(up,up))))/math.pi
+    azimuth = azs*180.0*n.arccos(n.dot(az_p,north)/(n.sqrt(n.dot(az_p,az_p))*n.sqrt(n.dot(north,north))))/math.pi
+    target_range = n.sqrt(n.dot(p_vec,p_vec))
+    return(n.array([azimuth, elevation, target_range]))
+
+def scalar_az_el_r2geodetic(obs_lat, obs_lon, obs_h, az, el, r):
+    x = scalar_geodetic2ecef(obs_lat, obs_lon, obs_h) + scalar_azel_ecef(obs_lat, obs_lon, obs_h, az, el)*r
+    llh = scalar_ecef2geodetic(x[0],x[1],x[2])
+    if(llh[1] < 0.0):
+        llh[1] = llh[1]+360.0
+    return(llh)
+
+def points_per_second(fun, n_points):
+    t0=time.perf_counter()
+    res=fun()
+    dt=time.perf_counter()-t0
+    return(res, n_points/dt)
+
+def max_rel_err(x, x_ref):
+    return(n.max(n.abs(x-x_ref)/n.maximum(n.abs(x_ref),1.0)))
+
+# number of points for the per-point loop (slow) and batched call (fast)
+n_loop=5000
+n_batch=1000000
+
+rng=n.random.default_rng(0)
+lat=rng.uniform(-90,90,n_batch)
+lon=rng.uniform(-180,180,n_batch)
+alt=rng.uniform(-1e3,1e6,n_batch)
+az=rng.uniform(0,360,n_batch)
+el=rng.uniform(1,90,n_batch)
+r=rng.uniform(70e3,1000e3,n_batch)
+
+# observer in Tromsø
+obs_lat=69.58
+obs_lon=19.23
+obs_h=86.0
+
+tests=[
+    ("geodetic2ecef",
+     lambda i: scalar_geodetic2ecef(lat[i],lon[i],alt[i]),
+     lambda s: jcoord.geodetic2ecef(lat[s],lon[s],alt[s])),
+    ("ecef2geodetic",
+     lambda i: scalar_ecef2geodetic(*scalar_geodetic2ecef(lat[i],lon[i],alt[i])),
+     lambda s: jcoord.ecef2geodetic(*jcoord.geodetic2ecef(lat[s],lon[s],alt[s]))),
+    ("azel_ecef",
+     lambda i: scalar_azel_ecef(obs_lat,obs_lon,obs_h,az[i],el[i]),
+     lambda s: jcoord.azel_ecef(obs_lat,obs_lon,obs_h,az[s],el[s])),
+    ("az_el_r2geodetic",
+     lambda i: scalar_az_el_r2geodetic(obs_lat,obs_lon,obs_h,az[i],el[i],r[i]),
+     lambda s: jcoord.az_el_r2geodetic(obs_lat,obs_lon,obs_h,az[s],el[s],r[s])),
+]
+
+print("%-20s %14s %14s %8s %10s"%("function","loop (pts/s)","batch (pts/s)","speedup","max err"))
+for name, one, many in tests:
+    loop_res, loop_rate = points_per_second(lambda: n.array([one(i) for i in range(n_loop)]).T, n_loop)
+    batch_res, batch_rate = points_per_second(lambda: many(slice(0,n_batch)), n_batch)
+    err=max_rel_err(batch_res[:,0:n_loop],loop_res)
+    print("%-20s %14.3g %14.3g %8.1f %10.2g"%(name,loop_rate,batch_rate,batch_rate/loop_rate,err))
+
+# targets around the observer at ionospheric heights. The azimuth
+# uses arccos, which amplifies round-off near due north, so the error
+# is reported in degrees.
+t_lat=obs_lat+rng.uniform(-5,5,n_batch)
+t_lon=obs_lon+rng.uniform(-5,5,n_batch)
+t_h=rng.uniform(80e3,500e3,n_batch)
+loop_res, loop_rate = points_per_second(
+    lambda: n.array([scalar_geodetic_to_az_el_r(obs_lat,obs_lon,obs_h,t_lat[i],t_lon[i],t_h[i]) for i in range(n_loop)]).T, n_loop)
+batch_res, batch_rate = points_per_second(
+    lambda: jcoord.geodetic_to_az_el_r(obs_lat,obs_lon,obs_h,t_lat,t_lon,t_h), n_batch)
+err=n.max(n.abs(batch_res[0:2,0:n_loop]-loop_res[0:2]))
+print("%-20s %14.3g %14.3g %8.1f %10.2g (deg)"%("geodetic_to_az_el_r",loop_rate,batch_rate,batch_rate/loop_rate,err))
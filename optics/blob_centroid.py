@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+#
+# Automatic detection of bright blobs (e.g., artificial aurora) and their
+# intensity weighted centroids in camera image sequences.
+#
+# Frames are read lazily in blocks from an HDF5 file (this includes MATLAB
+# v7.3 files), or from an older MATLAB file or a numpy array. Each block is
+# processed with vectorized operations over all frames of the block:
+#
+#   1. background subtraction (median of coarse tiles, interpolated to each pixel,
+#      which follows vignetting and sky background gradients)
+#   2. thresholding at a number of robust standard deviations (median absolute deviation)
+#   3. labeling of connected regions within each frame
+#   4. intensity weighted centroid of each region
+#
+# Blocks can be distributed to a process pool. Only a bounded number of
+# blocks are in memory at any time.
+#
+# The centroids are fractional pixel positions (x = column, y = row), which
+# can be converted to look vectors with camera_calibration.CameraCalibration.
+#
+import concurrent.futures
+import numpy as n
+import h5py
+import scipy.io as sio
+import scipy.ndimage as ndi
+
+def iter_frames(source, key=None, block_size=32, frame_axis=0):
+    """ Iterate over blocks of frames (n_block,ny,nx) as float32 arrays.
+        @source an HDF5 or MAT file name, or an array of frames
+        @key dataset name in the file
+        @frame_axis axis that indexes the frames in the stored array.
+          Note that MATLAB v7.3 files store arrays transposed, so that
+          a MATLAB (ny,nx,n_frames) array is (n_frames,nx,ny) in the file.
+        A single (ny,nx) image is yielded as one block with one frame.
+    """
+    if isinstance(source, str) and h5py.is_hdf5(source):
+        with h5py.File(source, "r") as h:
+            d = h[key]
+            if d.ndim == 2:
+                yield(d[()][None,:,:].astype(n.float32))
+                return
+            n_frames = d.shape[frame_axis]
+            for i0 in range(0, n_frames, block_size):
+                idx = [slice(None)]*3
+                idx[frame_axis] = slice(i0, min(i0+block_size, n_frames))
+                # only this hyperslab is read from disk
+                yield(n.moveaxis(d[tuple(idx)], frame_axis, 0).astype(n.float32))
+        return
+
+    if isinstance(source, str):
+        # older MATLAB files can't be read partially
+        source = sio.loadmat(source)[key]
+    frames = n.asarray(source)
+    if frames.ndim == 2:
+        yield(frames[None,:,:].astype(n.float32))
+        return
+    frames = n.moveaxis(frames, frame_axis, 0)
+    for i0 in range(0, frames.shape[0], block_size):
+        yield(frames[i0:(i0+block_size)].astype(n.float32))
+
+def tile_background(frames, tile=32):
+    """ Smooth background of each frame (n_frames,ny,nx): the median of tile x tile pixel
+        tiles, bilinearly interpolated between the tile centers. Tiles should be
+        larger than the blobs. """
+    n_frames, ny, nx = frames.shape
+    n_ty = max(ny//tile, 1)
+    n_tx = max(nx//tile, 1)
+    ty = min(tile, ny)
+    tx = min(tile, nx)
+    tiles = frames[:, 0:(n_ty*ty), 0:(n_tx*tx)].reshape(n_frames, n_ty, ty, n_tx, tx)
+    med = n.median(tiles.transpose(0,1,3,2,4).reshape(n_frames, n_ty, n_tx, -1), axis=-1)
+    # bilinear interpolation between tile centers is separable: W_y med W_x^T
+    W_y = interpolation_matrix(ny, n_ty, ty)
+    W_x = interpolation_matrix(nx, n_tx, tx)
+    return(n.einsum("yi,fij,xj->fyx", W_y, med, W_x, optimize=True).astype(n.float32))
+
+def interpolation_matrix(n_pix, n_tiles, tile):
+    """ (n_pix,n_tiles) linear interpolation weights from tile centers to pixels, constant beyond the outermost centers. """
+    pos = n.clip((n.arange(n_pix)+0.5)/tile-0.5, 0, n_tiles-1)
+    i0 = n.minimum(n.floor(pos).astype(int), max(n_tiles-2, 0))
+    frac = pos - i0
+    W = n.zeros([n_pix, n_tiles])
+    W[n.arange(n_pix), i0] = 1.0 - frac
+    if n_tiles > 1:
+        W[n.arange(n_pix), i0+1] = frac
+    return(W)
+
+def centroid_frames(frames, threshold=4.0, min_pixels=3, brightest_only=False, tile=32, background=None):
+    """ Detect blobs and their intensity weighted centroids in a block of frames (n_frames,ny,nx).
+        @threshold detection threshold in robust standard deviations above the background
+        @min_pixels smallest number of connected pixels in a blob
+        @brightest_only keep only the brightest blob of each frame
+        @tile size of the tiles used to estimate the background
+        @background optional background image (ny,nx) to use instead of the tile background
+        Returns a dict of arrays with one entry per blob: frame (index within the block),
+        x, y (fractional pixel position), intensity (background subtracted sum) and n_pixels.
+    """
+    frames = n.asarray(frames, dtype=n.float32)
+    n_frames = frames.shape[0]
+    if background is None:
+        background = tile_background(frames, tile=tile)
+    img = frames - background
+    resid = img.reshape(n_frames, -1)
+    sigma = 1.4826*n.median(n.abs(resid - n.median(resid, axis=1)[:,None]), axis=1)
+    mask = img > threshold*sigma[:,None,None]
+
+    # 8-connected regions within a frame, never connected across frames
+    structure = n.zeros([3,3,3], dtype=bool)
+    structure[1,:,:] = True
+    labels, n_labels = ndi.label(mask, structure=structure)
+    if n_labels == 0:
+        return(empty_centroids())
+
+    # per blob sums over the detected pixels only
+    fi, yi, xi = n.nonzero(mask)
+    lab = labels[fi, yi, xi]
+    w = img[fi, yi, xi].astype(n.float64)
+    n_pixels = n.bincount(lab, minlength=n_labels+1)[1:]
+    intensity = n.bincount(lab, weights=w, minlength=n_labels+1)[1:]
+    # all pixels of a blob are in the same frame
+    frame = n.bincount(lab, weights=fi, minlength=n_labels+1)[1:]/n.maximum(n_pixels, 1)
+    res = {"frame": n.round(frame).astype(int),
+           "x": n.bincount(lab, weights=w*xi, minlength=n_labels+1)[1:]/intensity,
+           "y": n.bincount(lab, weights=w*yi, minlength=n_labels+1)[1:]/intensity,
+           "intensity": intensity,
+           "n_pixels": n_pixels}
+    res = select(res, res["n_pixels"] >= min_pixels)
+
+    if brightest_only and len(res["frame"]) > 0:
+        # sort by frame, then by decreasing intensity, and keep the first of each frame
+        order = n.lexsort((-res["intensity"], res["frame"]))
+        first = n.ones(len(order), dtype=bool)
+        first[1:] = res["frame"][order][1:] != res["frame"][order][:-1]
+        res = select(res, order[first])
+    return(res)
+
+def empty_centroids():
+    return({"frame": n.zeros(0, dtype=int), "x": n.zeros(0), "y": n.zeros(0),
+            "intensity": n.zeros(0), "n_pixels": n.zeros(0, dtype=int)})
+
+def select(res, idx):
+    return({k: v[idx] for k, v in res.items()})
+
+def concatenate(results):
+    if len(results) == 0:
+        return(empty_centroids())
+    return({k: n.concatenate([r[k] for r in results]) for k in results[0].keys()})
+
+def _centroid_block(args):
+    frame0, frames, kwargs = args
+    res = centroid_frames(frames, **kwargs)
+    res["frame"] += frame0
+    return(res)
+
+def process_sequence(source, key=None, block_size=32, frame_axis=0, n_workers=1, **kwargs):
+    """ Find blob centroids in a whole image sequence.
+        @n_workers number of processes. With n_workers > 1, at most 2*n_workers
+          blocks are read ahead of the results, which bounds the memory use.
+        Other keyword arguments are passed to centroid_frames.
+        Returns the same dict as centroid_frames, with frame indices counted
+        from the start of the sequence.
+    """
+    blocks = iter_frames(source, key=key, block_size=block_size, frame_axis=frame_axis)
+
+    def tasks():
+        frame0 = 0
+        for frames in blocks:
+            yield((frame0, frames, kwargs))
+            frame0 += frames.shape[0]
+
+    if n_workers <= 1:
+        return(concatenate([_centroid_block(t) for t in tasks()]))
+
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as pool:
+        pending = []
+        for t in tasks():
+            pending.append(pool.submit(_centroid_block, t))
+            if len(pending) >= 2*n_workers:
+                results.append(pending.pop(0).result())
+        results += [p.result() for p in pending]
+    return(concatenate(results))
+
+def look_vectors(centroids, calibration):
+    """ Unit ECEF look vectors (3,n_blobs) of the centroids using a
+        camera_calibration.CameraCalibration. """
+    return(calibration.pixel_to_ecef(centroids["x"], centroids["y"]))
+
+if __name__ == "__main__":
+    import time
+    # the single frames from both ALIS stations in the triangulation exercise
+    for key in ["dN", "dS"]:
+        c = process_sequence("Data_4_triangulation.mat", key=key, brightest_only=True)
+        print("%s blob centroid x %1.2f y %1.2f"%(key, c["x"][0], c["y"][0]))
+
+    # throughput on a synthetic image sequence with a moving blob
+    n_frames = 2000
+    x, y = n.meshgrid(n.arange(128), n.arange(128))
+    t = n.arange(n_frames)
+    bx = 64 + 30*n.cos(2*n.pi*t/n_frames)
+    by = 64 + 30*n.sin(2*n.pi*t/n_frames)
+    frames = n.random.randn(n_frames, 128, 128).astype(n.float32)
+    frames += 50*n.exp(-((x[None,:,:]-bx[:,None,None])**2 + (y[None,:,:]-by[:,None,None])**2)/(2*3.0**2))
+    for n_workers in [1, 4]:
+        t0 = time.perf_counter()
+        c = process_sequence(frames, n_workers=n_workers, brightest_only=True)
+        dt = time.perf_counter()-t0
+        err = n.max(n.hypot(c["x"]-bx[c["frame"]], c["y"]-by[c["frame"]]))
+        print("%d workers: %1.0f frames/s, max centroid error %1.3f pixels"%(n_workers, n_frames/dt, err))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+#
+# Camera calibration lookup tables. The calibration gives the azimuth and
+# zenith angle (radians) of every pixel on a regular pixel grid. Instead of
+# rebuilding a Delaunay triangulation with griddata for every query, the
+# unit look vector of each pixel is computed once and interpolated
+# bilinearly on the pixel grid. Interpolating look vectors instead of
+# angles also avoids the 2*pi wrap in azimuth.
+#
+# The inverse map (az,za) -> (x,y) is tabulated once on a regular grid of
+# the horizontal projection of the look direction
+#   (sin(az)*sin(za), cos(az)*sin(za))
+# which is also continuous across the azimuth wrap.
+#
+# The tables can be saved to an npz file, so that later runs don't have
+# to rebuild them.
+#
+import numpy as n
+import scipy.io as sio
+import scipy.interpolate as sint
+
+import jcoord
+
+def bilinear(grid, x, y):
+    """ Bilinear interpolation of grid (C,ny,nx) at fractional indices x (column) and y (row).
+        Returns (C,...) with the shape of x and y. Points outside the grid are NaN. """
+    x, y = n.broadcast_arrays(n.asarray(x, dtype=n.float64), n.asarray(y, dtype=n.float64))
+    ny, nx = grid.shape[1], grid.shape[2]
+    inside = (x >= 0) & (x <= nx-1) & (y >= 0) & (y <= ny-1)
+    xc = n.where(inside, x, 0.0)
+    yc = n.where(inside, y, 0.0)
+    x0 = n.minimum(n.floor(xc).astype(int), nx-2)
+    y0 = n.minimum(n.floor(yc).astype(int), ny-2)
+    fx = xc - x0
+    fy = yc - y0
+    res = (grid[:, y0, x0]*((1-fx)*(1-fy)) + grid[:, y0, x0+1]*(fx*(1-fy)) +
+           grid[:, y0+1, x0]*((1-fx)*fy) + grid[:, y0+1, x0+1]*(fx*fy))
+    res[:, ~inside] = n.nan
+    return(res)
+
+class CameraCalibration:
+    """ Pixel <-> look direction mapping for one camera.
+        @az, @za azimuth and zenith angle (radians) of each pixel, indexed [y,x]
+        @lat, @lon, @alt camera location (deg, deg, meters)
+        @n_inverse size of the inverse lookup table along each axis
+    """
+    def __init__(self, az, za, lat, lon, alt, n_inverse=512, inverse_table=None):
+        self.az = n.asarray(az, dtype=n.float64)
+        self.za = n.asarray(za, dtype=n.float64)
+        self.lat = float(lat)
+        self.lon = float(lon)
+        self.alt = float(alt)
+        self.ny, self.nx = self.az.shape
+
+        # unit look vector of each pixel in east-north-up and ECEF (3,ny,nx)
+        self.look_enu = n.array([n.sin(self.az)*n.sin(self.za),
+                                 n.cos(self.az)*n.sin(self.za),
+                                 n.cos(self.za)])
+        self.frame = jcoord.local_frame(self.lat, self.lon, self.alt)
+        self.look_ecef = self.frame.enu2ecef_vec(self.look_enu)
+
+        if inverse_table is None:
+            inverse_table = self._inverse_table(n_inverse)
+        # (hx0, hy0, dh) of the regular grid and the (2,n,n) table of x and y pixels
+        self.inverse_extent, self.inverse_xy = inverse_table
+
+    def _inverse_table(self, n_inverse):
+        # this is the only place where a triangulation is needed
+        hor = self.look_enu[0:2].reshape(2, -1).T
+        x, y = n.meshgrid(n.arange(self.nx), n.arange(self.ny))
+        interp = sint.LinearNDInterpolator(hor, n.column_stack([x.flatten(), y.flatten()]))
+        h_min = n.min(hor, axis=0)
+        h_max = n.max(hor, axis=0)
+        dh = n.max(h_max - h_min)/(n_inverse - 1)
+        hx = h_min[0] + n.arange(n_inverse)*dh
+        hy = h_min[1] + n.arange(n_inverse)*dh
+        hxg, hyg = n.meshgrid(hx, hy)
+        xy = n.moveaxis(interp(hxg, hyg), -1, 0)
+        return((n.array([h_min[0], h_min[1], dh]), xy))
+
+    def pixel_to_enu(self, x, y):
+        """ Unit look vectors (3,...) in east-north-up for fractional pixel positions. """
+        v = bilinear(self.look_enu, x, y)
+        return(v/n.sqrt(n.sum(v**2, axis=0)))
+
+    def pixel_to_ecef(self, x, y):
+        """ Unit look vectors (3,...) in ECEF for fractional pixel positions. """
+        return(self.frame.enu2ecef_vec(self.pixel_to_enu(x, y)))
+
+    def pixel_to_azza(self, x, y):
+        """ Azimuth and zenith angle (radians) for fractional pixel positions. """
+        e, no, u = self.pixel_to_enu(x, y)
+        return(n.mod(n.arctan2(e, no), 2.0*n.pi), n.arccos(n.clip(u, -1.0, 1.0)))
+
+    def pixel_to_azel(self, x, y):
+        """ Azimuth and elevation (degrees) for fractional pixel positions, as used by jcoord. """
+        az, za = self.pixel_to_azza(x, y)
+        return(n.degrees(az), 90.0 - n.degrees(za))
+
+    def azza_to_pixel(self, az, za):
+        """ Fractional pixel positions (x,y) for azimuth and zenith angle (radians).
+            Directions outside the field of view are NaN. """
+        hx = n.sin(az)*n.sin(za)
+        hy = n.cos(az)*n.sin(za)
+        h_x0, h_y0, dh = self.inverse_extent
+        x, y = bilinear(self.inverse_xy, (hx - h_x0)/dh, (hy - h_y0)/dh)
+        return(x, y)
+
+    def save(self, fname):
+        """ Save the calibration and lookup tables to an npz file. """
+        n.savez(fname, az=self.az, za=self.za, lat=self.lat, lon=self.lon, alt=self.alt,
+                inverse_extent=self.inverse_extent, inverse_xy=self.inverse_xy)
+
+    @classmethod
+    def load(cls, fname):
+        """ Load a calibration saved with save(). """
+        d = n.load(fname)
+        return(cls(d["az"], d["za"], d["lat"], d["lon"], d["alt"],
+                   inverse_table=(d["inverse_extent"], d["inverse_xy"])))
+
+    @classmethod
+    def from_mat(cls, fname, station, n_inverse=512):
+        """ Read the calibration of a station ("N" for Nikkaluokta, "S" for Silkkimuotka)
+            from an ALIS triangulation MAT file (e.g., Data_4_triangulation.mat). """
+        d = sio.loadmat(fname)
+        return(cls(d["az%s"%(station)], d["ze%s"%(station)],
+                   d["latlong%s"%(station)][0,0], d["latlong%s"%(station)][0,1],
+                   d["alt%s"%(station)][0,0], n_inverse=n_inverse))
+
+if __name__ == "__main__":
+    import time
+    t0 = time.perf_counter()
+    cal = CameraCalibration.from_mat("Data_4_triangulation.mat", "S")
+    print("Building Silkkimuotka calibration took %1.2f s"%(time.perf_counter()-t0))
+    cal.save("calibration_S.npz")
+    t0 = time.perf_counter()
+    cal = CameraCalibration.load("calibration_S.npz")
+    print("Loading it took %1.3f s"%(time.perf_counter()-t0))
+
+    x = n.random.uniform(0, cal.nx-1, 100000)
+    y = n.random.uniform(0, cal.ny-1, 100000)
+    t0 = time.perf_counter()
+    az, za = cal.pixel_to_azza(x, y)
+    dt = time.perf_counter()-t0
+    x2, y2 = cal.azza_to_pixel(az, za)
+    print("%d pixel lookups took %1.3f s, round trip pixel error median %1.3f"%(len(x), dt, n.nanmedian(n.hypot(x-x2, y-y2))))
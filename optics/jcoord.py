@@ -10,15 +10,14 @@ from datetime import datetime, timedelta
 from time import mktime
 #import ConfigParser
 #import igrf2
-from numpy import power, degrees, radians, mat, cos, sin, arctan, sqrt, pi, arctan2, array, transpose, dot, arccos, sign
+from numpy import power, degrees, radians, cos, sin, arctan, sqrt, pi, arctan2, array, transpose, dot, arccos, sign
 import math
+import functools
 import numpy
 
 def cbrt(x):
-    if x >= 0:
-        return power(x, 1.0/3.0)
-    else:
-        return -power(abs(x), 1.0/3.0)
+    """Real cube root, works element-wise on arrays."""
+    return(numpy.cbrt(x))
 
 # Constants defined by the World Geodetic System 1984 (WGS84)
 a = 6378.137*1e3
@@ -27,6 +26,11 @@ esq = 6.69437999014 * 0.001
 e1sq = 6.73949674228 * 0.001
 f = 1 / 298.257223563
 
+# All functions below accept scalars or numpy arrays that broadcast
+# against each other. Vector results are returned with the x,y,z (or e,n,u)
+# component along the first axis, i.e., shape (3,) for scalar input
+# and (3,N) for N-element input. Use .T to get (N,3).
+
 def geodetic2ecef(lat, lon, alt):
     """
     Convert geodetic coordinates to ECEF.
@@ -38,85 +42,248 @@ def geodetic2ecef(lat, lon, alt):
     x = (a / xi + alt) * cos(lat) * cos(lon)
     y = (a / xi + alt) * cos(lat) * sin(lon)
     z = (a / xi * (1 - esq) + alt) * sin(lat)
-    return(numpy.array([x, y, z]))
+    return(numpy.array(numpy.broadcast_arrays(x, y, z)))
 
 def enu2ecef(lat, lon, alt, e, n, u):
-    """NED (north/east/down) to ECEF coordinate system conversion."""
-    x, y, z = e, n, u
+    """ENU (east/north/up) to ECEF coordinate system conversion."""
     lat, lon = radians(lat), radians(lon)
-    mx = array([[-sin(lon), -sin(lat) * cos(lon), cos(lat) * cos(lon)],
-                [cos(lon), -sin(lat) * sin(lon), cos(lat) * sin(lon)],
-                [0, cos(lat), sin(lat)]])
-    enu = array([x, y, z])
-    res = dot(mx,enu)
-    return(res)
+    slat, clat = sin(lat), cos(lat)
+    slon, clon = sin(lon), cos(lon)
+    # rows of the ENU -> ECEF rotation matrix applied component-wise,
+    # so that arrays of positions and directions broadcast
+    x = -slon * e - slat * clon * n + clat * clon * u
+    y = clon * e - slat * slon * n + clat * slon * u
+    z = clat * n + slat * u
+    return(numpy.array(numpy.broadcast_arrays(x, y, z)))
 
 def ned2ecef(lat, lon, alt, n, e, d):
     """NED (north/east/down) to ECEF coordinate system conversion."""
-    x, y, z = e, n, -1.0*d
-    lat, lon = radians(lat), radians(lon)
-    mx = array([[-sin(lon), -sin(lat) * cos(lon), cos(lat) * cos(lon)],
-                [cos(lon), -sin(lat) * sin(lon), cos(lat) * sin(lon)],
-                [0, cos(lat), sin(lat)]])
-    enu = array([x, y, z])
-    res = dot(mx,enu)
-    return(res)
+    return(enu2ecef(lat, lon, alt, e, n, -1.0*numpy.asarray(d)))
 
 def azel_ecef(lat, lon, alt, az, el):
     """Radar pointing (az,el) degrees to unit vector in ECEF."""
-    return(ned2ecef(lat,lon,alt,
-                    cos(-radians(az))*cos(radians(el)),
-                    -sin(-radians(az))*cos(radians(el)),
-                    -sin(radians(el))))
+    az, el = radians(az), radians(el)
+    return(enu2ecef(lat, lon, alt,
+                    sin(az)*cos(el),
+                    cos(az)*cos(el),
+                    sin(el)))
+
+def _geodetic_out(x, y, z, out):
+    """ Broadcast ECEF inputs and allocate the (3,...) lat, lon, h output if needed.
+        A given output array must be float64 with shape (3,)+(broadcast shape of x, y, z). """
+    x, y, z = numpy.broadcast_arrays(x, y, z)
+    if out is None:
+        out = numpy.empty((3,)+x.shape)
+    elif not isinstance(out, numpy.ndarray) or out.shape != (3,)+x.shape or out.dtype != numpy.float64:
+        raise ValueError("out must be a float64 array of shape %s, not %s %s"%(
+            str((3,)+x.shape), getattr(out, "dtype", type(out).__name__), str(numpy.shape(out))))
+    return(x, y, z, out)
 
-def ecef2geodetic(x, y, z):
+def _lon_h(x, y, z, r, lat_rad, out):
+    """ Longitude and the latitude dependent height formula, which is accurate also near the poles. """
+    lat_out, lon_out, h_out = out[0, ...], out[1, ...], out[2, ...]
+    slat = sin(lat_rad)
+    numpy.multiply(r, cos(lat_rad), out=h_out)
+    h_out += z*slat
+    h_out -= a*sqrt(1.0 - esq*slat*slat)
+    numpy.degrees(lat_rad, out=lat_out)
+    numpy.arctan2(y, x, out=lon_out)
+    numpy.degrees(lon_out, out=lon_out)
+    return(out)
+
+def ecef2geodetic_zhu(x, y, z, out=None):
     """Convert ECEF coordinates to geodetic.
     J. Zhu, "Conversion of Earth-centered Earth-fixed coordinates \
     to geodetic coordinates," IEEE Transactions on Aerospace and \
     Electronic Systems, vol. 30, pp. 957-961, 1994."""
+    x, y, z, out = _geodetic_out(x, y, z, out)
     r = sqrt(x * x + y * y)
     Esq = a * a - b * b
     F = 54 * b * b * z * z
     G = r * r + (1 - esq) * z * z - esq * Esq
-    C = (esq * esq * F * r * r) / (pow(G, 3))
+    C = (esq * esq * F * r * r) / (G * G * G)
     S = cbrt(1 + C + sqrt(C * C + 2 * C))
-    P = F / (3 * pow((S + 1 / S + 1), 2) * G * G)
+    P = F / (3 * (S + 1 / S + 1)**2 * G * G)
     Q = sqrt(1 + 2 * esq * esq * P)
     r_0 =  -(P * esq * r) / (1 + Q) + sqrt(0.5 * a * a*(1 + 1.0 / Q) - \
         P * (1 - esq) * z * z / (Q * (1 + Q)) - 0.5 * P * r * r)
-    U = sqrt(pow((r - esq * r_0), 2) + z * z)
-    V = sqrt(pow((r - esq * r_0), 2) + (1 - esq) * z * z)
+    U = sqrt((r - esq * r_0)**2 + z * z)
+    V = sqrt((r - esq * r_0)**2 + (1 - esq) * z * z)
     Z_0 = b * b * z / (a * V)
-    h = U * (1 - b * b / (a * V))
-    lat = arctan((z + e1sq * Z_0) / r)
-    lon = arctan2(y, x)
-    return(array([degrees(lat), degrees(lon), h]))
+    lat_out, lon_out, h_out = out[0, ...], out[1, ...], out[2, ...]
+    numpy.multiply(U, 1 - b * b / (a * V), out=h_out)
+    numpy.degrees(arctan((z + e1sq * Z_0) / r), out=lat_out)
+    numpy.arctan2(y, x, out=lon_out)
+    numpy.degrees(lon_out, out=lon_out)
+    return(out)
+
+def ecef2geodetic_bowring(x, y, z, out=None):
+    """Convert ECEF coordinates to geodetic with one iteration of Bowring's method.
+    B. R. Bowring, "Transformation from spatial to geographical coordinates,"
+    Survey Review, vol. 23, pp. 323-327, 1976."""
+    x, y, z, out = _geodetic_out(x, y, z, out)
+    r = sqrt(x * x + y * y)
+    # parametric latitude of the initial guess
+    beta = arctan2(a * z, b * r)
+    sb = sin(beta)
+    cb = cos(beta)
+    lat = arctan2(z + e1sq * b * sb * sb * sb, r - esq * a * cb * cb * cb)
+    return(_lon_h(x, y, z, r, lat, out))
+
+def ecef2geodetic_newton(x, y, z, out=None, n_iter=2):
+    """Convert ECEF coordinates to geodetic with a fixed number of Newton-Raphson
+    iterations on Bowring's irrational equation for kappa = tan(lat)*r/z,
+    starting from the value on the ellipsoid surface."""
+    x, y, z, out = _geodetic_out(x, y, z, out)
+    r2 = x * x + y * y
+    r = sqrt(r2)
+    z2 = (1 - esq) * z * z
+    kappa = numpy.full(r.shape, 1.0 / (1 - esq))
+    for i in range(n_iter):
+        c = (r2 + z2 * kappa * kappa)**1.5 / (a * esq)
+        kappa = (c + z2 * kappa * kappa * kappa) / (c - r2)
+    lat = arctan2(kappa * z, r)
+    return(_lon_h(x, y, z, r, lat, out))
+
+ecef2geodetic_methods = {"zhu": ecef2geodetic_zhu,
+                         "bowring": ecef2geodetic_bowring,
+                         "newton": ecef2geodetic_newton}
+
+def ecef2geodetic(x, y, z, method="zhu", out=None):
+    """Convert ECEF coordinates to geodetic (lat and lon in degrees, height in meters).
+    @method is one of "zhu" (closed form), "bowring" (one iteration) or "newton" (fixed iterations).
+    See benchmark_ecef2geodetic.py for the accuracy and speed of each.
+    @out is an optional preallocated (3,...) float64 array for the result."""
+    return(ecef2geodetic_methods[method](x, y, z, out=out))
 
 def geodetic_to_az_el_r(obs_lat, obs_lon, obs_h, target_lat, target_lon, target_h):
-    """ When given a observer lat,long,h and target lat,long,h, provide azimuth, elevation, and range to target """
+    """ When given a observer lat,long,h and target lat,long,h, provide azimuth, elevation, and range to target
+        For many targets seen from a fixed observer, local_frame(obs_lat, obs_lon, obs_h).geodetic_to_az_el_r is cheaper.
+    """
+    obs_lat, obs_lon, obs_h, target_lat, target_lon, target_h = numpy.broadcast_arrays(
+        obs_lat, obs_lon, obs_h, target_lat, target_lon, target_h)
     up = ned2ecef(obs_lat, obs_lon, obs_h, 0.0, 0.0, -1.0)
     north = ned2ecef(obs_lat, obs_lon, obs_h, 1.0, 0.0, 0.0)
     east = ned2ecef(obs_lat, obs_lon, obs_h, 0.0, 1.0, 0.0)
-    obs = array(geodetic2ecef(obs_lat, obs_lon, obs_h))
-    target = array(geodetic2ecef(target_lat, target_lon, target_h))
+    obs = geodetic2ecef(obs_lat, obs_lon, obs_h)
+    target = geodetic2ecef(target_lat, target_lon, target_h)
     p_vec = (target-obs)
-    az_p = dot(p_vec,north)*north+dot(p_vec,east)*east
-    azs = sign(dot(p_vec,east))
-    
-    elevation = 90.0-180.0*arccos(dot(p_vec,up)/(sqrt(dot(p_vec,p_vec))*sqrt(dot(up,up))))/math.pi
-    azimuth = azs*180.0*arccos(dot(az_p,north)/(sqrt(dot(az_p,az_p))*sqrt(dot(north,north))))/math.pi
-    target_range = sqrt(dot(p_vec,p_vec))
-    
-    return(array([azimuth, elevation, target_range]))
+    # dot products along the component axis, so that targets can be (3,N)
+    p_up = numpy.sum(p_vec*up, axis=0)
+    p_north = numpy.sum(p_vec*north, axis=0)
+    p_east = numpy.sum(p_vec*east, axis=0)
+    azs = sign(p_east)
+
+    az_p = p_north*north + p_east*east
+
+    target_range = sqrt(numpy.sum(p_vec*p_vec, axis=0))
+    elevation = 90.0-180.0*arccos(p_up/(target_range*sqrt(numpy.sum(up*up, axis=0))))/math.pi
+    azimuth = azs*180.0*arccos(numpy.sum(az_p*north, axis=0)/(sqrt(numpy.sum(az_p*az_p, axis=0))*sqrt(numpy.sum(north*north, axis=0))))/math.pi
+
+    return(numpy.array(numpy.broadcast_arrays(azimuth, elevation, target_range)))
 
 def az_el_r2geodetic(obs_lat, obs_lon, obs_h, az, el, r):
     """ When given a observer lat,long,h and az,el and r, return lat,long,h of target """
+    obs_lat, obs_lon, obs_h, az, el, r = numpy.broadcast_arrays(obs_lat, obs_lon, obs_h, az, el, r)
     x = geodetic2ecef(obs_lat, obs_lon, obs_h) + azel_ecef(obs_lat, obs_lon, obs_h, az, el)*r
     llh = ecef2geodetic(x[0],x[1],x[2])
-    if(llh[1] < 0.0):
-        llh[1] = llh[1]+360.0
+    llh[1] = numpy.where(llh[1] < 0.0, llh[1]+360.0, llh[1])
     return(llh)
 
+class LocalFrame:
+    """ Observer centric east-north-up frame with a precomputed ECEF origin and rotation matrix.
+        All conversions are matrix products of the (3,3) rotation with (3,...) component-first arrays,
+        so the trigonometric functions of the observer position are only evaluated once.
+        Azimuth is in degrees east of north in the range (-180,180], as in geodetic_to_az_el_r.
+    """
+    def __init__(self, lat, lon, alt):
+        self.lat = lat
+        self.lon = lon
+        self.alt = alt
+        self.origin = geodetic2ecef(lat, lon, alt)
+        # columns are the east, north, and up unit vectors in ECEF
+        self.enu2ecef_matrix = numpy.column_stack([enu2ecef(lat, lon, alt, 1.0, 0.0, 0.0),
+                                                   enu2ecef(lat, lon, alt, 0.0, 1.0, 0.0),
+                                                   enu2ecef(lat, lon, alt, 0.0, 0.0, 1.0)])
+        self.ecef2enu_matrix = numpy.ascontiguousarray(self.enu2ecef_matrix.T)
+        # frames are shared through the cache in local_frame, don't allow modifying them
+        for arr in [self.origin, self.enu2ecef_matrix, self.ecef2enu_matrix]:
+            arr.setflags(write=False)
+
+    def _origin(self, ndim):
+        return(self.origin.reshape((3,)+(1,)*(ndim-1)))
+
+    def enu2ecef_vec(self, enu):
+        """ Rotate ENU vectors (3,...) into ECEF direction vectors. """
+        return(numpy.tensordot(self.enu2ecef_matrix, enu, axes=1))
+
+    def ecef2enu_vec(self, ecef):
+        """ Rotate ECEF direction vectors (3,...) into ENU. """
+        return(numpy.tensordot(self.ecef2enu_matrix, ecef, axes=1))
+
+    def enu2ecef(self, enu):
+        """ ENU positions (3,...) relative to the observer to ECEF positions. """
+        enu = numpy.asarray(enu)
+        return(self.enu2ecef_vec(enu) + self._origin(enu.ndim))
+
+    def ecef2enu(self, ecef):
+        """ ECEF positions (3,...) to ENU positions relative to the observer. """
+        ecef = numpy.asarray(ecef)
+        return(self.ecef2enu_vec(ecef - self._origin(ecef.ndim)))
+
+    def ned2ecef(self, ned):
+        """ NED positions (3,...) relative to the observer to ECEF positions. """
+        ned = numpy.asarray(ned)
+        return(self.enu2ecef(numpy.array([ned[1], ned[0], -ned[2]])))
+
+    def ecef2ned(self, ecef):
+        """ ECEF positions (3,...) to NED positions relative to the observer. """
+        enu = self.ecef2enu(ecef)
+        return(numpy.array([enu[1], enu[0], -enu[2]]))
+
+    def geodetic2enu(self, lat, lon, alt):
+        """ Target lat, lon, alt to ENU positions relative to the observer. """
+        return(self.ecef2enu(geodetic2ecef(lat, lon, alt)))
+
+    def enu2geodetic(self, enu):
+        """ ENU positions relative to the observer to target lat, lon, alt. """
+        x = self.enu2ecef(enu)
+        return(ecef2geodetic(x[0], x[1], x[2]))
+
+    def ecef2az_el_r(self, ecef):
+        """ ECEF positions (3,...) to azimuth, elevation (degrees) and range (m). """
+        e, n, u = self.ecef2enu(ecef)
+        r = sqrt(e*e + n*n + u*u)
+        return(numpy.array([degrees(arctan2(e, n)), degrees(numpy.arcsin(u/r)), r]))
+
+    def azel_ecef(self, az, el):
+        """ Pointing (az,el) degrees to unit vectors in ECEF. """
+        az, el = radians(az), radians(el)
+        enu = numpy.array(numpy.broadcast_arrays(sin(az)*cos(el), cos(az)*cos(el), sin(el)))
+        return(self.enu2ecef_vec(enu))
+
+    def az_el_r2ecef(self, az, el, r):
+        """ Azimuth, elevation (degrees) and range (m) to ECEF positions. """
+        u = self.azel_ecef(az, el)*r
+        return(u + self._origin(u.ndim))
+
+    def geodetic_to_az_el_r(self, lat, lon, alt):
+        """ Target lat, lon, alt to azimuth, elevation and range. """
+        return(self.ecef2az_el_r(geodetic2ecef(lat, lon, alt)))
+
+    def az_el_r2geodetic(self, az, el, r):
+        """ Azimuth, elevation and range to target lat, lon, alt. Longitude is in [0,360). """
+        x = self.az_el_r2ecef(az, el, r)
+        llh = ecef2geodetic(x[0], x[1], x[2])
+        llh[1] = numpy.where(llh[1] < 0.0, llh[1]+360.0, llh[1])
+        return(llh)
+
+@functools.lru_cache(maxsize=32)
+def local_frame(lat, lon, alt):
+    """ Cached LocalFrame for an observer. Observers are typically fixed sites, so the
+        frame is built once per (lat, lon, alt). """
+    return(LocalFrame(float(lat), float(lon), float(alt)))
+
 def test_coord():
     result = geodetic2ecef(69.0,19.0,10.0)
 #    print resigrf
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+#
+# Least-squares triangulation of features seen from several camera
+# stations. For each feature, the position x that minimizes the sum of
+# squared perpendicular distances to the lines of sight
+#
+#   p_m + t_m u_m
+#
+# from all stations m is found. With P_m = I - u_m u_m^T the normal
+# equations are
+#
+#   (sum_m P_m) x = sum_m P_m p_m
+#
+# which is a 3x3 system for each feature. All features are solved at
+# once with a batched solve, so thousands of features (or all features
+# of an image sequence, stacked along the feature axis) are cheap.
+#
+# When the lines of sight of a feature are nearly parallel, the system
+# is ill-conditioned and the position along the lines is undetermined.
+# The condition number of each system is checked, and these features are
+# NaN, while all other features are solved as usual. For two lines of
+# sight at a small angle theta, the condition number is about 4/theta^2.
+#
+import numpy as n
+
+import jcoord
+
+def station_positions(lat, lon, alt):
+    """ ECEF positions (3,M) of M stations given in geodetic coordinates. """
+    return(jcoord.geodetic2ecef(n.atleast_1d(lat), n.atleast_1d(lon), n.atleast_1d(alt)))
+
+def look_vectors(lat, lon, alt, az, el):
+    """ Unit vectors (3,M,K) in ECEF for K features seen from M stations.
+        @lat, @lon, @alt are station positions with shape (M,)
+        @az, @el are azimuth and elevation in degrees with shape (M,K).
+    """
+    lat, lon, alt = n.atleast_1d(lat), n.atleast_1d(lon), n.atleast_1d(alt)
+    return(jcoord.azel_ecef(lat[:,None], lon[:,None], alt[:,None], az, el))
+
+def triangulate(pos, u, weights=None, max_cond=1e6):
+    """ Triangulate K features from M stations.
+        @pos station ECEF positions (3,M)
+        @u unit look vectors in ECEF (3,M,K). A NaN look vector marks a
+           feature that was not seen from a station.
+        @weights optional (M,K) weights of each line of sight.
+        @max_cond largest condition number of the normal equations of a feature.
+           The default 1e6 leaves out lines of sight within about 0.1 degrees of parallel.
+
+        Returns (x, ranges, miss):
+          x      ECEF positions of the features (3,K), NaN if the feature is
+                 seen from less than two stations or the lines of sight are
+                 nearly parallel
+          ranges distance along each line of sight to the closest point to x (M,K)
+          miss   perpendicular distance from x to each line of sight (M,K)
+    """
+    pos = n.asarray(pos, dtype=n.float64)
+    u = n.asarray(u, dtype=n.float64)
+    n_stations = u.shape[1]
+    n_features = u.shape[2]
+    if weights is None:
+        weights = n.ones([n_stations, n_features])
+    seen = n.all(n.isfinite(u), axis=0)
+    w = n.where(seen, weights, 0.0)
+    u = n.where(seen[None,:,:], u, 0.0)
+
+    # A_k = sum_m w_mk (I - u_mk u_mk^T)
+    A = -n.einsum("mk,imk,jmk->kij", w, u, u)
+    A += n.sum(w, axis=0)[:,None,None]*n.eye(3)[None,:,:]
+    # b_k = sum_m w_mk (p_m - (u_mk . p_m) u_mk)
+    up = n.einsum("imk,im->mk", u, pos)
+    b = n.einsum("mk,im->ki", w, pos) - n.einsum("mk,imk->ki", w*up, u)
+
+    # at least two lines of sight are needed, and they can't be (nearly) parallel
+    ok = n.sum(seen, axis=0) >= 2
+    with n.errstate(divide="ignore", invalid="ignore"):
+        ok[ok] = n.linalg.cond(A[ok]) <= max_cond
+    A[~ok] = n.eye(3)
+    x = n.linalg.solve(A, b[:,:,None])[:,:,0]
+    x[~ok] = n.nan
+    x = x.T
+
+    # distance along the line of sight and miss distance from each station
+    d = x[:,None,:] - pos[:,:,None]
+    ranges = n.sum(d*u, axis=0)
+    miss = n.sqrt(n.sum((d - ranges[None,:,:]*u)**2, axis=0))
+    ranges[~seen] = n.nan
+    miss[~seen] = n.nan
+    return(x, ranges, miss)
+
+def triangulate_azel(lat, lon, alt, az, el, weights=None):
+    """ Triangulate K features given in azimuth and elevation (degrees, shape (M,K))
+        from M stations at geodetic positions @lat, @lon, @alt (shape (M,)).
+        Returns (llh, ranges, miss), where llh is the geodetic lat, lon, height (3,K)
+        of the features and ranges and miss are as in triangulate.
+    """
+    pos = station_positions(lat, lon, alt)
+    u = look_vectors(lat, lon, alt, az, el)
+    x, ranges, miss = triangulate(pos, u, weights=weights)
+    llh = jcoord.ecef2geodetic(x[0], x[1], x[2])
+    return(llh, ranges, miss)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+#
+# Columnar cache of a multi-day meteor radar archive.
+#
+# The archive has one HDF5 file per day, each with the datasets of
+# doppler_data.h5 (see read_smr_data.py). Opening and reading hundreds of
+# files for every analysis is slow, so the detections of all files are
+# written once into a cache directory with one .npy file per column:
+#
+#   t.npy        float64 unix seconds, sorted
+#   height.npy, doppler.npy, k_east.npy, k_north.npy, k_up.npy   float32
+#
+# float32 keeps heights to better than 1 cm, Doppler shifts to 1e-7
+# relative precision and the wave vectors to 1e-7 relative precision. The
+# times need float64 (float32 unix seconds have a resolution of minutes).
+#
+# The columns are opened as memory maps, so a query only reads the rows
+# that it returns. index.npz holds the list of source files, with their
+# sizes and modification times to detect a stale cache, and a time index
+# with the first row of each hour, so that a time range query is two
+# lookups into the index and a search within one hour of rows.
+#
+import os
+import glob
+import numpy as n
+import numpy.lib.format as nlf
+import h5py
+
+import smr_wind
+
+columns = ["t", "height", "doppler", "k_east", "k_north", "k_up"]
+column_dtypes = {"t": n.float64, "height": n.float32, "doppler": n.float32,
+                 "k_east": n.float32, "k_north": n.float32, "k_up": n.float32}
+
+def scan_files(data_dir, pattern="*.h5"):
+    """ Sorted list of archive files, and their sizes and modification times. """
+    fnames = sorted(glob.glob(os.path.join(data_dir, pattern)))
+    stats = [os.stat(f) for f in fnames]
+    return(fnames, n.array([s.st_size for s in stats], dtype=n.int64), n.array([s.st_mtime for s in stats]))
+
+class SmrArchive:
+    """ Memory-mapped columnar cache of meteor radar detections.
+        Use SmrArchive.open(cache_dir, data_dir) to open the cache, building or rebuilding
+        it from the HDF5 files in data_dir when needed.
+    """
+    # rows of the time index (s)
+    index_step = 3600.0
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        idx = n.load(os.path.join(cache_dir, "index.npz"))
+        self.files = list(idx["files"])
+        self.sizes = idx["sizes"]
+        self.mtimes = idx["mtimes"]
+        self.index_t0 = float(idx["index_t0"])
+        self.index_rows = idx["index_rows"]
+        self.data = {c: n.load(os.path.join(cache_dir, "%s.npy"%(c)), mmap_mode="r") for c in columns}
+
+    @classmethod
+    def open(cls, cache_dir, data_dir=None, pattern="*.h5"):
+        """ Open the cache. When data_dir is given, the cache is (re)built if it doesn't exist
+            or if files have been added, removed or modified in data_dir since it was built. """
+        if data_dir is not None:
+            fnames, sizes, mtimes = scan_files(data_dir, pattern)
+            if not cls.is_current(cache_dir, fnames, sizes, mtimes):
+                cls.build(cache_dir, fnames)
+        return(cls(cache_dir))
+
+    @staticmethod
+    def is_current(cache_dir, fnames, sizes, mtimes):
+        """ True if the cache was built from exactly these files. """
+        fname = os.path.join(cache_dir, "index.npz")
+        if not os.path.exists(fname):
+            return(False)
+        idx = n.load(fname)
+        return(list(idx["files"]) == [os.path.abspath(f) for f in fnames]
+               and n.array_equal(idx["sizes"], sizes) and n.array_equal(idx["mtimes"], mtimes))
+
+    @classmethod
+    def build(cls, cache_dir, fnames):
+        """ Write the detections of the files into the cache. The files are read one at a time,
+            so the memory use is set by the largest file. """
+        os.makedirs(cache_dir, exist_ok=True)
+        # first pass: number of detections and time span of each file
+        counts = []
+        t_first = []
+        for f in fnames:
+            with h5py.File(f, "r") as h:
+                t = h["t_unix_sec"][()]
+            counts.append(len(t))
+            t_first.append(n.min(t) if len(t) > 0 else n.inf)
+        n_rows = int(n.sum(counts))
+        out = {c: nlf.open_memmap(os.path.join(cache_dir, "%s.npy"%(c)), mode="w+",
+                                  dtype=column_dtypes[c], shape=(n_rows,)) for c in columns}
+        # second pass: daily files are nearly disjoint in time, so writing them in the order
+        # of their first detection, each sorted by time, gives a sorted file in most cases.
+        row = 0
+        for fi in n.argsort(t_first, kind="stable"):
+            d = smr_wind.read_smr(fnames[fi])
+            order = n.argsort(d["t"], kind="stable")
+            for c in columns:
+                out[c][row:row+counts[fi]] = d[c][order]
+            row += counts[fi]
+        t = out["t"]
+        if n_rows > 1 and n.any(t[1:] < t[:-1]):
+            # files overlap in time. sort all rows.
+            order = n.argsort(t, kind="stable")
+            for c in columns:
+                out[c][:] = out[c][order]
+        for c in columns:
+            out[c].flush()
+
+        # row of the first detection at or after each hour
+        if n_rows > 0:
+            index_t0 = n.floor(t[0]/cls.index_step)*cls.index_step
+            edges = n.arange(index_t0, t[-1] + cls.index_step, cls.index_step)
+            index_rows = n.searchsorted(t, edges, side="left")
+        else:
+            index_t0 = 0.0
+            index_rows = n.zeros(1, dtype=n.int64)
+        sizes = n.array([os.stat(f).st_size for f in fnames], dtype=n.int64)
+        mtimes = n.array([os.stat(f).st_mtime for f in fnames])
+        n.savez(os.path.join(cache_dir, "index.npz"), files=n.array([os.path.abspath(f) for f in fnames]),
+                sizes=sizes, mtimes=mtimes, index_t0=index_t0, index_rows=index_rows)
+        del out
+
+    def __len__(self):
+        return(len(self.data["t"]))
+
+    @property
+    def t_range(self):
+        """ (first, last) detection time (unix seconds). """
+        t = self.data["t"]
+        return((t[0], t[-1]) if len(t) > 0 else (n.nan, n.nan))
+
+    def _row(self, t):
+        # first row with time >= t, using the time index to limit the search to one hour of rows
+        t_col = self.data["t"]
+        k = int(n.floor((t - self.index_t0)/self.index_step))
+        if k < 0:
+            return(0)
+        if k >= len(self.index_rows):
+            return(len(t_col))
+        i0 = self.index_rows[k]
+        i1 = self.index_rows[k+1] if k+1 < len(self.index_rows) else len(t_col)
+        return(i0 + int(n.searchsorted(t_col[i0:i1], t, side="left")))
+
+    def row_slice(self, t0=None, t1=None):
+        """ Slice of rows with t0 <= t < t1 (unix seconds). """
+        i0 = 0 if t0 is None else self._row(t0)
+        i1 = len(self) if t1 is None else self._row(t1)
+        return(slice(i0, max(i0, i1)))
+
+    def query(self, t0=None, t1=None, h_range=None, columns=columns, dtype=n.float64):
+        """ Detections with t0 <= t < t1 and h_range[0] <= height < h_range[1].
+            Returns a dict of arrays as smr_wind.read_smr(), converted to dtype
+            (None keeps the float32 columns of the cache). """
+        sl = self.row_slice(t0, t1)
+        res = {c: self.data[c][sl] for c in columns}
+        if h_range is not None:
+            h = self.data["height"][sl]
+            ok = (h >= h_range[0]) & (h < h_range[1])
+            res = {c: v[ok] for c, v in res.items()}
+        if dtype is not None:
+            res = {c: n.asarray(v, dtype=n.float64 if c == "t" else dtype) for c, v in res.items()}
+        else:
+            res = {c: n.array(v) for c, v in res.items()}
+        return(res)
+
+if __name__ == "__main__":
+    import time
+    import shutil
+    import tempfile
+
+    # synthetic archive with 31 daily files of 20000 detections
+    tmp = tempfile.mkdtemp()
+    data_dir = os.path.join(tmp, "data")
+    cache_dir = os.path.join(tmp, "cache")
+    os.makedirs(data_dir)
+    rng = n.random.default_rng(0)
+    day0 = 1672531200.0
+    n_per_day = 20000
+    for day in range(31):
+        t = n.sort(day0 + day*86400 + rng.uniform(0, 86400, n_per_day))
+        el = rng.uniform(n.radians(20), n.radians(80), n_per_day)
+        az = rng.uniform(0, 2*n.pi, n_per_day)
+        k = 4.0*n.pi/(3e8/32.55e6)
+        with h5py.File(os.path.join(data_dir, "smr_%02d.h5"%(day)), "w") as h:
+            h["t_unix_sec"] = t
+            h["height"] = rng.normal(90e3, 5e3, n_per_day)
+            h["doppler_hertz"] = rng.normal(0, 10, n_per_day)
+            h["k_radar_east"] = -k*n.cos(el)*n.sin(az)
+            h["k_radar_north"] = -k*n.cos(el)*n.cos(az)
+            h["k_radar_up"] = -k*n.sin(el)
+
+    t0 = time.perf_counter()
+    fnames = sorted(glob.glob(os.path.join(data_dir, "*.h5")))
+    d = [smr_wind.read_smr(f) for f in fnames]
+    t1 = time.perf_counter()
+    print("Reading %d files: %1.3f s"%(len(fnames), t1-t0))
+
+    t0 = time.perf_counter()
+    a = SmrArchive.open(cache_dir, data_dir)
+    t1 = time.perf_counter()
+    print("Building the cache: %1.3f s"%(t1-t0))
+
+    t0 = time.perf_counter()
+    a = SmrArchive.open(cache_dir, data_dir)
+    q = a.query(day0, day0 + 31*86400, h_range=(80e3, 100e3))
+    t1 = time.perf_counter()
+    print("Opening the cache and reading one month: %1.3f s, %d detections"%(t1-t0, len(q["t"])))
+
+    t0 = time.perf_counter()
+    q = a.query(day0 + 10.5*86400, day0 + 10.5*86400 + 3600, h_range=(80e3, 100e3))
+    t1 = time.perf_counter()
+    ref = n.concatenate([x["t"] for x in d])
+    h = n.concatenate([x["height"] for x in d])
+    ok = (ref >= day0 + 10.5*86400) & (ref < day0 + 10.5*86400 + 3600) & (h >= 80e3) & (h < 100e3)
+    print("One hour query: %1.2g s, %d detections (%d expected)"%(t1-t0, len(q["t"]), n.sum(ok)))
+    shutil.rmtree(tmp)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+#
+# Outlier resistant meteor radar wind estimates.
+#
+# The least-squares fit of smr_wind.estimate_winds() is biased by
+# detections with a wrong Doppler shift (e.g., misidentified echoes). Here
+# the fit is repeated with iteratively reweighted least squares (IRLS):
+#
+#   r_i = m_i - a_i . v           residual of detection i
+#   s   = 1.4826 median(|r - median(r)|)   robust scale of the bin
+#   w_i = psi(r_i/s)/(r_i/s)      weight of detection i
+#
+# with the Huber or Tukey biweight function, or with median-based
+# rejection, where w_i = 0 for |r_i - median(r)| > n_sigma s and 1 otherwise.
+#
+# All bins are updated at once: the medians of all bins are found with one
+# sort of the residuals by (bin, value), and the weighted normal equations
+# with the bincount sums of smr_wind. The iteration is stopped separately
+# for each bin when the wind changes by less than tol, and the detections
+# of the converged bins are left out of the following iterations.
+#
+import numpy as n
+
+import smr_wind
+
+def huber_weights(u, c=1.345):
+    """ Huber weights of the normalized residuals u = r/s. """
+    a = n.abs(u)
+    return(n.where(a <= c, 1.0, c/n.maximum(a, c)))
+
+def tukey_weights(u, c=4.685):
+    """ Tukey biweight weights of the normalized residuals u = r/s. """
+    return(n.where(n.abs(u) < c, (1.0 - (u/c)**2)**2, 0.0))
+
+def rejection_weights(u, c=3.0):
+    """ Weight 0 for detections with |u| > c and 1 otherwise. """
+    return(n.where(n.abs(u) <= c, 1.0, 0.0))
+
+weight_functions = {"huber": huber_weights,
+                    "tukey": tukey_weights,
+                    "median": rejection_weights}
+
+def bin_median(values, bins, n_bins):
+    """ Median of the values in each bin, NaN for empty bins. Detections with bin index -1 are skipped. """
+    ok = bins >= 0
+    v = values[ok]
+    b = bins[ok]
+    # sort by (bin, value) with one float sort of bin + u, where u in [0, 0.5] is increasing with value.
+    # this is several times faster than lexsort. Values closer than ~1e-16*n_bins of their range may
+    # be swapped, which changes the median by less than that.
+    v_range = n.max(v) - n.min(v) if len(v) > 0 else 0.0
+    u = 0.5*(v - n.min(v))/v_range if v_range > 0 else n.zeros(len(v))
+    order = n.argsort(b + u)
+    v = v[order]
+    counts = n.bincount(b, minlength=n_bins)
+    start = n.zeros(n_bins, dtype=n.int64)
+    start[1:] = n.cumsum(counts)[:-1]
+    med = n.full(n_bins, n.nan)
+    nz = counts > 0
+    med[nz] = 0.5*(v[start[nz] + (counts[nz]-1)//2] + v[start[nz] + counts[nz]//2])
+    return(med)
+
+def robust_scale(r, bins, n_bins):
+    """ Median and scaled median absolute deviation 1.4826 MAD of the residuals of each bin. """
+    med = bin_median(r, bins, n_bins)
+    mad = bin_median(n.abs(r - med[n.maximum(bins, 0)]), bins, n_bins)
+    return(med, 1.4826*mad)
+
+def robust_winds(t, height, doppler, k_east, k_north, k_up=None, dh=2e3, dt=3600.0,
+                 h_range=None, t_range=None, n_components=2, method="huber", c=None,
+                 max_iter=20, tol=1e-3):
+    """ Winds in (height, time) bins with iteratively reweighted least squares.
+        @method "huber", "tukey" or "median" (rejection of residuals further than c
+          robust standard deviations from the median)
+        @c tuning constant in units of the robust standard deviation. By default
+          1.345 (huber), 4.685 (tukey) or 3 (median).
+        @max_iter maximum number of reweighting iterations
+        @tol a bin has converged when no wind component changes by more than tol (m/s)
+        The other arguments are as in smr_wind.estimate_winds(). Returns the same dict,
+        computed with the final weights, with the weight of each detection, the number of
+        detections with non-zero weight, and the number of iterations and convergence flag of each bin.
+    """
+    weight_fun = weight_functions[method]
+    kwargs = {} if c is None else {"c": c}
+
+    # ordinary least-squares starting point
+    res = smr_wind.estimate_winds(t, height, doppler, k_east, k_north, k_up, dh=dh, dt=dt,
+                                  h_range=h_range, t_range=t_range, n_components=n_components)
+    A = smr_wind.design_matrix(k_east, k_north, k_up, n_components)
+    bins = res["bins"]
+    n_bins = res["n_meas"].size
+    x = res["wind"].reshape(n_bins, n_components).copy()
+    w = n.ones(len(doppler))
+    active = n.isfinite(x[:, 0])
+    n_iter = n.zeros(n_bins, dtype=n.int64)
+    converged = n.zeros(n_bins, dtype=bool)
+    in_bin = bins >= 0
+
+    for i in range(max_iter):
+        # only the detections of bins that are still iterating
+        sel = n.flatnonzero(in_bin & active[n.maximum(bins, 0)])
+        if len(sel) == 0:
+            break
+        b = bins[sel]
+        r = doppler[sel] - n.sum(A[sel]*x[b], axis=1)
+        med, s = robust_scale(r, b, n_bins)
+        # a bin with more than half of the residuals equal has zero MAD
+        s = n.maximum(s, n.finfo(float).tiny)
+        if method == "median":
+            w_sel = weight_fun((r - med[b])/s[b], **kwargs)
+        else:
+            w_sel = weight_fun(r/s[b], **kwargs)
+        AtA, Atm, _ = smr_wind.normal_equations(A[sel], doppler[sel], b, n_bins, w_sel)
+        n_used = n.bincount(b[w_sel > 0], minlength=n_bins)
+        x_new, _ = smr_wind.solve_normal_equations(AtA, Atm, n_used)
+
+        w[sel] = w_sel
+        n_iter[active] += 1
+        dx = n.max(n.abs(x_new - x), axis=1)
+        x[active] = x_new[active]
+        done = active & (dx <= tol)
+        converged[done] = True
+        # bins that lost their solution (too many rejected detections) also stop
+        active &= ~done & n.isfinite(x_new[:, 0])
+
+    res = smr_wind.estimate_winds(t, height, doppler, k_east, k_north, k_up, dh=dh, dt=dt,
+                                  h_range=res["h_edges"][[0, -1]], t_range=res["t_edges"][[0, -1]],
+                                  n_components=n_components, weights=w)
+    shape = res["n_meas"].shape
+    res["weights"] = w
+    res["n_used"] = n.bincount(bins[in_bin & (w > 0)], minlength=n_bins).reshape(shape)
+    res["n_iter"] = n_iter.reshape(shape)
+    res["converged"] = converged.reshape(shape)
+    return(res)
+
+if __name__ == "__main__":
+    import time
+    d = smr_wind.read_smr("doppler_data.h5")
+    w = robust_winds(d["t"], d["height"], d["doppler"], d["k_east"], d["k_north"], dh=4e3, dt=3600.0)
+    print("Example file: zonal %1.1f m/s meridional %1.1f m/s (%d of %d detections used, %d iterations)"%(
+        w["wind"][0,0,0], w["wind"][0,0,1], w["n_used"][0,0], w["n_meas"][0,0], w["n_iter"][0,0]))
+
+    # one day of synthetic detections with 5% outliers
+    n_meas = 300000
+    rng = n.random.default_rng(0)
+    t = rng.uniform(0, 86400, n_meas)
+    height = rng.normal(90e3, 5e3, n_meas)
+    el = rng.uniform(n.radians(20), n.radians(80), n_meas)
+    az = rng.uniform(0, 2*n.pi, n_meas)
+    k = 4.0*n.pi/(3e8/32.55e6)
+    k_east = -k*n.cos(el)*n.sin(az)
+    k_north = -k*n.cos(el)*n.cos(az)
+    u = 20.0 + 30.0*n.cos(2*n.pi*t/43200.0)
+    v = -10.0 + 30.0*n.sin(2*n.pi*t/43200.0)
+    doppler = -(k_east*u + k_north*v)/(2*n.pi) + rng.normal(0, 1.0, n_meas)
+    outlier = rng.random(n_meas) < 0.05
+    doppler[outlier] += rng.uniform(5, 50, n.sum(outlier))
+
+    # true mean wind of each bin
+    ok = n.abs(height - 90e3) < 10e3
+    kwargs = {"dh": 2e3, "dt": 3600.0, "h_range": (80e3, 100e3), "t_range": (0, 86400)}
+    truth = smr_wind.estimate_winds(t[ok], height[ok], n.zeros(n.sum(ok)), k_east[ok], k_north[ok], **kwargs)
+    bins = truth["bins"]
+    u_true = n.bincount(bins, weights=u[ok], minlength=truth["n_meas"].size)/n.bincount(bins, minlength=truth["n_meas"].size)
+    v_true = n.bincount(bins, weights=v[ok], minlength=truth["n_meas"].size)/n.bincount(bins, minlength=truth["n_meas"].size)
+    wind_true = n.stack([u_true, v_true], axis=1).reshape(truth["wind"].shape)
+
+    ols = smr_wind.estimate_winds(t, height, doppler, k_east, k_north, **kwargs)
+    print("Least squares: RMS error %1.2f m/s"%(n.sqrt(n.nanmean((ols["wind"] - wind_true)**2))))
+    for method in ["huber", "tukey", "median"]:
+        t0 = time.perf_counter()
+        w = robust_winds(t, height, doppler, k_east, k_north, method=method, **kwargs)
+        dt = time.perf_counter() - t0
+        print("%s: RMS error %1.2f m/s, %1.2f s for %d bins, mean %1.1f iterations, %d bins converged"%(
+            method, n.sqrt(n.nanmean((w["wind"] - wind_true)**2)), dt, w["n_meas"].size,
+            n.mean(w["n_iter"]), n.sum(w["converged"])))
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+#
+# Running meteor radar wind estimates that are updated as new detections
+# arrive.
+#
+# The least-squares wind of a height gate only depends on the detections
+# through the normal equations
+#
+#   A^T A = sum_i a_i a_i^T,   A^T m = sum_i a_i m_i
+#
+# which are sums over detections. A sliding window is then maintained by
+# adding the rows of new detections and subtracting the rows of detections
+# that fall out of the window, instead of recomputing every window from the
+# raw detections. Each update costs O(number of new or expired detections),
+# and solving all height gates is one batched (n_h,p,p) solve.
+#
+# The extended model has a mean wind and tidal components with periods of
+# 24, 12 and 8 hours for each wind component:
+#
+#   u(t) = u_0 + sum_k (a_k cos(2 pi t/P_k) + b_k sin(2 pi t/P_k))
+#
+# The phase of the basis functions is referenced to the unix epoch (UTC),
+# not to the start of the window, so that the accumulated sums stay valid
+# while the window moves.
+#
+import collections
+import numpy as n
+
+import smr_wind
+
+# solar tidal periods (s)
+tidal_periods = [24*3600.0, 12*3600.0, 8*3600.0]
+
+def temporal_basis(t, periods=tidal_periods):
+    """ Basis functions (n_meas, 1+2*len(periods)) of the mean wind and tides at times t (unix seconds). """
+    cols = [n.ones(len(t))]
+    for P in periods:
+        phase = 2.0*n.pi*n.mod(t, P)/P
+        cols.append(n.cos(phase))
+        cols.append(n.sin(phase))
+    return(n.column_stack(cols))
+
+def tidal_design_matrix(t, k_east, k_north, k_up=None, n_components=2, periods=tidal_periods):
+    """ Theory matrix (n_meas, n_components*(1+2*len(periods))) of the mean wind and tides.
+        The unknowns are ordered by wind component: [u_0, a_1, b_1, ..., v_0, a_1, b_1, ...]. """
+    B = temporal_basis(t, periods)
+    K = smr_wind.design_matrix(k_east, k_north, k_up, n_components)
+    return((K[:, :, None]*B[:, None, :]).reshape(len(t), -1))
+
+def tidal_components(x, n_components=2, periods=tidal_periods):
+    """ Mean wind (..., n_components), and the amplitude (m/s) and phase (hours UTC of the maximum)
+        (..., n_components, n_periods) of each tide from the solutions of the tidal model. """
+    x = x.reshape(x.shape[:-1] + (n_components, 1+2*len(periods)))
+    a = x[..., 1::2]
+    b = x[..., 2::2]
+    P_h = n.array(periods)/3600.0
+    phase = n.mod(n.arctan2(b, a)/(2.0*n.pi)*P_h, P_h)
+    return(x[..., 0], n.sqrt(a**2 + b**2), phase)
+
+class SlidingWindowWinds:
+    """ Winds in height gates from the detections in a sliding time window.
+        @h_edges edges of the height gates (m)
+        @window length of the window (s). Detections older than window seconds
+          before the newest time seen are removed.
+        @periods None for a constant wind in the window, or the tidal periods (s)
+          of the extended model, e.g., tidal_periods.
+        @n_components 2 for (east, north), 3 for (east, north, up)
+    """
+    def __init__(self, h_edges, window=3600.0, periods=None, n_components=2):
+        self.h_edges = n.asarray(h_edges, dtype=n.float64)
+        self.window = window
+        self.periods = periods
+        self.n_components = n_components
+        self.n_h = len(self.h_edges) - 1
+        self.n_par = n_components if periods is None else n_components*(1+2*len(periods))
+        self.t_end = -n.inf
+        self.reset()
+
+    def reset(self):
+        """ Remove all detections. """
+        p = self.n_par
+        self.AtA = n.zeros([self.n_h, p, p])
+        self.Atm = n.zeros([self.n_h, p])
+        # sum of w m^2, for the residual variance
+        self.mtm = n.zeros(self.n_h)
+        self.counts = n.zeros(self.n_h, dtype=n.int64)
+        # detections in the window, in the order in which they were added.
+        # each block is (t, gate, A, m, w) sorted by time.
+        self.blocks = collections.deque()
+
+    @property
+    def height(self):
+        return(0.5*(self.h_edges[1:] + self.h_edges[:-1]))
+
+    @property
+    def n_meas(self):
+        return(self.counts.copy())
+
+    def _rows(self, t, k_east, k_north, k_up):
+        if self.periods is None:
+            return(smr_wind.design_matrix(k_east, k_north, k_up, self.n_components))
+        return(tidal_design_matrix(t, k_east, k_north, k_up, self.n_components, self.periods))
+
+    def _update(self, gate, A, m, w, sign):
+        # add (sign=1) or subtract (sign=-1) the detections from the sums of their gates
+        AtA, Atm, counts = smr_wind.normal_equations(A, m, gate, self.n_h, w)
+        self.AtA += sign*AtA
+        self.Atm += sign*Atm
+        self.mtm += sign*n.bincount(gate, weights=w*m**2, minlength=self.n_h)
+        self.counts += sign*counts
+
+    def add(self, t, height, doppler, k_east, k_north, k_up=None, weights=None):
+        """ Add new detections and move the end of the window to the newest detection.
+            Detections outside of the height gates or older than the window are ignored. """
+        t = n.asarray(t, dtype=n.float64)
+        if len(t) == 0:
+            return
+        gate = n.searchsorted(self.h_edges, height, side="right") - 1
+        ok = (gate >= 0) & (gate < self.n_h) & n.isfinite(doppler)
+        t_end = max(self.t_end, n.max(t))
+        ok = ok & (t > t_end - self.window)
+        order = n.argsort(t[ok], kind="stable")
+        idx = n.flatnonzero(ok)[order]
+        k_up = None if k_up is None else n.asarray(k_up)[idx]
+        A = self._rows(t[idx], n.asarray(k_east)[idx], n.asarray(k_north)[idx], k_up)
+        m = n.asarray(doppler, dtype=n.float64)[idx]
+        w = n.ones(len(idx)) if weights is None else n.asarray(weights, dtype=n.float64)[idx]
+        self._update(gate[idx], A, m, w, 1)
+        self.blocks.append((t[idx], gate[idx], A, m, w))
+        self.advance(t_end)
+
+    def advance(self, t_end):
+        """ Move the end of the window to t_end (unix seconds) and remove the detections that
+            are older than t_end - window. """
+        self.t_end = max(self.t_end, t_end)
+        t_min = self.t_end - self.window
+        kept = collections.deque()
+        for t, gate, A, m, w in self.blocks:
+            # each block is sorted by time, so the expired detections are at the start of the block
+            i = n.searchsorted(t, t_min, side="right")
+            if i > 0:
+                self._update(gate[:i], A[:i], m[:i], w[:i], -1)
+            if i < len(t):
+                kept.append((t[i:], gate[i:], A[i:], m[i:], w[i:]))
+        self.blocks = kept
+
+    def rebuild(self):
+        """ Recompute the sums from the detections in the window. Removes the round-off that
+            accumulates after a very large number of add and remove operations. """
+        blocks = self.blocks
+        self.reset()
+        for t, gate, A, m, w in blocks:
+            self._update(gate, A, m, w, 1)
+        self.blocks = blocks
+
+    def estimate(self, max_cond=1e10):
+        """ Solve the model of every height gate.
+            Returns a dict with the solution x (n_h, n_par), its covariance (n_h, n_par, n_par),
+            the number of detections and the residual standard deviation (Hz) in each gate. For the
+            constant wind model, x is the wind (m/s). For the tidal model, x is
+            [u_0, a_1, b_1, ..., v_0, ...], see tidal_components(). Gates without a solution are NaN.
+        """
+        x, AtA_inv = smr_wind.solve_normal_equations(self.AtA, self.Atm, self.counts, max_cond)
+        # sum of squared residuals |m - A x|^2 = m^T m - 2 x^T A^T m + x^T A^T A x
+        ssr = self.mtm - 2.0*n.sum(x*self.Atm, axis=1) + n.einsum("bi,bij,bj->b", x, self.AtA, x)
+        dof = self.counts - self.n_par
+        with n.errstate(invalid="ignore", divide="ignore"):
+            s2 = n.where(dof > 0, n.maximum(ssr, 0.0)/dof, n.nan)
+        result = {"height": self.height,
+                  "t_end": self.t_end,
+                  "x": x,
+                  "cov": s2[:, None, None]*AtA_inv,
+                  "n_meas": self.n_meas,
+                  "residual_std": n.sqrt(s2)}
+        if self.periods is None:
+            result["wind"] = x
+        else:
+            result["mean"], result["amplitude"], result["phase"] = tidal_components(x, self.n_components, self.periods)
+            # wind at the end of the window
+            result["wind"] = n.einsum("hcj,j->hc", x.reshape(self.n_h, self.n_components, -1),
+                                      temporal_basis(n.array([self.t_end]), self.periods)[0])
+        return(result)
+
+def running_winds(t, height, doppler, k_east, k_north, k_up=None, h_edges=None, window=3600.0,
+                  step=600.0, periods=None, n_components=2, dh=2e3):
+    """ Winds of a window of length window that moves in steps of step seconds over the detections.
+        @h_edges height gate edges (m). By default gates of dh meters over the range of the detections,
+          as in smr_wind.estimate_winds.
+        Returns the end times of the windows (n_steps) and the winds (n_steps, n_h, n_components).
+        Each detection is added and removed once. """
+    if h_edges is None:
+        h_edges = n.arange(n.floor(n.min(height)/dh)*dh, n.max(height) + 1.5*dh, dh)
+    order = n.argsort(t, kind="stable")
+    t = t[order]
+    sw = SlidingWindowWinds(h_edges, window, periods, n_components)
+    t_ends = n.arange(t[0] + step, t[-1] + step, step)
+    i_ends = n.searchsorted(t, t_ends, side="right")
+    winds = []
+    i0 = 0
+    for t_end, i1 in zip(t_ends, i_ends):
+        idx = order[i0:i1]
+        sw.add(t[i0:i1], height[idx], doppler[idx], k_east[idx], k_north[idx],
+               None if k_up is None else k_up[idx])
+        sw.advance(t_end)
+        winds.append(sw.estimate()["wind"])
+        i0 = i1
+    return(t_ends, n.array(winds))
+
+if __name__ == "__main__":
+    import time
+    d = smr_wind.read_smr("doppler_data.h5")
+    sw = SlidingWindowWinds(h_edges=[90e3, 98e3], window=3600.0)
+    sw.add(d["t"], d["height"], d["doppler"], d["k_east"], d["k_north"])
+    w = sw.estimate()
+    print("Example file: zonal %1.1f m/s meridional %1.1f m/s (%d detections)"%(w["wind"][0,0], w["wind"][0,1], w["n_meas"][0]))
+
+    # ten days of synthetic detections with a mean wind and tides
+    n_days = 10
+    n_meas = 20000*n_days
+    rng = n.random.default_rng(0)
+    t = n.sort(rng.uniform(0, n_days*86400, n_meas))
+    height = rng.normal(90e3, 5e3, n_meas)
+    el = rng.uniform(n.radians(20), n.radians(80), n_meas)
+    az = rng.uniform(0, 2*n.pi, n_meas)
+    k = 4.0*n.pi/(3e8/32.55e6)
+    k_east = -k*n.cos(el)*n.sin(az)
+    k_north = -k*n.cos(el)*n.cos(az)
+    u = 10.0 + 20.0*n.cos(2*n.pi*(t/86400.0 - 6.0/24)) + 30.0*n.cos(2*n.pi*(t/43200.0 - 3.0/12))
+    v = -5.0 + 15.0*n.cos(2*n.pi*(t/86400.0 - 12.0/24)) + 25.0*n.cos(2*n.pi*(t/43200.0 - 6.0/12))
+    doppler = -(k_east*u + k_north*v)/(2*n.pi) + rng.normal(0, 1.0, n_meas)
+    h_edges = n.arange(70e3, 112e3, 2e3)
+
+    # tidal fit in a four day window moved in one hour steps
+    window = 4*86400.0
+    t0 = time.perf_counter()
+    t_ends, winds = running_winds(t, height, doppler, k_east, k_north, h_edges=h_edges, window=window,
+                                  step=3600.0, periods=tidal_periods)
+    t1 = time.perf_counter()
+    # the same windows recomputed from the raw detections
+    for t_end in t_ends:
+        i0, i1 = n.searchsorted(t, [t_end - window, t_end], side="right")
+        sw = SlidingWindowWinds(h_edges, window=window, periods=tidal_periods)
+        sw.add(t[i0:i1], height[i0:i1], doppler[i0:i1], k_east[i0:i1], k_north[i0:i1])
+        sw.advance(t_end)
+    t2 = time.perf_counter()
+    print("%d windows: incremental %1.2f s, recomputed %1.2f s"%(len(t_ends), t1-t0, t2-t1))
+    print("Max difference to the recomputed last window %1.2g m/s"%(n.nanmax(n.abs(winds[-1] - sw.estimate()["wind"]))))
+
+    w = sw.estimate()
+    gate = n.searchsorted(h_edges, 90e3) - 1
+    print("Mean wind %1.1f %1.1f m/s (true 10 -5)"%tuple(w["mean"][gate]))
+    print("24 h amplitude %1.1f %1.1f m/s phase %1.1f %1.1f h (true 20 15, 6 12)"%(tuple(w["amplitude"][gate, :, 0]) + tuple(w["phase"][gate, :, 0])))
+    print("12 h amplitude %1.1f %1.1f m/s phase %1.1f %1.1f h (true 30 25, 3 6)"%(tuple(w["amplitude"][gate, :, 1]) + tuple(w["phase"][gate, :, 1])))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+#
+# Electron density profiles from frequency-resolved cosmic noise absorption.
+#
+# The absorption (dB) of the O- and X-mode at frequency f on a vertical
+# path is (see ex00/sim_riometer_solution.py)
+#
+#   A(f) = int 4.6e-5 n_e(h) nu(h) / (nu(h)^2 + (omega -+ omega_c(h))^2) dh
+#
+# which is linear in n_e. With the trapezoidal rule on a height grid, the
+# absorption of both modes at all frequencies is one matrix product
+#
+#   a = K n_e,   K[mode, f, h] = 4.6e-5 nu_h / (nu_h^2 + (omega_f -+ omega_c,h)^2) w_h
+#
+# where w_h are the trapezoidal integration weights.
+#
+# The inversion is ill-posed, as the kernels of nearby heights are
+# similar. The profile is the maximum a posteriori estimate with a
+# smoothness prior on the second difference of n_e, and a weak prior on
+# n_e itself:
+#
+#   n_e = (K^T K/sigma^2 + L^T L/sigma_d2^2 + I/sigma_0^2)^-1 K^T a/sigma^2 = M a
+#
+# The kernel depends only on the collision frequency profile, the
+# gyrofrequency and the frequencies, not on the measurements. M is
+# therefore computed once, and all time steps are inverted with one matrix
+# product. Time steps with missing frequencies are grouped by the pattern
+# of the missing values, with one operator for each pattern. The
+# (n_t, n_freq, 3) absorption of riometer_absorption.absorption() is
+# accepted as it is, and its O- and X-mode columns are used.
+#
+# The frequencies only resolve height where the collision frequency is
+# comparable to the wave frequency. Where nu << omega, the kernels of all
+# frequencies have the same 1/omega^2 shape and only the integral of
+# n_e nu over these heights is measured. There the profile is set by the
+# prior, which is seen in the posterior standard deviation.
+#
+import numpy as n
+
+# mode order of the kernel and of the absorption arrays, as in riometer_absorption
+modes = ["O", "X"]
+
+def trapezoid_weights(hgt):
+    """ Weights w such that sum(w*f) is the trapezoidal integral of f over hgt. """
+    dh = n.diff(hgt)
+    w = n.zeros(len(hgt))
+    w[:-1] += 0.5*dh
+    w[1:] += 0.5*dh
+    return(w)
+
+def collision_frequency(n_N2, Te=300.0):
+    """ Effective electron-neutral collision frequency (1/s) from the N2 density (1/m^3)
+        (Brekke, Hargreaves 1969), as in ex00/sim_riometer_solution.py. """
+    return((5/2)*5.4e-10*(n_N2/1e6)*n.sqrt(Te))
+
+def msis_collision_frequency(hgt, lat=69.65, lon=18.96, date="2024-01-01T00:00", Te=300.0):
+    """ Collision frequency profile with the N2 density from MSIS (pymsis). """
+    from pymsis import msis
+    data = msis.run(n.array([n.datetime64(date)]), lon, lat, hgt/1e3, geomagnetic_activity=-1)
+    return(collision_frequency(data[0, 0, 0, :, 1], Te))
+
+def absorption_kernel(hgt, nu_en, freqs, gyrofreq=1.4e6):
+    """ Kernel K (2, n_freq, n_h) that maps n_e (1/m^3) on the height grid hgt (m) to the
+        O- and X-mode absorption (dB).
+        @nu_en collision frequency (1/s) at each height
+        @freqs frequencies (Hz)
+        @gyrofreq electron gyrofrequency (Hz), a scalar or one value per height
+    """
+    omega = 2.0*n.pi*n.asarray(freqs, dtype=n.float64)[:, None]
+    omega_c = 2.0*n.pi*n.broadcast_to(gyrofreq, hgt.shape)[None, :]
+    nu = nu_en[None, :]
+    w = trapezoid_weights(hgt)[None, :]
+    K_X = 4.6e-5*nu/(nu**2.0 + (omega - omega_c)**2.0)*w
+    K_O = 4.6e-5*nu/(nu**2.0 + (omega + omega_c)**2.0)*w
+    return(n.stack([K_O, K_X]))
+
+def forward(K, n_e):
+    """ Absorption (..., 2, n_freq) in dB of electron density profiles n_e (..., n_h). """
+    return(n.einsum("mfh,...h->...mf", K, n_e))
+
+def mode_absorption(A, n_freq):
+    """ O- and X-mode absorption (n_t, 2, n_freq) from absorption in this layout, or from the
+        (n_t, n_freq, 3) O-mode, X-mode and total absorption of riometer_absorption.absorption(). """
+    A = n.asarray(A, dtype=n.float64)
+    if A.ndim == 3 and A.shape[1:] == (2, n_freq):
+        return(A)
+    if A.ndim == 3 and A.shape[1] == n_freq and A.shape[2] in (2, 3):
+        return(A[:, :, 0:2].transpose(0, 2, 1))
+    raise ValueError("Absorption must be (n_t, 2, %d) or (n_t, %d, 3), not %s"%(n_freq, n_freq, str(A.shape)))
+
+def second_difference(n_h):
+    """ (n_h-2, n_h) second difference operator. """
+    L = n.zeros((n_h - 2, n_h))
+    i = n.arange(n_h - 2)
+    L[i, i] = 1.0
+    L[i, i+1] = -2.0
+    L[i, i+2] = 1.0
+    return(L)
+
+class AbsorptionInversion:
+    """ Regularized inversion of O- and X-mode absorption spectra to electron density profiles.
+        @K kernel (2, n_freq, n_h) from absorption_kernel()
+        @sigma standard deviation of the absorption measurements (dB), a scalar or (2, n_freq)
+        @sigma_d2 prior standard deviation of the second difference of n_e between adjacent heights
+          of the grid (1/m^3)
+        @sigma_0 prior standard deviation of n_e (1/m^3)
+    """
+    def __init__(self, K, sigma=0.05, sigma_d2=3e9, sigma_0=1e12):
+        self.K = K
+        self.n_h = K.shape[2]
+        self.G = K.reshape(-1, self.n_h)
+        self.inv_var = n.broadcast_to(1.0/n.asarray(sigma, dtype=n.float64)**2, K.shape[0:2]).reshape(-1)
+        L = second_difference(self.n_h)
+        self.prior = L.T @ L/sigma_d2**2 + n.eye(self.n_h)/sigma_0**2
+        self.M, self.cov = self.operator(n.ones(self.G.shape[0], dtype=bool))
+
+    def operator(self, good):
+        """ Solution operator M (n_h, n_meas) and posterior covariance (n_h, n_h) using only the
+            measurements where good (n_meas,) is True. """
+        G = self.G[good]
+        GtW = G.T*self.inv_var[good][None, :]
+        cov = n.linalg.inv(GtW @ G + self.prior)
+        M = n.zeros((self.n_h, self.G.shape[0]))
+        M[:, good] = cov @ GtW
+        return(M, cov)
+
+    def solve(self, A):
+        """ Electron density profiles (n_t, n_h) from absorption (n_t, 2, n_freq) in dB, or the
+            (n_t, n_freq, 3) absorption of riometer_absorption.absorption().
+            NaN absorption values are left out of the fit of their time step.
+            Returns (n_e, n_e_std), where n_e_std (n_t, n_h) is the posterior standard deviation. """
+        A = mode_absorption(A, self.K.shape[1])
+        A = A.reshape(A.shape[0], -1)
+        good = n.isfinite(A)
+        n_e = n.empty((A.shape[0], self.n_h))
+        n_e_std = n.empty((A.shape[0], self.n_h))
+        # time steps with all measurements with one matrix product
+        full = n.all(good, axis=1)
+        n_e[full] = A[full] @ self.M.T
+        n_e_std[full] = n.sqrt(n.diag(self.cov))[None, :]
+        # the others grouped by the pattern of missing values, packed into bytes for unique()
+        partial = n.flatnonzero(~full)
+        if len(partial) > 0:
+            packed = n.packbits(good[partial], axis=1)
+            _, first, inverse = n.unique(packed, axis=0, return_index=True, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            A_p = n.where(good[partial], A[partial], 0.0)
+            for pi, row in enumerate(first):
+                idx = n.flatnonzero(inverse == pi)
+                M, cov = self.operator(good[partial[row]])
+                n_e[partial[idx]] = A_p[idx] @ M.T
+                n_e_std[partial[idx]] = n.sqrt(n.diag(cov))[None, :]
+        return(n_e, n_e_std)
+
+    def residuals(self, A, n_e):
+        """ Measured minus modelled absorption (n_t, 2, n_freq). """
+        return(mode_absorption(A, self.K.shape[1]) - forward(self.K, n_e))
+
+if __name__ == "__main__":
+    import time
+
+    # isothermal N2 atmosphere (scale height 6.5 km) in place of MSIS
+    hgt = n.arange(60e3, 131e3, 1e3)
+    n_N2 = 1.7e21*n.exp(-(hgt - 70e3)/6.5e3)
+    nu_en = collision_frequency(n_N2)
+    freqs = n.linspace(20e6, 55e6, 141)
+
+    t0 = time.perf_counter()
+    K = absorption_kernel(hgt, nu_en, freqs)
+    t1 = time.perf_counter()
+    print("Kernel (%d modes, %d frequencies, %d heights): %1.2g s"%(K.shape + (t1-t0,)))
+
+    # a day of 10 s time steps with a Chapman layer that moves down and up
+    n_t = 8640
+    rng = n.random.default_rng(0)
+    tt = n.arange(n_t)/n_t
+    h_peak = 95e3 - 10e3*n.sin(n.pi*tt)
+    z = (hgt[None, :] - h_peak[:, None])/5e3
+    n_e_true = 5e10*(1 + 3*n.sin(n.pi*tt)[:, None])*n.exp(0.5*(1 - z - n.exp(-z)))
+    sigma = 0.05
+    A = forward(K, n_e_true) + rng.normal(0, sigma, (n_t, 2, len(freqs)))
+    # some missing frequencies (interference)
+    A[rng.random(n_t) < 0.05, :, 40] = n.nan
+
+    t0 = time.perf_counter()
+    inv = AbsorptionInversion(K, sigma=sigma)
+    t1 = time.perf_counter()
+    n_e, n_e_std = inv.solve(A)
+    t2 = time.perf_counter()
+    print("Operator: %1.3f s, %d time steps: %1.3f s"%(t1-t0, n_t, t2-t1))
+    layer = (hgt > 75e3) & (hgt < 100e3)
+    err = n_e[:, layer] - n_e_true[:, layer]
+    print("75-100 km: RMS error %1.2g m^-3, median posterior std %1.2g m^-3, mean n_e %1.2g m^-3"%(
+        n.sqrt(n.mean(err**2)), n.median(n_e_std[:, layer]), n.mean(n_e_true[:, layer])))
+    print("Errors within two posterior standard deviations: %1.0f%%"%(100*n.mean(n.abs(n_e - n_e_true) < 2*n_e_std)))
+    print("Residual RMS %1.3f dB (noise %1.3f dB)"%(n.sqrt(n.nanmean(inv.residuals(A, n_e)**2)), sigma))
+
+    # the same absorption from riometer power spectra, with the QDC of riometer_absorption.py
+    import riometer_absorption
+    qdc_interp = riometer_absorption.QdcInterpolator.from_file("KIL_QDC_2024-01-03.h5", freq=freqs)
+    timestamps = qdc_interp.t0 + 10.0*n.arange(n_t)
+    quiet = 10.0**(qdc_interp(timestamps)/10.0)
+    power = (0.5*quiet[:, None, :]*10.0**(-A/10.0)).reshape(n_t, 2*len(freqs))
+    t0 = time.perf_counter()
+    A_rio = riometer_absorption.absorption(power, timestamps, qdc_interp)
+    n_e_rio, _ = inv.solve(A_rio)
+    t1 = time.perf_counter()
+    print("From power spectra %s: %1.3f s, max difference %1.2g of the peak n_e"%(
+        str(A_rio.shape), t1-t0, n.max(n.abs(n_e_rio - n_e))/n.max(n_e_true)))
+
+    # the same forward model with the loop and trapezoid of ex00/sim_riometer_solution.py
+    import scipy.integrate as sinteg
+    omega_c = 2.0*n.pi*1.4e6
+    ne = n_e_true[0]
+    A_X = [sinteg.trapezoid(4.6e-5*ne*nu_en/(nu_en**2.0 + (2.0*n.pi*f - omega_c)**2.0), hgt) for f in freqs]
+    print("Max difference to the trapezoid loop %1.2g dB"%(n.max(n.abs(forward(K, ne)[1] - A_X))))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+#
+# Quiet day curve (QDC) from a multi-day spectral riometer archive.
+#
+# The quiet sky noise repeats every sidereal day, while absorption only
+# reduces the received power. The QDC of each frequency is therefore an
+# upper quantile of the total (O + X) power in dB of many days, binned by
+# the phase of the sidereal day,
+#
+#   tau = (t - t0) mod T_sid
+#
+# Instead of keeping all measurements in memory, the power of each
+# (sidereal time bin, frequency) is accumulated into a fixed histogram in
+# dB (by default 0.05 dB resolution between 0 and 80 dB). The histogram is
+# a quantile sketch with bounded memory that does not grow with the number
+# of days, and the quantiles are read from its cumulative sum, with
+# linear interpolation within the histogram bin.
+#
+# The frequencies are independent, so the archive is split into groups of
+# frequency channels, which are processed in parallel, each worker reading
+# only the columns of its channels from each file.
+#
+# The output file has the layout of KIL_QDC_2024-01-03.h5: qdc_data
+# (n_t, n_freq) in dB, qdv_data (n_t, n_freq), freq, t (seconds since t0)
+# and t0 (unix seconds). qdv_data is here the variance of the power in
+# each bin, estimated robustly from the interquartile range, (IQR/1.349)^2.
+# As in KIL_QDC_2024-01-03.h5, t is the start of each sidereal time bin.
+# The bin width (s) is also stored in the attribute bin_width of t.
+# riometer_absorption.read_qdc() places the QDC of every file at the bin
+# centres, and infers the bin width from the spacing of t when the
+# attribute is missing.
+#
+import concurrent.futures
+import numpy as n
+import h5py
+import scipy.signal as ss
+
+from riometer_absorption import sidereal_day
+
+class QdcSketch:
+    """ Histograms of power (dB) in (sidereal time bin, frequency) bins.
+        @n_t number of sidereal time bins
+        @n_freq number of frequencies
+        @db_range (min, max) range of the histograms (dB). Values outside are counted in the edge bins.
+        @resolution width of a histogram bin (dB)
+    """
+    def __init__(self, n_t, n_freq, db_range=(0.0, 80.0), resolution=0.05):
+        self.n_t = n_t
+        self.n_freq = n_freq
+        self.db_min = db_range[0]
+        self.resolution = resolution
+        self.n_levels = int(n.ceil((db_range[1] - db_range[0])/resolution))
+        self.counts = n.zeros((n_t, n_freq, self.n_levels), dtype=n.int64)
+
+    def add(self, t_bin, power_db):
+        """ Add measurements (n_meas, n_freq) in dB, with sidereal time bin indices t_bin (n_meas). """
+        level = n.clip(((power_db - self.db_min)/self.resolution).astype(n.int64), 0, self.n_levels-1)
+        ok = n.isfinite(power_db)
+        idx = (t_bin[:, None]*self.n_freq + n.arange(self.n_freq)[None, :])*self.n_levels + level
+        # unbuffered in-place increment. Faster than bincount, as the histogram has many more bins
+        # than there are measurements in one block.
+        n.add.at(self.counts.reshape(-1), idx[ok], 1)
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def quantile(self, q):
+        """ Quantile q of each (time bin, frequency) (n_t, n_freq) in dB, NaN for empty bins. """
+        cdf = n.cumsum(self.counts, axis=2)
+        total = cdf[:, :, -1]
+        target = q*total
+        # first histogram bin where the cumulative count reaches the target
+        k = n.sum(cdf < target[:, :, None], axis=2)
+        k = n.minimum(k, self.n_levels-1)
+        below = n.take_along_axis(cdf, k[:, :, None], axis=2)[:, :, 0] - n.take_along_axis(self.counts, k[:, :, None], axis=2)[:, :, 0]
+        in_bin = n.take_along_axis(self.counts, k[:, :, None], axis=2)[:, :, 0]
+        with n.errstate(invalid="ignore", divide="ignore"):
+            frac = n.where(in_bin > 0, (target - below)/in_bin, 0.5)
+            return(n.where(total > 0, self.db_min + (k + frac)*self.resolution, n.nan))
+
+def sidereal_bin(timestamps, t0, n_t):
+    """ Index of the sidereal time bin of each timestamp (unix seconds). """
+    tau = n.mod(timestamps - t0, sidereal_day)
+    return(n.minimum((tau/sidereal_day*n_t).astype(n.int64), n_t-1))
+
+def _sketch_channels(args):
+    # histograms of the frequency channels f0:f1 from all files
+    fnames, f0, f1, t0, n_t, db_range, resolution, block_size = args
+    sketch = QdcSketch(n_t, f1 - f0, db_range, resolution)
+    for fname in fnames:
+        with h5py.File(fname, "r") as h:
+            n_freq = len(h["freq"])
+            data = h["data"]
+            timestamps = h["timestamp"][()]
+            for i0 in range(0, len(timestamps), block_size):
+                i1 = min(i0 + block_size, len(timestamps))
+                # total power of the O and X modes
+                power = data[i0:i1, f0:f1] + data[i0:i1, n_freq+f0:n_freq+f1]
+                with n.errstate(divide="ignore", invalid="ignore"):
+                    power_db = 10.0*n.log10(power)
+                sketch.add(sidereal_bin(timestamps[i0:i1], t0, n_t), power_db)
+    return(f0, f1, sketch)
+
+def build_qdc(fnames, t0=None, n_t=144, quantile=0.9, db_range=(0.0, 80.0), resolution=0.05,
+              smoothing_window=7, smoothing_order=3, n_workers=1, channels_per_task=16, block_size=8640):
+    """ Quiet day curve from spectral riometer files.
+        @fnames list of KIL_*.h5 files with data (n_times, 2*n_freq), freq and timestamp
+        @t0 reference time (unix seconds) of the sidereal phase. By default midnight UTC of the first measurement.
+        @n_t number of sidereal time bins
+        @quantile upper quantile of the power used as the quiet level
+        @smoothing_window, smoothing_order periodic Savitzky-Golay smoothing in sidereal time. 0 for none.
+        @n_workers number of processes. The frequency channels are split into groups of channels_per_task.
+        @block_size number of spectra read from a file at a time
+        Returns a dict with qdc_data, qdv_data (n_t, n_freq), freq, t (start of each bin in seconds since t0,
+        int64), bin_width (s) and t0.
+    """
+    fnames = sorted(fnames)
+    with h5py.File(fnames[0], "r") as h:
+        freq = h["freq"][()]
+        if t0 is None:
+            t0 = n.floor(n.min(h["timestamp"][()])/86400.0)*86400.0
+    n_freq = len(freq)
+    tasks = [(fnames, f0, min(f0 + channels_per_task, n_freq), t0, n_t, db_range, resolution, block_size)
+             for f0 in range(0, n_freq, channels_per_task)]
+    qdc = n.zeros((n_t, n_freq))
+    qdv = n.zeros((n_t, n_freq))
+
+    def collect(f0, f1, sketch):
+        qdc[:, f0:f1] = sketch.quantile(quantile)
+        qdv[:, f0:f1] = ((sketch.quantile(0.75) - sketch.quantile(0.25))/1.349)**2
+
+    if n_workers <= 1:
+        for task in tasks:
+            collect(*_sketch_channels(task))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as pool:
+            for res in pool.map(_sketch_channels, tasks):
+                collect(*res)
+
+    if smoothing_window > 0:
+        qdc = ss.savgol_filter(qdc, smoothing_window, smoothing_order, axis=0, mode="wrap")
+    return({"qdc_data": qdc,
+            "qdv_data": qdv,
+            "freq": freq,
+            # starts of the sidereal time bins
+            "t": n.round(n.arange(n_t)*sidereal_day/n_t).astype(n.int64),
+            "bin_width": sidereal_day/n_t,
+            "t0": float(t0),
+            "smoothing": {"type": "savgol", "window": smoothing_window, "order": smoothing_order},
+            "quantile": quantile,
+            "n_files": len(fnames)})
+
+def write_qdc(fname, q):
+    """ Write a quiet day curve from build_qdc() in the layout of KIL_QDC_2024-01-03.h5. """
+    with h5py.File(fname, "w") as h:
+        for k in ["qdc_data", "qdv_data", "freq", "t", "t0"]:
+            h[k] = q[k]
+        h["t"].attrs["bin_width"] = q["bin_width"]
+        for k, v in q["smoothing"].items():
+            h["smoothing/%s"%(k)] = v
+        h.attrs["quantile"] = q["quantile"]
+        h.attrs["n_files"] = q["n_files"]
+
+if __name__ == "__main__":
+    import os
+    import time
+    import shutil
+    import tempfile
+    import riometer_absorption as ra
+
+    # two weeks of synthetic spectra at 10 s cadence from the QDC of KIL_QDC_2024-01-03.h5,
+    # with absorption events and noise
+    qdc_ref = ra.QdcInterpolator.from_file("KIL_QDC_2024-01-03.h5")
+    freq = qdc_ref.freq
+    tmp = tempfile.mkdtemp()
+    rng = n.random.default_rng(0)
+    fnames = []
+    for day in range(14):
+        timestamps = qdc_ref.t0 + day*86400.0 + n.arange(0, 86400.0, 10.0)
+        quiet_db = qdc_ref(timestamps)
+        A = n.zeros(quiet_db.shape)
+        if rng.random() < 0.5:
+            A += rng.uniform(0.5, 3.0)*n.exp(-0.5*((timestamps[:, None] - timestamps[0] - rng.uniform(0, 86400))/3600.0)**2)*(30e6/freq[None, :])**2
+        p_db = quiet_db - A + rng.normal(0, 0.3, quiet_db.shape)
+        p_mode = 0.5*10.0**(p_db/10.0)
+        fname = os.path.join(tmp, "KIL_%02d.h5"%(day))
+        with h5py.File(fname, "w") as h:
+            h["data"] = n.concatenate([p_mode, p_mode], axis=1)
+            h["freq"] = freq
+            h["timestamp"] = timestamps
+        fnames.append(fname)
+
+    for n_workers in [1, 4]:
+        t0 = time.perf_counter()
+        q = build_qdc(fnames, t0=qdc_ref.t0, quantile=0.5, n_workers=n_workers)
+        t1 = time.perf_counter()
+        print("%d days, %d frequencies, %d workers: %1.2f s"%(len(fnames), len(freq), n_workers, t1-t0))
+    write_qdc(os.path.join(tmp, "KIL_QDC.h5"), q)
+    qdc_new = ra.QdcInterpolator.from_file(os.path.join(tmp, "KIL_QDC.h5"))
+    t_test = qdc_ref.t0 + n.arange(0, sidereal_day, 60.0)
+    err = qdc_new(t_test) - qdc_ref(t_test)
+    print("QDC error: median %1.2f dB, RMS %1.2f dB"%(n.median(err), n.sqrt(n.mean(err**2))))
+    shutil.rmtree(tmp)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+#
+# Cosmic noise absorption from the spectral riometer measurements.
+#
+# The absorption is the ratio of the quiet day curve (QDC), the power that
+# would be received from the sky without absorption, to the measured power:
+#
+#   A(t,f) = QDC(t,f) - P(t,f)     (dB)
+#
+# The sky noise follows the rotation of the Earth with respect to the
+# stars, so the QDC is a function of sidereal time. A measurement at unix
+# time T sees the same sky as the QDC day at
+#
+#   tau = (T - t0) mod T_sid,   T_sid = 86164.0905 s
+#
+# where t0 is the start of the QDC day. The times t of a QDC file are the
+# starts of its time bins, and each QDC value is placed at the centre of
+# its bin. The QDC is linearly interpolated in tau, periodically, for all
+# frequencies at once. The interpolation weights only depend on the
+# timestamps, so they are computed once and reused for the O-mode, X-mode
+# and total power.
+#
+# The QDC is the total (O + X) power. The sky noise is unpolarized, so the
+# quiet level of each mode is half of it, QDC - 10 log10(2) dB.
+#
+import collections
+import numpy as n
+import h5py
+
+# length of a sidereal day (s)
+sidereal_day = 86164.0905
+
+modes = ["O", "X", "total"]
+
+InterpolationWeights = collections.namedtuple("InterpolationWeights", ["i0", "i1", "w"])
+
+def read_qdc(fname):
+    """ Read a quiet day curve file. Returns the QDC (n_t, n_freq) in dB, the frequencies (Hz),
+        the sample times (seconds since t0) and t0 (unix seconds).
+        t in the file is the start of each time bin, and the sample times are the bin centres.
+        The bin width is the attribute bin_width of t, as written by qdc_builder.py, or the
+        median spacing of t in files without it, such as KIL_QDC_2024-01-03.h5. """
+    with h5py.File(fname, "r") as h:
+        t = h["t"][()].astype(n.float64)
+        if "bin_width" in h["t"].attrs:
+            bin_width = float(h["t"].attrs["bin_width"])
+        else:
+            bin_width = float(n.median(n.diff(t)))
+        t += 0.5*bin_width
+        return(h["qdc_data"][()], h["freq"][()], t, float(h["t0"][()]))
+
+def read_spectra(fname):
+    """ Read a spectral riometer file. Returns the power (n_t, 2*n_freq), O-mode followed by X-mode,
+        the frequencies (Hz) and the timestamps. """
+    with h5py.File(fname, "r") as h:
+        return(h["data"][()], h["freq"][()], h["timestamp"][()])
+
+class QdcInterpolator:
+    """ Interpolation of a quiet day curve to the measurement times.
+        @qdc (n_t, n_freq) quiet day curve (dB)
+        @qdc_t sample times (seconds since qdc_t0)
+        @qdc_t0 start of the QDC day (unix seconds)
+        @qdc_freq frequencies of the QDC (Hz)
+        @freq frequencies of the measurements (Hz). By default the same as the QDC.
+        @sidereal interpolate in sidereal time. If False, the QDC is used as a function
+          of the time of the (solar) day.
+    """
+    def __init__(self, qdc, qdc_t, qdc_t0, qdc_freq, freq=None, sidereal=True):
+        self.t0 = qdc_t0
+        self.period = sidereal_day if sidereal else 86400.0
+        qdc = n.asarray(qdc, dtype=n.float64)
+        if freq is not None and (len(freq) != len(qdc_freq) or n.any(freq != qdc_freq)):
+            # linear interpolation of the QDC to the measured frequencies, done once
+            qdc = n.array([n.interp(freq, qdc_freq, q) for q in qdc])
+            qdc_freq = freq
+        self.freq = qdc_freq
+        # QDC samples in the order of the phase of the period, with the first sample repeated
+        # one period later, so that interpolation wraps around
+        tau = n.mod(qdc_t, self.period)
+        order = n.argsort(tau)
+        self.tau = n.concatenate([tau[order], [tau[order[0]] + self.period]])
+        self.qdc = n.concatenate([qdc[order], qdc[order[:1]]]).astype(n.float32)
+        self._last = (None, None)
+
+    @classmethod
+    def from_file(cls, fname, freq=None, sidereal=True):
+        qdc, qdc_freq, qdc_t, qdc_t0 = read_qdc(fname)
+        return(cls(qdc, qdc_t, qdc_t0, qdc_freq, freq, sidereal))
+
+    def weights(self, timestamps):
+        """ Interpolation weights for the timestamps (unix seconds). The weights of the last
+            timestamps are kept, and reused when called again with the same timestamps. """
+        timestamps = n.asarray(timestamps, dtype=n.float64)
+        if self._last[0] is not None and n.array_equal(self._last[0], timestamps):
+            return(self._last[1])
+        tau = n.mod(timestamps - self.t0, self.period)
+        # samples before the first QDC sample wrap around to the previous period
+        tau = n.where(tau < self.tau[0], tau + self.period, tau)
+        i1 = n.clip(n.searchsorted(self.tau, tau, side="right"), 1, len(self.tau)-1)
+        i0 = i1 - 1
+        w = ((tau - self.tau[i0])/(self.tau[i1] - self.tau[i0])).astype(n.float32)
+        wts = InterpolationWeights(i0, i1, w)
+        self._last = (timestamps.copy(), wts)
+        return(wts)
+
+    def __call__(self, timestamps):
+        """ QDC (n_t, n_freq) in dB at the timestamps (unix seconds), or at precomputed weights. """
+        wts = timestamps if isinstance(timestamps, InterpolationWeights) else self.weights(timestamps)
+        q = self.qdc[wts.i0]
+        q += wts.w[:, None]*(self.qdc[wts.i1] - q)
+        return(q)
+
+def absorption(power, timestamps, qdc, out=None):
+    """ Absorption (n_t, n_freq, 3) in dB for the O-mode, X-mode and total power.
+        @power (n_t, 2*n_freq) linear power, O-mode followed by X-mode, as in the data files
+        @timestamps measurement times (unix seconds), or InterpolationWeights of them
+        @qdc QdcInterpolator, or precomputed (n_t, n_freq) QDC in dB
+        @out optional (n_t, 3, n_freq) float32 work array
+        The result is a (n_t, n_freq, 3) view of the (n_t, 3, n_freq) work array, where each mode
+        of a spectrum is contiguous in memory, as in the data files.
+    """
+    n_t = power.shape[0]
+    n_freq = power.shape[1]//2
+    if out is None:
+        out = n.empty((n_t, 3, n_freq), dtype=n.float32)
+    q = qdc(timestamps) if callable(qdc) else n.asarray(qdc, dtype=n.float32)
+    # measured power in dB, all done in place in the work array
+    out[:, 0:2, :] = power.reshape(n_t, 2, n_freq)
+    n.add(out[:, 0, :], out[:, 1, :], out=out[:, 2, :])
+    n.log10(out, out=out)
+    out *= -10.0
+    out += q[:, None, :]
+    # quiet level of a single mode is half of the total
+    out[:, 0:2, :] -= 10.0*n.log10(2.0)
+    return(out.transpose(0, 2, 1))
+
+if __name__ == "__main__":
+    import time
+    qdc_interp = QdcInterpolator.from_file("KIL_QDC_2024-01-03.h5")
+    n_freq = len(qdc_interp.freq)
+
+    # one day of 1 s cadence spectra, two days after the QDC day, with a known absorption
+    t0 = qdc_interp.t0 + 2*86400.0
+    timestamps = t0 + n.arange(86400.0)
+    A_true = 2.0*n.exp(-0.5*((timestamps - t0 - 43200.0)/3600.0)**2)[:, None]*(30e6/qdc_interp.freq[None, :])**2
+    quiet = 10.0**(qdc_interp(timestamps)/10.0)
+    p_mode = 0.5*quiet*10.0**(-A_true/10.0)
+    power = n.concatenate([p_mode, p_mode], axis=1)
+
+    t1 = time.perf_counter()
+    wts = qdc_interp.weights(timestamps)
+    A = absorption(power, timestamps, qdc_interp)
+    t2 = time.perf_counter()
+    A = absorption(power, wts, qdc_interp)
+    t3 = time.perf_counter()
+    print("%d spectra with %d frequencies: %1.3f s, %1.3f s with precomputed weights"%(len(timestamps), n_freq, t2-t1, t3-t2))
+    print("Max error %1.2g dB"%(n.max(n.abs(A - A_true[:, :, None]))))
+
+    # sidereal time: the QDC sample at t0 is seen four minutes earlier each day
+    print("QDC at t0 %1.2f dB, at t0 + one sidereal day %1.2f dB, at t0 + 24 h %1.2f dB"%(
+        qdc_interp(qdc_interp.t0 + n.zeros(1))[0, 0], qdc_interp(qdc_interp.t0 + sidereal_day + n.zeros(1))[0, 0],
+        qdc_interp(qdc_interp.t0 + 86400.0 + n.zeros(1))[0, 0]))
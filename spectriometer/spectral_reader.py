@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+#
+# Lazy reader for spectral riometer files (e.g., KIL_2024-01-03.h5).
+#
+# The data array is (n_times, 2*n_freq), with the O-mode power in the
+# first n_freq columns and the X-mode power in the last n_freq columns.
+# When the dataset is stored contiguously and uncompressed, which is the
+# h5py default, it is mapped into memory directly from the file, and the
+# O-mode and X-mode arrays are views of the map that read nothing until
+# they are indexed. Otherwise (chunked or compressed datasets) the same
+# interface reads hyperslabs with h5py.
+#
+# The total power and the conversion to dB need arithmetic, so they are
+# computed block by block into a reusable buffer, in place. The memory use
+# is then set by the block size and not by the length of the file.
+#
+import numpy as n
+import h5py
+
+class SpectralRiometerFile:
+    """ Spectral riometer file. The frequencies and timestamps are read when opened.
+        @block_size number of spectra per block when iterating
+    """
+    def __init__(self, fname, block_size=4096):
+        self.fname = fname
+        self.block_size = block_size
+        self.h = h5py.File(fname, "r")
+        self.freq = self.h["freq"][()]
+        self.timestamps = self.h["timestamp"][()]
+        self.n_freq = len(self.freq)
+        d = self.h["data"]
+        self.shape = d.shape
+        self.dtype = d.dtype
+        offset = d.id.get_offset()
+        if d.chunks is None and d.compression is None and offset is not None:
+            self.data = n.memmap(fname, dtype=d.dtype, mode="r", offset=offset, shape=d.shape)
+        else:
+            self.data = d
+
+    def close(self):
+        self.data = None
+        self.h.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def memory_mapped(self):
+        return(isinstance(self.data, n.memmap))
+
+    @property
+    def o_mode(self):
+        """ O-mode power (n_times, n_freq). A view of the memory map, or a lazy h5py selection. """
+        return(ModeView(self.data, 0, self.n_freq))
+
+    @property
+    def x_mode(self):
+        """ X-mode power (n_times, n_freq). A view of the memory map, or a lazy h5py selection. """
+        return(ModeView(self.data, self.n_freq, 2*self.n_freq))
+
+    def time_slice(self, t0=None, t1=None):
+        """ Slice of time indices with t0 <= timestamp < t1. """
+        i0 = 0 if t0 is None else n.searchsorted(self.timestamps, t0, side="left")
+        i1 = len(self.timestamps) if t1 is None else n.searchsorted(self.timestamps, t1, side="left")
+        return(slice(i0, i1))
+
+    def _block(self, i0, i1, mode, db, out):
+        # power of rows i0:i1 into out (i1-i0, n_freq)
+        nf = self.n_freq
+        if mode == "O":
+            out[:] = self.data[i0:i1, 0:nf]
+        elif mode == "X":
+            out[:] = self.data[i0:i1, nf:2*nf]
+        elif mode == "total":
+            if self.memory_mapped:
+                n.add(self.data[i0:i1, 0:nf], self.data[i0:i1, nf:2*nf], out=out)
+            else:
+                block = self.data[i0:i1, :]
+                n.add(block[:, 0:nf], block[:, nf:2*nf], out=out)
+        else:
+            raise ValueError("Unknown mode %s, use O, X or total"%(mode))
+        if db:
+            n.log10(out, out=out)
+            out *= 10.0
+        return(out)
+
+    def iter_blocks(self, t0=None, t1=None, mode="total", db=False, dtype=n.float32):
+        """ Iterate over blocks (timestamps, power) with t0 <= timestamp < t1. power is a
+            (n_block, n_freq) array of the O, X or total power, in dB if db is True. The same
+            buffer is reused for every block, so copy it to keep it. """
+        sl = self.time_slice(t0, t1)
+        buf = n.empty((self.block_size, self.n_freq), dtype=dtype)
+        for i0 in range(sl.start, sl.stop, self.block_size):
+            i1 = min(i0 + self.block_size, sl.stop)
+            yield((self.timestamps[i0:i1], self._block(i0, i1, mode, db, buf[0:(i1-i0)])))
+
+    def read(self, t0=None, t1=None, mode="total", db=False, dtype=n.float32, out=None):
+        """ Read the O, X or total power with t0 <= timestamp < t1 into one (n_times, n_freq) array.
+            Filled block by block, without temporary arrays of the full size.
+            Returns (timestamps, power). """
+        sl = self.time_slice(t0, t1)
+        if out is None:
+            out = n.empty((sl.stop - sl.start, self.n_freq), dtype=dtype)
+        for i0 in range(sl.start, sl.stop, self.block_size):
+            i1 = min(i0 + self.block_size, sl.stop)
+            self._block(i0, i1, mode, db, out[(i0-sl.start):(i1-sl.start)])
+        return(self.timestamps[sl], out)
+
+class ModeView:
+    """ Columns c0:c1 of the data array, indexed as a (n_times, n_freq) array without reading
+        anything until indexed. """
+    def __init__(self, data, c0, c1):
+        self.data = data
+        self.c0 = c0
+        self.c1 = c1
+
+    @property
+    def shape(self):
+        return((self.data.shape[0], self.c1 - self.c0))
+
+    def __len__(self):
+        return(self.data.shape[0])
+
+    def __getitem__(self, idx):
+        if not isinstance(idx, tuple):
+            idx = (idx,)
+        rows = idx[0]
+        cols = idx[1] if len(idx) > 1 else slice(None)
+        if isinstance(self.data, n.memmap):
+            return(self.data[:, self.c0:self.c1][rows, cols])
+        # h5py: read the rows of the mode, then select the columns
+        return(self.data[rows, self.c0:self.c1][..., cols])
+
+def iter_archive(fnames, t0=None, t1=None, mode="total", db=False, block_size=4096, dtype=n.float32):
+    """ Iterate over blocks (timestamps, power) of several files, e.g., one per day, in time order.
+        Files outside of the time range are skipped after reading their timestamps. """
+    for fname in fnames:
+        with SpectralRiometerFile(fname, block_size) as f:
+            if len(f.timestamps) == 0:
+                continue
+            if (t1 is not None and f.timestamps[0] >= t1) or (t0 is not None and f.timestamps[-1] < t0):
+                continue
+            for block in f.iter_blocks(t0, t1, mode, db, dtype):
+                yield(block)
+
+if __name__ == "__main__":
+    import os
+    import time
+    import shutil
+    import tempfile
+
+    # synthetic day of 1 s cadence spectra
+    tmp = tempfile.mkdtemp()
+    fname = os.path.join(tmp, "KIL_test.h5")
+    n_t = 86400
+    n_freq = 141
+    rng = n.random.default_rng(0)
+    t_start = 1704240000.0
+    with h5py.File(fname, "w") as h:
+        h["freq"] = n.linspace(20e6, 55e6, n_freq)
+        h["timestamp"] = t_start + n.arange(n_t, dtype=n.float64)
+        d = h.create_dataset("data", shape=(n_t, 2*n_freq), dtype=n.float64)
+        for i0 in range(0, n_t, 8640):
+            d[i0:i0+8640] = rng.uniform(1e4, 2e4, (8640, 2*n_freq))
+
+    with SpectralRiometerFile(fname) as f:
+        print("Memory mapped: %s, O-mode view %s"%(f.memory_mapped, str(f.o_mode.shape)))
+        t0 = time.perf_counter()
+        total_db = n.zeros(n_freq)
+        n_spectra = 0
+        for ts, p in f.iter_blocks(mode="total", db=True):
+            total_db += n.sum(p, axis=0)
+            n_spectra += len(ts)
+        t1 = time.perf_counter()
+        print("Mean total power of %d spectra in blocks: %1.2f s"%(n_spectra, t1-t0))
+        ts, p = f.read(t_start + 3600, t_start + 7200, mode="total", db=True)
+        ref = 10.0*n.log10(f.o_mode[3600:7200] + f.x_mode[3600:7200])
+        print("One hour window: %d spectra, max difference %1.2g dB"%(len(ts), n.max(n.abs(p - ref))))
+    shutil.rmtree(tmp)
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+#
+# Multi-resolution spectrogram pyramid for plotting spectral riometer data.
+#
+# A day of 1 s spectra is 86400 columns, far more than there are pixels in
+# a figure. The power in dB is therefore decimated once into levels with
+# time_factor^l times fewer spectra and (up to a minimum number of
+# channels) freq_factor^l times fewer frequencies. Each level stores the
+# minimum, mean and maximum of the original dB values within each cell,
+# so that short events are still visible in the max (or min) image of a
+# coarse level.
+#
+# The pyramid is written into a file next to the data (KIL_2024-01-03.h5
+# -> KIL_2024-01-03.pyramid.h5). It is built in one streaming pass over
+# the data: each level reduces the blocks that it gets from the previous
+# one, and carries the incomplete group of spectra at the end of a block
+# over to the next block.
+#
+# When plotting, the coarsest level that still has at least one spectrum
+# per pixel of the axes in the requested time range is used. Level 0 is the
+# original data, read through spectral_reader. The cells are drawn with
+# pcolormesh on time edges halfway between the spectra, as the spectra are
+# not equally spaced when there are gaps in the data, and gaps are empty.
+#
+import os
+import numpy as n
+import h5py
+
+import spectral_reader
+
+def pyramid_fname(fname):
+    """ Name of the pyramid file of a data file. """
+    return("%s.pyramid.h5"%(os.path.splitext(fname)[0]))
+
+class _Decimator:
+    # min, max, sum and count of groups of time_factor spectra and freq_factor frequencies
+    def __init__(self, time_factor, freq_factor, n_freq):
+        self.tf = time_factor
+        self.ff = freq_factor
+        self.n_freq_out = int(n.ceil(n_freq/freq_factor))
+        self.pad = self.n_freq_out*freq_factor - n_freq
+        self.carry = None
+
+    def _reduce(self, t, mn, mx, s, c):
+        n_g = int(n.ceil(len(t)/self.tf))
+        pad_t = n_g*self.tf - len(t)
+        def pad(a, value):
+            return(n.pad(a, ((0, pad_t), (0, self.pad)), constant_values=value).reshape(n_g, self.tf, self.n_freq_out, self.ff))
+        t_sum = n.pad(t, (0, pad_t)).reshape(n_g, self.tf).sum(axis=1)
+        t_mean = t_sum/(self.tf - n.concatenate([n.zeros(n_g-1), [pad_t]]))
+        return(t_mean,
+               pad(mn, n.inf).min(axis=(1, 3)),
+               pad(mx, -n.inf).max(axis=(1, 3)),
+               pad(s, 0.0).sum(axis=(1, 3)),
+               pad(c, 0).sum(axis=(1, 3)))
+
+    def feed(self, t, mn, mx, s, c):
+        """ Reduce the complete groups of the block. The remaining spectra are kept for the next block. """
+        if self.carry is not None:
+            t, mn, mx, s, c = [n.concatenate([a, b]) for a, b in zip(self.carry, (t, mn, mx, s, c))]
+        n_full = (len(t)//self.tf)*self.tf
+        self.carry = tuple(a[n_full:] for a in (t, mn, mx, s, c))
+        if n_full == 0:
+            return(None)
+        return(self._reduce(t[:n_full], mn[:n_full], mx[:n_full], s[:n_full], c[:n_full]))
+
+    def flush(self):
+        """ Reduce the last incomplete group. """
+        if self.carry is None or len(self.carry[0]) == 0:
+            return(None)
+        res = self._reduce(*self.carry)
+        self.carry = None
+        return(res)
+
+def build_pyramid(fnames, out_fname=None, mode="total", time_factor=4, freq_factor=2, min_freq=32,
+                  min_samples=512, block_size=16384):
+    """ Build the min/mean/max pyramid of the power in dB of one data file, or of a list of
+        data files in time order (e.g., several days).
+        @out_fname output file. By default the pyramid file of the first data file.
+        @mode O, X or total power
+        @time_factor, freq_factor decimation from one level to the next. Frequencies are
+          only decimated while there are at least min_freq frequencies left.
+        @min_samples levels are added until the coarsest level has fewer spectra than this.
+    """
+    if isinstance(fnames, str):
+        fnames = [fnames]
+    if out_fname is None:
+        out_fname = pyramid_fname(fnames[0])
+    n_total = 0
+    for fname in fnames:
+        with spectral_reader.SpectralRiometerFile(fname) as f:
+            n_total += len(f.timestamps)
+            freq = f.freq
+    # block size a multiple of the decimation, so that most blocks reduce without a carry
+    block_size = max(1, block_size//time_factor)*time_factor
+
+    decimators = []
+    level_freq = [freq]
+    n_t = n_total
+    n_f = len(freq)
+    while n_t > min_samples or len(decimators) == 0:
+        ff = freq_factor if n_f//freq_factor >= min_freq else 1
+        decimators.append(_Decimator(time_factor, ff, n_f))
+        n_f = decimators[-1].n_freq_out
+        n_t = int(n.ceil(n_t/time_factor))
+        # frequency of each decimated channel is the mean of the frequencies of the group
+        f_prev = level_freq[-1]
+        level_freq.append(n.nanmean(n.pad(f_prev, (0, decimators[-1].pad), constant_values=n.nan).reshape(n_f, ff), axis=1))
+
+    with h5py.File(out_fname, "w") as h:
+        h.attrs["mode"] = mode
+        h.attrs["time_factor"] = time_factor
+        h["data_fnames"] = n.array([os.path.abspath(f) for f in fnames], dtype=h5py.string_dtype())
+        h["freq"] = freq
+        out = []
+        for li, dec in enumerate(decimators):
+            g = h.create_group("level_%d"%(li+1))
+            g["freq"] = level_freq[li+1]
+            nf = dec.n_freq_out
+            chunk = (min(4096, max(1, n_total//time_factor**(li+1))), nf)
+            ds = {"t": g.create_dataset("t", shape=(0,), maxshape=(None,), dtype=n.float64, chunks=(chunk[0],))}
+            for k in ["min", "mean", "max"]:
+                ds[k] = g.create_dataset(k, shape=(0, nf), maxshape=(None, nf), dtype=n.float32, chunks=chunk)
+            out.append(ds)
+        h.attrs["n_levels"] = len(decimators)
+
+        def write(li, res):
+            # append a reduced block to level li+1 and pass it on to the next level
+            while res is not None:
+                t, mn, mx, s, c = res
+                ds = out[li]
+                i0 = ds["t"].shape[0]
+                for k in ds:
+                    ds[k].resize(i0 + len(t), axis=0)
+                ds["t"][i0:] = t
+                ds["min"][i0:] = n.where(c > 0, mn, n.nan)
+                ds["max"][i0:] = n.where(c > 0, mx, n.nan)
+                with n.errstate(invalid="ignore", divide="ignore"):
+                    ds["mean"][i0:] = s/c
+                li += 1
+                res = decimators[li].feed(t, mn, mx, s, c) if li < len(decimators) else None
+
+        for t, p_db in spectral_reader.iter_archive(fnames, mode=mode, db=True, block_size=block_size):
+            ok = n.isfinite(p_db)
+            p = n.where(ok, p_db, 0.0)
+            write(0, decimators[0].feed(t, n.where(ok, p_db, n.inf), n.where(ok, p_db, -n.inf), p, ok.astype(n.int64)))
+        for li in range(len(decimators)):
+            write(li, decimators[li].flush())
+    return(out_fname)
+
+class SpectrogramPyramid:
+    """ Pyramid file written by build_pyramid(). Level 0 is the original data. """
+    def __init__(self, fname):
+        self.h = h5py.File(fname, "r")
+        self.mode = self.h.attrs["mode"]
+        self.n_levels = int(self.h.attrs["n_levels"])
+        self.data_fnames = [f.decode() if isinstance(f, bytes) else f for f in self.h["data_fnames"][()]]
+        self.levels = [None] + [self.h["level_%d"%(li)] for li in range(1, self.n_levels+1)]
+        # spectra per time unit at each level, from the times of the coarsest level
+        self.level_t = [None] + [g["t"][()] for g in self.levels[1:]]
+
+    def close(self):
+        self.h.close()
+
+    def n_spectra(self, level, t0, t1):
+        """ Number of spectra of a level between t0 and t1. Level 0 is estimated from level 1. """
+        if level == 0:
+            return(self.h.attrs["time_factor"]*self.n_spectra(1, t0, t1))
+        t = self.level_t[level]
+        return(n.searchsorted(t, t1) - n.searchsorted(t, t0))
+
+    def choose_level(self, t0, t1, n_pixels):
+        """ Coarsest level with at least n_pixels spectra between t0 and t1. """
+        for level in range(self.n_levels, 0, -1):
+            if self.n_spectra(level, t0, t1) >= n_pixels:
+                return(level)
+        return(0)
+
+    def read(self, level, t0=None, t1=None, stat="mean"):
+        """ (t, freq, power_db (n_t, n_freq)) of a level between t0 and t1. stat is min, mean or max,
+            which is the same for the original data in level 0. """
+        if level == 0:
+            blocks = [(t.copy(), p.copy()) for t, p in spectral_reader.iter_archive(self.data_fnames, t0, t1, self.mode, db=True)]
+            if len(blocks) == 0:
+                return(n.zeros(0), self.h["freq"][()], n.zeros((0, len(self.h["freq"])), dtype=n.float32))
+            return(n.concatenate([b[0] for b in blocks]), self.h["freq"][()], n.concatenate([b[1] for b in blocks]))
+        t = self.level_t[level]
+        i0 = 0 if t0 is None else n.searchsorted(t, t0, side="left")
+        i1 = len(t) if t1 is None else n.searchsorted(t, t1, side="left")
+        g = self.levels[level]
+        return(t[i0:i1], g["freq"][()], g[stat][i0:i1])
+
+def time_edges(t, p):
+    """ Cell edges (n_t+n_gaps+1) of spectra at times t, and the power (n_t+n_gaps, n_freq) with a NaN
+        row in each gap. Cells extend halfway to the neighbouring spectra, except at gaps longer than
+        1.5 times the median spacing, where they extend half a median spacing and the gap is empty. """
+    dt = n.median(n.diff(t))
+    gap = n.diff(t) > 1.5*dt
+    mid = 0.5*(t[:-1] + t[1:])
+    right = n.where(gap, t[:-1] + 0.5*dt, mid)
+    left = n.where(gap, t[1:] - 0.5*dt, mid)
+    ins = n.flatnonzero(gap)
+    edges = n.concatenate([[t[0] - 0.5*dt], right, [t[-1] + 0.5*dt]])
+    edges = n.insert(edges, ins + 2, left[ins])
+    return(edges, n.insert(p, ins + 1, n.nan, axis=0))
+
+def freq_edges(freq):
+    """ Cell edges (n_freq+1) halfway between the frequencies. """
+    df = n.diff(freq) if len(freq) > 1 else n.ones(1)
+    return(n.concatenate([[freq[0] - 0.5*df[0]], 0.5*(freq[:-1] + freq[1:]), [freq[-1] + 0.5*df[-1]]]))
+
+class SpectrogramPlot:
+    """ Spectrogram of a pyramid in a matplotlib axes. The level is chosen from the time range and the
+        width of the axes in pixels, and it is chosen again when the time axis is zoomed or panned.
+        Gaps in the data are left empty.
+        @stat min, mean or max
+        @oversampling number of spectra per pixel, at least
+    """
+    def __init__(self, ax, pyramid, t0=None, t1=None, stat="mean", vmin=None, vmax=None, cmap="viridis", oversampling=1.0):
+        self.ax = ax
+        self.pyramid = pyramid
+        self.stat = stat
+        self.oversampling = oversampling
+        t_all = pyramid.level_t[pyramid.n_levels]
+        self.t0 = t_all[0] if t0 is None else t0
+        self.t1 = t_all[-1] if t1 is None else t1
+        self.image = None
+        self.level = None
+        self.cmap = cmap
+        self.vmin = vmin
+        self.vmax = vmax
+        self.update(self.t0, self.t1)
+        ax.set_xlim(self.t0, self.t1)
+        ax.callbacks.connect("xlim_changed", self._on_xlim)
+
+    def n_pixels(self):
+        fig = self.ax.figure
+        return(int(self.ax.get_window_extent().width*self.oversampling) if fig.dpi > 0 else 1000)
+
+    def update(self, t0, t1):
+        """ Draw the time range t0, t1 with the level that fits the axes. """
+        level = self.pyramid.choose_level(t0, t1, self.n_pixels())
+        # some margin on both sides, so that small pans don't need a new read
+        margin = 0.5*(t1 - t0)
+        t, freq, p = self.pyramid.read(level, t0 - margin, t1 + margin, self.stat)
+        if len(t) < 2:
+            return
+        # the spectra are not always equally spaced in time, so the cells are drawn with pcolormesh
+        t_edges, p = time_edges(t, p)
+        xlim = self.ax.get_xlim()
+        if self.image is not None:
+            self.image.remove()
+        else:
+            self.ax.set_ylabel("Frequency (MHz)")
+        self.image = self.ax.pcolormesh(t_edges, freq_edges(freq)/1e6, n.ma.masked_invalid(p.T),
+                                        cmap=self.cmap, vmin=self.vmin, vmax=self.vmax)
+        # a new mesh changes the data limits, but not the view
+        self.ax.set_xlim(xlim, emit=False)
+        self.level = level
+        self.t_loaded = (t0 - margin, t1 + margin)
+
+    def _on_xlim(self, ax):
+        t0, t1 = ax.get_xlim()
+        level = self.pyramid.choose_level(t0, t1, self.n_pixels())
+        if level != self.level or t0 < self.t_loaded[0] or t1 > self.t_loaded[1]:
+            self.update(t0, t1)
+
+if __name__ == "__main__":
+    import time
+    import shutil
+    import tempfile
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    # three days of synthetic 1 s spectra with a short absorption spike
+    tmp = tempfile.mkdtemp()
+    rng = n.random.default_rng(0)
+    n_freq = 141
+    fnames = []
+    t_start = 1704240000.0
+    for day in range(3):
+        fname = os.path.join(tmp, "KIL_%02d.h5"%(day))
+        with h5py.File(fname, "w") as h:
+            h["freq"] = n.linspace(20e6, 55e6, n_freq)
+            ts = t_start + day*86400 + n.arange(86400.0)
+            if day == 1:
+                # six hours without data
+                ts = ts[(ts - ts[0] < 3*3600) | (ts - ts[0] >= 9*3600)]
+            h["timestamp"] = ts
+            d = h.create_dataset("data", shape=(len(ts), 2*n_freq), dtype=n.float64)
+            for i0 in range(0, len(ts), 8640):
+                i1 = min(i0 + 8640, len(ts))
+                p = 10.0**(rng.normal(40, 0.5, (i1 - i0, 2*n_freq))/10.0)
+                spike = n.abs(ts[i0:i1] - (t_start + day*86400 + 43200)) < 5
+                p[spike] *= 0.1
+                d[i0:i1] = p
+        fnames.append(fname)
+
+    t0 = time.perf_counter()
+    pyr_fname = build_pyramid(fnames)
+    t1 = time.perf_counter()
+    pyr = SpectrogramPyramid(pyr_fname)
+    print("Pyramid of %d days: %1.2f s, %d levels, coarsest %s"%(len(fnames), t1-t0, pyr.n_levels, str(pyr.levels[-1]["mean"].shape)))
+    _, _, p_min = pyr.read(pyr.n_levels, stat="min")
+    print("Absorption spike in the min image of the coarsest level: %1.1f dB below the median"%(n.median(p_min) - n.min(p_min)))
+
+    fig, ax = plt.subplots(figsize=(10, 4))
+    t0 = time.perf_counter()
+    sp = SpectrogramPlot(ax, pyr)
+    fig.canvas.draw()
+    t1 = time.perf_counter()
+    print("Full range (level %d): %1.3f s"%(sp.level, t1-t0))
+    t_edges = sp.image.get_coordinates()[0, :, 0]
+    empty = n.all(sp.image.get_array().mask, axis=0)
+    print("Empty cells from %1.1f to %1.1f h after the start of the second day (no data from 3 to 9 h)"%(
+        (t_edges[:-1][empty][0] - t_start - 86400)/3600, (t_edges[1:][empty][-1] - t_start - 86400)/3600))
+    for width in [3600.0, 60.0]:
+        t0 = time.perf_counter()
+        ax.set_xlim(t_start + 43200 - width, t_start + 43200 + width)
+        fig.canvas.draw()
+        t1 = time.perf_counter()
+        print("Zoom to +-%1.0f s (level %d): %1.3f s"%(width, sp.level, t1-t0))
+    pyr.close()
+    shutil.rmtree(tmp)